@@ -0,0 +1,292 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Benchmark of the rule matching hot path (fiscal_allocation_map / fiscal_allocation_map_batch).
+#
+# Generates a synthetic dataset of Fiscal Domains, Fiscal Attributes, Fiscal Allocations and Fiscal Allocation Rules
+# of configurable size inside a local test database, measures per-line latency, batch throughput (from cold and warm
+# caches) and query counts, and writes the results as JSON so that runs can be compared across commits. Everything
+# happens in one transaction which is rolled back at the end: the database is left untouched.
+#
+# The database must have account_fiscal_allocation_rule installed. Example:
+#
+#   python bench_rule_matching.py -d bench --addons-path=/path/to/odoo/addons,/path/to/this/repo \
+#       --rules 10000 --attributes 200 --lines 2000 --output bench-10k.json
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+
+USE_FLAGS = ('use_sale', 'use_invoice', 'use_purchase', 'use_picking')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark of the Fiscal Allocation Rule matching hot path.")
+    parser.add_argument('-d', '--database', required=True, help="Local PostgreSQL test database.")
+    parser.add_argument('--addons-path', required=True)
+    parser.add_argument('--rules', type=int, default=1000, help="Number of rules per company (10 to 100000).")
+    parser.add_argument('--attributes', type=int, default=50, help="Number of Fiscal Attributes per company.")
+    parser.add_argument('--domains', type=int, default=5, help="Number of Fiscal Domains per company.")
+    parser.add_argument('--allocations', type=int, default=100, help="Number of Fiscal Allocations per company.")
+    parser.add_argument('--taxes', type=int, default=30, help="Number of taxes per company.")
+    parser.add_argument('--companies', type=int, default=1)
+    parser.add_argument('--partners', type=int, default=200)
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--lines', type=int, default=1000, help="Number of document lines to map.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="JSON result file, printed on stdout if omitted.")
+    args = parser.parse_args(argv)
+    if not 10 <= args.rules <= 100000:
+        parser.error("--rules must be between 10 and 100000")
+    return args
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip().decode()
+    except Exception:
+        return None
+
+
+class QueryCounter(object):
+    # Elapsed time and number of queries issued on the cursor between enter and exit.
+
+    def __init__(self, cr):
+        self.cr = cr
+
+    def __enter__(self):
+        self.queries = self.cr.sql_log_count
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+        self.queries = self.cr.sql_log_count - self.queries
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def rule_memory(rules):
+    # Mean size of the compiled rule snapshots (CompiledRule and its own containers, the values being shared).
+    if not rules:
+        return None
+    size = sum(sys.getsizeof(rule) + sys.getsizeof(rule.fiscal_allocation_ids) for rule in rules)
+    return float(size) / len(rules)
+
+
+def generate_company(cr, uid, pool, args, rng, company_id):
+    # Synthetic master data of one company. Return what the document lines are drawn from.
+    country_ids = pool.get('res.country').search(cr, uid, [], limit=10)
+    state_ids = pool.get('res.country.state').search(cr, uid, [('country_id', 'in', country_ids)], limit=30)
+    states = dict((s['id'], s['country_id'][0]) for s in pool.get('res.country.state').read(
+        cr, uid, state_ids, ['country_id']))
+
+    domain_ids = [pool.get('account.fiscal.domain').create(cr, uid, {
+        'name': 'BENCH D%d' % n, 'company_id': company_id}) for n in range(args.domains)]
+    attribute_ids = [pool.get('account.fiscal.attribute').create(cr, uid, {
+        'name': 'BENCH A%d' % n, 'company_id': company_id,
+        'fiscal_domain_id': rng.choice(domain_ids)}) for n in range(args.attributes)]
+    tax_ids = [pool.get('account.tax').create(cr, uid, {
+        'name': 'BENCH T%d-%d' % (company_id, n), 'amount': 0.01 * (n % 20), 'type_tax_use': 'all',
+        'company_id': company_id}) for n in range(args.taxes)]
+    allocation_ids = [pool.get('account.fiscal.allocation').create(cr, uid, {
+        'name': 'BENCH F%d' % n, 'company_id': company_id, 'fiscal_domain_id': rng.choice(domain_ids),
+        'sale_tax_ids': [(6, 0, rng.sample(tax_ids, min(len(tax_ids), rng.randint(1, 3))))],
+        'purchase_tax_ids': [(6, 0, rng.sample(tax_ids, min(len(tax_ids), rng.randint(1, 3))))],
+    }) for n in range(args.allocations)]
+
+    def geo():
+        # Most rules leave a criterion empty (any), like real rule sets do.
+        state_id = rng.random() < 0.2 and rng.choice(state_ids) or False
+        country_id = state_id and states[state_id] or (rng.random() < 0.4 and rng.choice(country_ids) or False)
+        return country_id, state_id
+
+    # The rules are inserted at once, as an import of a large rule set would do.
+    vals_list = []
+    for n in range(args.rules):
+        from_country, from_state = geo()
+        invoice_country, invoice_state = geo()
+        shipping_country, shipping_state = geo()
+        vals = {
+            'name': 'BENCH R%d' % n,
+            'company_id': company_id,
+            'fiscal_domain_id': rng.choice(domain_ids),
+            'from_country': from_country, 'from_state': from_state,
+            'to_invoice_country': invoice_country, 'to_invoice_state': invoice_state,
+            'to_shipping_country': shipping_country, 'to_shipping_state': shipping_state,
+            'fiscal_attribute_id': [(6, 0, rng.sample(attribute_ids, min(len(attribute_ids), rng.randint(0, 2))))],
+            'fiscal_allocation_id': [(6, 0, rng.sample(allocation_ids, min(len(allocation_ids), rng.randint(1, 3))))],
+            'vat_rule': rng.choice(['with', 'both', 'without']),
+            'sequence': rng.randint(1, 100),
+        }
+        for use in USE_FLAGS:
+            vals[use] = rng.random() < 0.6
+        if rng.random() < 0.2:
+            vals['date_start'] = '%d-%02d-01' % (rng.randint(2010, 2014), rng.randint(1, 12))
+        if rng.random() < 0.1:
+            vals['date_end'] = '%d-%02d-28' % (rng.randint(2014, 2018), rng.randint(1, 12))
+        vals_list.append(vals)
+    pool.get('account.fiscal.allocation.rule')._create_batch(cr, uid, vals_list)
+
+    partner_ids = []
+    for n in range(args.partners):
+        country_id, state_id = geo()
+        partner_ids.append(pool.get('res.partner').create(cr, uid, {
+            'name': 'BENCH P%d' % n, 'country_id': country_id, 'state_id': state_id,
+            'vat': rng.random() < 0.5 and 'CO%09d' % n or False,
+            'property_fiscal_attribute': [(6, 0, rng.sample(attribute_ids, min(len(attribute_ids), 2)))],
+        }))
+    product_ids = [pool.get('product.product').create(cr, uid, {
+        'name': 'BENCH PR%d' % n,
+        'property_fiscal_attribute': [(6, 0, rng.sample(attribute_ids, min(len(attribute_ids), 2)))],
+    }) for n in range(args.products)]
+
+    return {'partner_ids': partner_ids, 'product_ids': product_ids}
+
+
+def generate_lines(args, rng, companies):
+    lines = []
+    for n in range(args.lines):
+        company_id = rng.choice(list(companies))
+        data = companies[company_id]
+        partner_id = rng.choice(data['partner_ids'])
+        lines.append((
+            partner_id, partner_id, rng.random() < 0.5 and rng.choice(data['partner_ids']) or partner_id,
+            company_id, rng.choice(data['product_ids']),
+            '%d-%02d-%02d' % (rng.randint(2010, 2018), rng.randint(1, 12), rng.randint(1, 28)),
+            rng.choice(USE_FLAGS)))
+    return lines
+
+
+def run(cr, uid, pool, args):
+    rng = random.Random(args.seed)
+    obj_rule = pool.get('account.fiscal.allocation.rule')
+
+    companies = {}
+    company_ids = pool.get('res.company').search(cr, uid, [], limit=1)
+    for n in range(1, args.companies):
+        company_ids.append(pool.get('res.company').create(cr, uid, {'name': 'BENCH C%d' % n}))
+    with QueryCounter(cr) as generation:
+        for company_id in company_ids:
+            companies[company_id] = generate_company(cr, uid, pool, args, rng, company_id)
+    lines = generate_lines(args, rng, companies)
+
+    def map_line(line):
+        partner_id, partner_invoice_id, partner_shipping_id, company_id, product_id, date, use = line
+        return obj_rule.fiscal_allocation_map(
+            cr, uid, partner_id=partner_id, partner_invoice_id=partner_invoice_id,
+            partner_shipping_id=partner_shipping_id, company_id=company_id, product_id=product_id,
+            taxes=[], context={'date': date, 'use_domain': (use, '=', True)})
+
+    def drop_caches():
+        # Everything the fiscal mapping keeps in memory: compiled rules, attributes, tax sets and results.
+        obj_rule._rule_index_invalidate(cr, uid)
+        obj_rule._attribute_cache_invalidate(cr, uid)
+        pool.get('account.fiscal.allocation')._tax_cache_drop(cr, uid)
+        obj_rule._result_cache.clear()
+
+    # Cold start: compile the rules of every company (first call after a restart or a rule change).
+    drop_caches()
+    with QueryCounter(cr) as cold:
+        indexes = [obj_rule._rule_index_get(cr, uid, company_id) for company_id in company_ids]
+    rules = [rule for index in indexes for rule in index.rules.values()]
+
+    latencies, queries = [], []
+    for line in lines:
+        with QueryCounter(cr) as single:
+            map_line(line)
+        latencies.append(single.elapsed)
+        queries.append(single.queries)
+
+    # The per-line phase left every cache warm: the batch is measured from cold caches, then again warm.
+    drop_caches()
+    with QueryCounter(cr) as batch:
+        obj_rule.fiscal_allocation_map_batch(cr, uid, lines)
+    with QueryCounter(cr) as batch_warm:
+        obj_rule.fiscal_allocation_map_batch(cr, uid, lines)
+
+    return {
+        'generation': {'seconds': generation.elapsed, 'queries': generation.queries},
+        'cold_start': {'seconds': cold.elapsed, 'queries': cold.queries},
+        'memory': {'rules': len(rules), 'bytes_per_rule': rule_memory(rules)},
+        'per_line': {
+            'count': len(lines),
+            'mean_ms': 1000.0 * sum(latencies) / len(latencies),
+            'p50_ms': 1000.0 * percentile(latencies, 50),
+            'p95_ms': 1000.0 * percentile(latencies, 95),
+            'p99_ms': 1000.0 * percentile(latencies, 99),
+            'queries_mean': float(sum(queries)) / len(queries),
+            'queries_max': max(queries),
+        },
+        'batch': {
+            'count': len(lines),
+            'seconds': batch.elapsed,
+            'lines_per_second': batch.elapsed and len(lines) / batch.elapsed or None,
+            'queries': batch.queries,
+        },
+        'batch_warm': {
+            'count': len(lines),
+            'seconds': batch_warm.elapsed,
+            'lines_per_second': batch_warm.elapsed and len(lines) / batch_warm.elapsed or None,
+            'queries': batch_warm.queries,
+        },
+    }
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    import openerp
+    from openerp import SUPERUSER_ID
+    openerp.tools.config.parse_config(['--addons-path', args.addons_path])
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+
+    cr = registry.db.cursor()
+    try:
+        results = run(cr, SUPERUSER_ID, registry, args)
+    finally:
+        cr.rollback()
+        cr.close()
+
+    output = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'parameters': dict((k, v) for k, v in vars(args).items() if k not in ('database', 'addons_path', 'output')),
+        'results': results,
+    }
+    data = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,97 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Microbenchmark of the union of the tax sets of the Fiscal Allocations of the matched rules (map_tax on a union
+# cache miss): set-add loop over the tax ids against bitwise OR of the TaxOrdinals bitsets, decoded once.
+# No database needed. Example:
+#
+#   python bench_tax_union.py --rules 40 --allocations-per-rule 3 --taxes-per-allocation 4 --output union.json
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'models'))
+from fiscal_allocation_bitset import TaxOrdinals  # noqa: E402
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Microbenchmark of the Fiscal Allocation tax set union.")
+    parser.add_argument('--rules', type=int, default=40, help="Number of matched rules.")
+    parser.add_argument('--allocations-per-rule', type=int, default=3)
+    parser.add_argument('--taxes-per-allocation', type=int, default=4)
+    parser.add_argument('--taxes', type=int, default=300, help="Number of distinct taxes of the company.")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=2000, help="Unions per measure.")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="JSON result file, printed on stdout if omitted.")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    tax_ids = rng.sample(range(1, 100 * args.taxes), args.taxes)
+    allocations = [rng.sample(tax_ids, min(args.taxes, args.taxes_per_allocation))
+                   for n in range(args.rules * args.allocations_per_rule)]
+
+    sets = [frozenset(a) for a in allocations]
+    ordinals = TaxOrdinals()
+    masks = [ordinals.encode(a) for a in allocations]
+
+    def union_sets():
+        result = set()
+        for tax_set in sets:
+            for tax_id in tax_set:
+                result.add(tax_id)
+        return list(result)
+
+    def union_bitsets():
+        mask = 0
+        for tax_mask in masks:
+            mask |= tax_mask
+        return ordinals.decode(mask)
+
+    assert sorted(union_sets()) == sorted(union_bitsets())
+
+    results = {}
+    for name, function in (('set_add', union_sets), ('bitset_or', union_bitsets)):
+        best = min(timeit.repeat(function, repeat=args.repeat, number=args.number))
+        results[name] = {'us_per_union': 1e6 * best / args.number}
+    results['speedup'] = results['set_add']['us_per_union'] / results['bitset_or']['us_per_union']
+
+    data = json.dumps({
+        'python': sys.version.split()[0],
+        'parameters': dict((k, v) for k, v in vars(args).items() if k != 'output'),
+        'union_size': len(union_sets()),
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
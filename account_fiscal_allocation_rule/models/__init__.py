@@ -20,4 +20,7 @@
 from . import \
     fiscal_allocation, \
     fiscal_allocation_rule, \
-    fiscal_allocation_rule_invoice
+    fiscal_allocation_rule_invoice, \
+    fiscal_allocation_reapply, \
+    fiscal_allocation_import, \
+    fiscal_attribute
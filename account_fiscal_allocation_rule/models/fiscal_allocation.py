@@ -24,8 +24,19 @@
 #
 ###############################################################################
 
+import logging
+import psycopg2
+from openerp import SUPERUSER_ID
 from openerp.osv import fields, orm
+from openerp.tools.lru import LRU
 from itertools import chain
+from .fiscal_allocation_batch import batch_insert
+from .fiscal_allocation_bitset import TaxOrdinals
+from .fiscal_allocation_generation import CACHE_BUILD_CONTEXT
+from .fiscal_allocation_profile import profiled
+from .fiscal_allocation_rule_index import CompiledRule
+
+_logger = logging.getLogger(__name__)
 
 ACC_FISC_ALLOC_COLS_TMPL = {
     'name': fields.char('Fiscal Allocation', size=64, required=True),
@@ -65,6 +76,84 @@ class AccountFiscalAllocation(orm.Model):
     _columns = dict(chain(ACC_FISC_ALLOC_COLS_TMPL.items(), nontmpl_update_cols.items()))
     _defaults = dict(chain(ACC_FISC_ALLOC_DEFS_TMPL.items(), nontmpl_update_defs.items()))
 
+    def __init__(self, pool, cr):
+        super(AccountFiscalAllocation, self).__init__(pool, cr)
+        # Materialized tax sets, as bitsets over self._tax_ordinals: {allocation_id: {'sale': mask, 'purchase': mask}}
+        self._tax_sets = {}
+        # Never replaced nor reset: the bit position of a tax stays valid for the masks computed by concurrent
+        # threads, whatever the caches dropped in between. It only grows with the taxes of the database.
+        self._tax_ordinals = TaxOrdinals()
+        # Allocated taxes of a combination of matched rules: {(frozenset(rule ids), 'sale'|'purchase'): [tax ids]}
+        self._tax_union_cache = LRU(4096)
+
+    # Allocations are compiled into the rule index of account.fiscal.allocation.rule, keep it current.
+    # Writing sale_tax_ids / purchase_tax_ids is the only way fiscal_allocation_*_tax_rel are changed.
+    def create(self, cr, uid, vals, context=None):
+        res_id = super(AccountFiscalAllocation, self).create(cr, uid, vals, context=context)
+        self.pool.get('account.fiscal.allocation.rule')._rule_index_invalidate(cr, uid, context=context)
+        return res_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        res = super(AccountFiscalAllocation, self).write(cr, uid, ids, vals, context=context)
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+        obj_rule._rule_index_invalidate(cr, uid, context=context)
+        obj_rule._flat_refresh(cr, uid, obj_rule._flat_rule_ids(cr, uid, allocation_ids=ids, context=context),
+                               context=context)
+        self._tax_cache_invalidate(cr, uid, ids, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+        rule_ids = obj_rule._flat_rule_ids(cr, uid, allocation_ids=ids, context=context)
+        res = super(AccountFiscalAllocation, self).unlink(cr, uid, ids, context=context)
+        obj_rule._rule_index_invalidate(cr, uid, context=context)
+        obj_rule._flat_refresh(cr, uid, rule_ids, context=context)
+        self._tax_cache_invalidate(cr, uid, ids, context=context)
+        return res
+
+    def _create_batch(self, cr, uid, vals_list, context=None):
+        # Mass creation of allocations (chart templates, imports), see fiscal_allocation_batch. New allocations are
+        # linked to no rule yet: invalidating the compiled rules once, like create() does, is enough.
+        ids = batch_insert(self, cr, uid, vals_list, context=context)
+        if ids:
+            self.pool.get('account.fiscal.allocation.rule')._rule_index_invalidate(cr, uid, context=context)
+        return ids
+
+    def _tax_cache_invalidate(self, cr, uid, allocation_ids=None, context=None):
+        # Drop the tax sets of allocation_ids (all of them if None), in all workers (cache scope 'taxes').
+        self._tax_cache_drop(cr, uid, allocation_ids, context=context)
+        if allocation_ids is None or allocation_ids:
+            self.pool.get('account.fiscal.allocation.rule')._cache_signal(cr, uid, ['taxes'], context=context)
+
+    def _tax_cache_drop(self, cr, uid, allocation_ids=None, context=None):
+        # Local part of _tax_cache_invalidate. Any combination of rules may involve the allocations, so the memoized
+        # unions are always dropped. Changed tax sets also outdate the cached mapping results.
+        if allocation_ids is None:
+            self._tax_sets.clear()
+        else:
+            for allocation_id in allocation_ids:
+                self._tax_sets.pop(allocation_id, None)
+        self._tax_union_cache.clear()
+        if allocation_ids is None or allocation_ids:
+            self.pool.get('account.fiscal.allocation.rule')._rule_generation_bump(cr, uid, context=context)
+
+    def _allocation_tax_sets(self, cr, uid, allocation_ids, context=None):
+        missing = [a for a in allocation_ids if a not in self._tax_sets]
+        if missing:
+            # Shared by all the users of the worker, see CACHE_BUILD_CONTEXT.
+            for allocation in self.read(cr, SUPERUSER_ID, missing, ['sale_tax_ids', 'purchase_tax_ids'],
+                                        context=dict(CACHE_BUILD_CONTEXT)):
+                self._tax_sets[allocation['id']] = {
+                    'sale': self._tax_ordinals.encode(allocation['sale_tax_ids']),
+                    'purchase': self._tax_ordinals.encode(allocation['purchase_tax_ids']),
+                }
+        return dict((a, self._tax_sets[a]) for a in allocation_ids)
+
+    @profiled
     def map_tax(self, cr, uid, frules, taxes, inv_type, context=None):
 
         # 'set()' filters duplicates. 'taxes' are product's default coded taxes, there is no conflict with the
@@ -72,25 +161,66 @@ class AccountFiscalAllocation(orm.Model):
         result = set(taxes)
 
         # CASE: Outgoing Invoice or a refund of such.
-        if inv_type in ('out_invoice','out_refund'):
-            # Iterate all applicable Fiscal Allocation Rules, that have been passed.
-            for f in frules:
-                # Iterate all Fiscal Allocations of each Fiscal Allocation Rule
-                for a in fiscal_allocation_id:
-                    # Iterate Sales Taxes of each Fiscal Allocation
-                    for t in self.sale_tax_ids:
-                        # Add Tax to result (evitating duplicates, as 'result' is a python 'set()')
-                        result.add(t.id)
-
+        if inv_type in ('out_invoice', 'out_refund'):
+            direction = 'sale'
         # CASE: Incoming Invoice or a refund of such.
-        if inv_type in ('in_invoice', 'in_refund'):
-            for f in frules:
-                for a in fiscal_allocation_id:
-                    for t in self.purchase_tax_ids:
-                        result.add(t.id)
-
+        elif inv_type in ('in_invoice', 'in_refund'):
+            direction = 'purchase'
+        else:
+            return list(result)
+
+        # 'frules' are the applicable Fiscal Allocation Rules, as ids, browse records or compiled rules (which carry
+        # their allocations, sparing the read of the rules). The same combination of rules comes back over and over
+        # again, so the union of the taxes of all their Fiscal Allocations is memoized.
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+        obj_rule._cache_check(cr, uid, context=context)
+        rule_ids = frozenset(getattr(f, 'id', f) for f in frules)
+        key = (rule_ids, direction)
+        profile = obj_rule._profile
+        if key in self._tax_union_cache:
+            profile.count('tax_union', True)
+            allocated = self._tax_union_cache[key]
+        else:
+            profile.count('tax_union', False)
+            if all(isinstance(f, CompiledRule) for f in frules):
+                allocation_ids = set(chain.from_iterable(f.fiscal_allocation_ids for f in frules))
+            else:
+                allocation_ids = obj_rule._rule_allocation_ids(cr, uid, rule_ids, context=context)
+            mask = 0
+            for tax_set in self._allocation_tax_sets(cr, uid, allocation_ids, context=context).values():
+                mask |= tax_set[direction]
+            allocated = self._tax_ordinals.decode(mask)
+            self._tax_union_cache[key] = allocated
+
+        result.update(allocated)
         return list(result)
 
+
+class AccountTax(orm.Model):
+    _inherit = 'account.tax'
+
+    # Deactivated or deleted taxes disappear from the tax sets of the Fiscal Allocations.
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(AccountTax, self).write(cr, uid, ids, vals, context=context)
+        if 'active' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            obj_rule = self.pool.get('account.fiscal.allocation.rule')
+            obj_rule._flat_refresh(cr, uid, obj_rule._flat_rule_ids(cr, uid, tax_ids=ids, context=context),
+                                   context=context)
+            self.pool.get('account.fiscal.allocation')._tax_cache_invalidate(cr, uid, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+        rule_ids = obj_rule._flat_rule_ids(cr, uid, tax_ids=ids, context=context)
+        res = super(AccountTax, self).unlink(cr, uid, ids, context=context)
+        obj_rule._flat_refresh(cr, uid, rule_ids, context=context)
+        self.pool.get('account.fiscal.allocation')._tax_cache_invalidate(cr, uid, context=context)
+        return res
+
 # ---------------------------
 # Templates & Wizards Section
 # ---------------------------
@@ -99,35 +229,69 @@ class AccountFiscalAllocation(orm.Model):
 class AccountFiscalAllocationTemplate(orm.Model):
     _name = 'account.fiscal.allocation.template'
     _description = 'Fiscal Allocation Set Template'
-    _columns = ACC_FISC_ALLOC_COLS_TMPL
+
+    # The tax relation tables of the allocations have their foreign key on the allocation table: templates need
+    # their own.
+    tmpl_update_cols = {
+        'sale_tax_ids': fields.many2many(
+            'account.tax', 'fiscal_allocation_template_sale_tax_rel',
+            'template_id', 'tax_id', 'Applicable Sale Taxes',
+            domain="[('type_tax_use', '!=', 'purchase'),('fiscal_domain_id', '=', fiscal_domain_id)]"),
+        'purchase_tax_ids': fields.many2many(
+            'account.tax', 'fiscal_allocation_template_purchase_tax_rel',
+            'template_id', 'tax_id', 'Applicable Purchase Taxes',
+            domain="[('type_tax_use', '!=', 'sale'),('fiscal_domain_id', '=', fiscal_domain_id)]"),
+    }
+
+    _columns = dict(chain(ACC_FISC_ALLOC_COLS_TMPL.items(), tmpl_update_cols.items()))
     _defaults = ACC_FISC_ALLOC_DEFS_TMPL
 
-# Is this for pure convenience? Look at views of fiscal_classification to identify use.
+    def init(self, cr):
+        # Trigram indexes for the substring matches of name_search. pg_trgm may be missing or not installable by the
+        # database user: name_search works without them, only slower on large template catalogs.
+        cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if not cr.fetchone():
+            cr.execute("SAVEPOINT fiscal_allocation_template_trgm")
+            try:
+                cr.execute("CREATE EXTENSION pg_trgm")
+            except psycopg2.Error:
+                cr.execute("ROLLBACK TO SAVEPOINT fiscal_allocation_template_trgm")
+                _logger.warning("Extension pg_trgm not available, %s.name_search is not index-backed.", self._name)
+                return
+            cr.execute("RELEASE SAVEPOINT fiscal_allocation_template_trgm")
+        for field in ('name', 'description'):
+            index = '%s_%s_trgm_index' % (self._table, field)
+            cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", (index,))
+            if not cr.fetchone():
+                cr.execute('CREATE INDEX "%s" ON "%s" USING gin ("%s" gin_trgm_ops)' % (index, self._table, field))
+
     def name_search(self, cr, user, name='', args=None, operator='ilike',
                     context=None, limit=80):
-
-        if not args:
-            args = []
-
-        if not context:
-            context = {}
-
-        if name:
-            ids = self.search(cr, user, [('name', '=', name)] + args,
-                              limit=limit, context=context)
-            if not len(ids):
-                ids = self.search(
-                    cr, user, [('description', '=', name)] + args,
-                    limit=limit, context=context)
-            if not len(ids):
-                ids = self.search(cr, user, [('name', operator, name)] + args,
-                                  limit=limit, context=context)
-                ids += self.search(
-                    cr, user, [('description', operator, name)] + args,
-                    limit=limit, context=context)
-        else:
-            ids = self.search(cr, user, args, limit=limit, context=context)
-
+        # Single query: exact matches on name, then on description, then prefix matches, then substring matches,
+        # each group ordered by name.
+        if not name or operator not in ('ilike', 'like'):
+            return super(AccountFiscalAllocationTemplate, self).name_search(
+                cr, user, name, args=args, operator=operator, context=context, limit=limit)
+
+        query = self._where_calc(cr, user, args or [], context=context)
+        self._apply_ir_rules(cr, user, query, 'read', context=context)
+        from_clause, where_clause, where_params = query.get_sql()
+        pattern = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        like = operator.upper()
+        cr.execute(
+            'SELECT "%(table)s".id FROM %(from)s WHERE %(where)s '
+            '("%(table)s".name %(like)s %%s OR "%(table)s".description %(like)s %%s) '
+            'ORDER BY CASE WHEN "%(table)s".name = %%s THEN 0 WHEN "%(table)s".description = %%s THEN 1 '
+            'WHEN "%(table)s".name %(like)s %%s OR "%(table)s".description %(like)s %%s THEN 2 ELSE 3 END, '
+            '"%(table)s".name, "%(table)s".id LIMIT %%s' % {
+                'table': self._table,
+                'from': from_clause,
+                'where': where_clause and where_clause + ' AND' or '',
+                'like': like,
+            },
+            where_params + ['%' + pattern + '%', '%' + pattern + '%', name, name, pattern + '%', pattern + '%',
+                            limit or None])
+        ids = [row[0] for row in cr.fetchall()]
         return self.name_get(cr, user, ids, context)
 
 
@@ -141,53 +305,56 @@ class WizardAccountFiscalAllocation(orm.TransientModel):
         self.pool.get('res.users').browse(cr, uid, [uid], c)[0].company_id.id,
     }
 
+    def _template_tax_map(self, cr, uid, tax_ids, company_id, context=None):
+        # {tax_id: tax of the same name of the company} for the taxes 'tax_ids' of the templates, in one query.
+        if not tax_ids:
+            return {}
+        cr.execute("SELECT src.id, min(dst.id) FROM account_tax src "
+                   "JOIN account_tax dst ON dst.name = src.name AND dst.company_id = %s "
+                   "WHERE src.id IN %s GROUP BY src.id", (company_id, tuple(tax_ids)))
+        return dict(cr.fetchall())
+
     def action_create(self, cr, uid, ids, context=None):
         obj_wizard = self.browse(cr, uid, ids[0])
-        obj_tax = self.pool.get('account.tax')
-        obj_tax_template = self.pool.get('account.tax.template')
         obj_fa = self.pool.get('account.fiscal.allocation')
         obj_fa_template = self.pool.get(
             'account.fiscal.allocation.template')
 
         company_id = obj_wizard.company_id.id
-        tax_template_ref = {}
-
-        tax_ids = obj_tax.search(
-            cr, uid, [('company_id', '=', company_id)], context=context)
-
-        for tax in obj_tax.browse(cr, uid, tax_ids, context=context):
-            tax_template = obj_tax_template.search(
-                cr, uid, [('name', '=', tax.name)], context=context)[0]
-
-            if tax_template:
-                tax_template_ref[tax_template] = tax.id
 
         fclass_ids_template = obj_fa_template.search(
             cr, uid, [], context=context)
-
-        for fclass_template in obj_fa_template.browse(
-                cr, uid, fclass_ids_template, context=context):
-
-            fclass_id = obj_fa.search(
-                cr, uid, [('name', '=', fclass_template.name)],
-                context=context)
-
-            if not fclass_id:
-                t_sale_tax_ids = []
-                for tax in fclass_template.sale_tax_ids:
-                    t_sale_tax_ids.append(tax_template_ref[tax.id])
-
-                t_purchase_tax_ids = []
-                for tax in fclass_template.purchase_tax_ids:
-                    t_purchase_tax_ids.append(tax_template_ref[tax.id])
-
-                vals = {
-                    'name': fclass_template.name,
-                    'description': fclass_template.description,
-                    'company_id': company_id,
-                    'sale_tax_ids': [(6, 0, t_sale_tax_ids)],
-                    'purchase_tax_ids': [(6, 0, t_purchase_tax_ids)]
-                }
-                obj_fa.create(cr, uid, vals, context)
+        templates = obj_fa_template.read(cr, uid, fclass_ids_template, ACC_FISC_ALLOC_COLS_TMPL.keys(),
+                                         context=context, load='_classic_write')
+
+        # The templates refer to the taxes of a reference company, matched by name with the taxes of the company.
+        tax_map = self._template_tax_map(
+            cr, uid, set(t for template in templates for t in template['sale_tax_ids'] + template['purchase_tax_ids']),
+            company_id, context=context)
+
+        fclass_ids = obj_fa.search(cr, uid, [('company_id', '=', company_id)], context=context)
+        existing = set(fclass['name'] for fclass in obj_fa.read(cr, uid, fclass_ids, ['name'], context=context))
+
+        vals_list = []
+        for fclass_template in templates:
+            if fclass_template['name'] in existing:
+                continue
+            t_sale_tax_ids = [tax_map.get(t) for t in fclass_template['sale_tax_ids']]
+            t_purchase_tax_ids = [tax_map.get(t) for t in fclass_template['purchase_tax_ids']]
+            if None in t_sale_tax_ids or None in t_purchase_tax_ids:
+                _logger.info("Fiscal Allocation template %s (%s) skipped: its taxes do not exist in company %s.",
+                             fclass_template['id'], fclass_template['name'], company_id)
+                continue
+            existing.add(fclass_template['name'])
+            vals_list.append({
+                'name': fclass_template['name'],
+                'description': fclass_template['description'],
+                'fiscal_domain_id': fclass_template['fiscal_domain_id'],
+                'note': fclass_template['note'],
+                'company_id': company_id,
+                'sale_tax_ids': [(6, 0, t_sale_tax_ids)],
+                'purchase_tax_ids': [(6, 0, t_purchase_tax_ids)]
+            })
+        obj_fa._create_batch(cr, uid, vals_list, context=context)
 
         return {}
@@ -0,0 +1,78 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Multi-row INSERTs for mass creation (chart templates, imports) of records of the simple models of this module:
+# stored columns and many2many relations only, no function fields, translations or workflows. Selection values,
+# the create record rules and the _constraints of the model are checked for each inserted chunk, as create() does.
+
+from openerp.osv import orm
+
+# Rows per INSERT statement.
+BATCH_SIZE = 1000
+
+
+def batch_insert(model, cr, uid, vals_list, context=None):
+    # Insert the records 'vals_list' (create() values, many2many values as [(6, 0, ids)]) of 'model', defaults
+    # applied. Return the ids of the new records, in the order of 'vals_list'. Hooks of create() are not called,
+    # the caller refreshes what depends on the new records once for the whole batch.
+    if not vals_list:
+        return []
+    model.check_access_rights(cr, uid, 'create')
+    defaults = model.default_get(cr, uid, model._columns.keys(), context=context)
+    columns = sorted(name for name, column in model._columns.items() if column._classic_write)
+    relations = sorted(name for name, column in model._columns.items() if column._type == 'many2many')
+    selections = dict((name, set(key for key, label in column.selection)) for name, column in model._columns.items()
+                      if column._type == 'selection' and isinstance(column.selection, (list, tuple)))
+
+    ids = []
+    for start in range(0, len(vals_list), BATCH_SIZE):
+        chunk = vals_list[start:start + BATCH_SIZE]
+        cr.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (model._sequence, len(chunk)))
+        chunk_ids = [row[0] for row in cr.fetchall()]
+        rows, params = [], []
+        for record_id, vals in zip(chunk_ids, chunk):
+            rows.append("(%s, %s, %s, now() at time zone 'UTC', now() at time zone 'UTC'" +
+                        ", %s" * len(columns) + ")")
+            params.extend([record_id, uid, uid])
+            for name in columns:
+                value = vals.get(name, defaults.get(name))
+                if value is False and model._columns[name]._type != 'boolean':
+                    value = None
+                if name in selections and value is not None and value not in selections[name]:
+                    raise orm.except_orm('ValidateError', "Wrong value %s for field %s" % (value, name))
+                params.append(value)
+        cr.execute('INSERT INTO "%s" (id, create_uid, write_uid, create_date, write_date, ' % model._table +
+                   ", ".join('"%s"' % name for name in columns) + ") VALUES " + ", ".join(rows), params)
+
+        for name in relations:
+            column = model._columns[name]
+            links = []
+            for record_id, vals in zip(chunk_ids, chunk):
+                for command in vals.get(name) or []:
+                    if command[0] != 6:
+                        raise ValueError("Only [(6, 0, ids)] is supported for %s" % name)
+                    links.extend((record_id, link_id) for link_id in set(command[2]))
+            if links:
+                cr.execute('INSERT INTO "%s" ("%s", "%s") VALUES ' % (column._rel, column._id1, column._id2) +
+                           ", ".join(["(%s, %s)"] * len(links)), [value for link in links for value in link])
+        model.check_access_rule(cr, uid, chunk_ids, 'create', context=context)
+        model._validate(cr, uid, chunk_ids, context=context)
+        ids.extend(chunk_ids)
+    return ids
@@ -0,0 +1,66 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Tax sets as integer bitsets over a dense tax ordinal: the union of the tax sets of any number of Fiscal
+# Allocations is a few bitwise ORs, decoded to tax ids once. Plain python (no ORM access), see
+# benchmark/bench_tax_union.py.
+
+import threading
+
+
+class TaxOrdinals(object):
+    """Dense bit position of every tax met so far: {tax_id: 1 << n}."""
+
+    def __init__(self):
+        self.bits = {}
+        self.tax_ids = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tax_ids)
+
+    def encode(self, tax_ids):
+        mask = 0
+        for tax_id in tax_ids:
+            bit = self.bits.get(tax_id)
+            if bit is None:
+                # Shared by the threads of the worker: new taxes get their position under the lock, and are only
+                # visible in 'bits' once 'tax_ids' has them.
+                with self.lock:
+                    bit = self.bits.get(tax_id)
+                    if bit is None:
+                        self.tax_ids.append(tax_id)
+                        bit = self.bits[tax_id] = 1 << (len(self.tax_ids) - 1)
+            mask |= bit
+        return mask
+
+    def decode(self, mask):
+        # Decode through the binary string of the mask, lowest bit first: a scan for dense masks, jumps from set bit
+        # to set bit for sparse ones. Both beat shifting the (long) integer bit by bit.
+        bits = bin(mask)[:1:-1]
+        tax_ids = self.tax_ids
+        if bits.count('1') * 8 >= len(bits):
+            return [tax_ids[i] for i, bit in enumerate(bits) if bit == '1']
+        result = []
+        i = bits.find('1')
+        while i >= 0:
+            result.append(tax_ids[i])
+            i = bits.find('1', i + 1)
+        return result
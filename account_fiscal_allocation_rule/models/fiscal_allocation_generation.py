@@ -0,0 +1,75 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Cache generations shared by the workers through the database: one row (scope, generation) per cache scope, the
+# generations drawn from a sequence. Plain python (no ORM access), see account.fiscal.allocation.rule _cache_signal
+# and _cache_check.
+
+import weakref
+
+# The caches are shared by all the users of the worker: they are filled as superuser with this context, never with
+# the uid and context (language, record rules, active_test) of the caller who happens to miss them.
+CACHE_BUILD_CONTEXT = {'active_test': True}
+
+
+class CacheGenerations(object):
+    """Generations of the cache scopes last seen by this worker: {scope: generation}."""
+
+    def __init__(self, table, sequence):
+        self.table = table
+        self.sequence = sequence
+        self.generations = {}
+        # Read the generations on the next use of the caches.
+        self.pending = True
+        # Cursors which changed generations: their transaction may still roll back, so the generations are read
+        # again on every use until they are gone.
+        self.cursors = weakref.WeakSet()
+
+    def signal(self, cr, scopes):
+        # Give the scopes new generations, in the transaction of the change. A sequence is not transactional: a
+        # generation is never handed out twice, even when the transaction rolls back, and generations are only
+        # compared for equality. The local generations are left alone, the next check reads them back.
+        for scope in scopes:
+            cr.execute("UPDATE " + self.table + " SET generation = nextval(%s) WHERE scope = %s",
+                       (self.sequence, scope))
+            if not cr.rowcount:
+                cr.execute("INSERT INTO " + self.table + " (scope, generation) VALUES (%s, nextval(%s))",
+                           (scope, self.sequence))
+        self.cursors.add(cr)
+        self.pending = True
+
+    def check(self, cr):
+        # Return the scopes whose generation changed (or disappeared, with a rolled back first change) since the
+        # last check, as seen by the transaction of 'cr'.
+        if not self.pending:
+            return []
+        # Once the cursors of the changes are gone, this check is the last one: it sees their outcome, committed
+        # or not.
+        self.pending = bool(len(self.cursors))
+        cr.execute("SELECT scope, generation FROM " + self.table)
+        current = dict(cr.fetchall())
+        changed = [scope for scope in self.generations if scope not in current]
+        for scope in changed:
+            del self.generations[scope]
+        for scope, generation in current.items():
+            if self.generations.get(scope) != generation:
+                self.generations[scope] = generation
+                changed.append(scope)
+        return changed
@@ -0,0 +1,433 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Streaming import of Fiscal Attributes, Fiscal Allocations and Fiscal Allocation Rules from CSV or XML files of
+# tens of thousands of rows. Rows are read one by one, their references (countries, states, domains, attributes,
+# allocations, taxes, accounts) resolved through name/code maps loaded once per import, and inserted by chunks with
+# _create_batch. Invalid rows are rejected and reported, the others imported.
+#
+# CSV: UTF-8, a header line with the column names below, many2many columns as comma separated names.
+# XML: <records><record><field name="column">value</field>...</record>...</records>
+#
+# account.fiscal.attribute:      name*, description, note, attribute_use, fiscal_domain
+# account.fiscal.allocation:     name*, description, note, fiscal_domain*, sale_taxes, purchase_taxes
+# account.fiscal.allocation.rule: name*, description, fiscal_domain*, sequence, vat_rule, use_sale, use_invoice,
+#                                 use_purchase, use_picking, date_start, date_end, from_country, from_state,
+#                                 to_invoice_country, to_invoice_state, to_shipping_country, to_shipping_state,
+#                                 fiscal_attributes, fiscal_allocations, account_invoice, account_purchase
+#
+# Countries and states are given by code, accounts by code, all other references by name.
+
+import base64
+import csv
+import logging
+import psycopg2
+import tempfile
+from datetime import datetime
+from xml.parsers import expat
+from openerp.osv import fields, orm
+from .fiscal_allocation_rule_index import DATE_FORMAT, RULE_USE_FLAGS
+
+_logger = logging.getLogger(__name__)
+
+IMPORT_MODELS = [
+    ('account.fiscal.attribute', 'Fiscal Attributes'),
+    ('account.fiscal.allocation', 'Fiscal Allocations'),
+    ('account.fiscal.allocation.rule', 'Fiscal Allocation Rules'),
+]
+
+# Rejected rows detailed in the result of the wizard, the others are only counted.
+IMPORT_REPORT_LIMIT = 1000
+
+# (country column, state column), named like the rule fields.
+IMPORT_GEO_COLUMNS = [
+    ('from_country', 'from_state'),
+    ('to_invoice_country', 'to_invoice_state'),
+    ('to_shipping_country', 'to_shipping_state'),
+]
+
+# Name (or code) -> id maps of the records the rows refer to: (query, company dependent). The last column is the id,
+# the others the key. Records of the company come first, so they win over shared records of the same name.
+IMPORT_LOOKUPS = {
+    'country': ("SELECT upper(code), id FROM res_country ORDER BY id", False),
+    'state': ("SELECT country_id, upper(code), id FROM res_country_state ORDER BY id", False),
+    'fiscal_domain': ("SELECT name, id FROM account_fiscal_domain WHERE company_id = %(company_id)s "
+                      "OR company_id IS NULL ORDER BY company_id IS NULL, id", True),
+    'attribute_use': ("SELECT name, id FROM account_fiscal_attribute_use WHERE company_id = %(company_id)s "
+                      "AND active ORDER BY id", True),
+    'attribute': ("SELECT name, id FROM account_fiscal_attribute WHERE company_id = %(company_id)s AND active "
+                  "ORDER BY id", True),
+    'allocation': ("SELECT name, id FROM account_fiscal_allocation WHERE company_id = %(company_id)s AND active "
+                   "ORDER BY id", True),
+    'tax': ("SELECT name, id FROM account_tax WHERE company_id = %(company_id)s AND active ORDER BY id", True),
+    'account': ("SELECT code, id FROM account_account WHERE company_id = %(company_id)s AND active ORDER BY id",
+                True),
+}
+
+
+class ImportRowError(Exception):
+    pass
+
+
+class ImportFileError(Exception):
+    # The file cannot be read at all: nothing is imported.
+    pass
+
+
+# The readers yield (row number, {column: value}), or (row number, ImportRowError) for a row which cannot be read:
+# the row is rejected and the reading goes on.
+
+def csv_rows(fileobj):
+    # Rows of a CSV file, one at a time.
+    reader = csv.reader(fileobj)
+    header = None
+    for row in reader:
+        if header is None:
+            try:
+                header = [h.decode('utf-8-sig').strip() for h in row]
+            except UnicodeDecodeError:
+                raise ImportFileError("The header line is not UTF-8.")
+            continue
+        if not any(row):
+            continue
+        if len(row) != len(header):
+            yield reader.line_num, ImportRowError("%s columns, the header has %s" % (len(row), len(header)))
+            continue
+        try:
+            values = [value.decode('utf-8').strip() for value in row]
+        except UnicodeDecodeError:
+            yield reader.line_num, ImportRowError("Not UTF-8")
+            continue
+        yield reader.line_num, dict(zip(header, values))
+
+
+def xml_rows(fileobj, step=65536):
+    # Records of an XML file, one at a time: the file is parsed piece by piece, no tree is built. Documents with a
+    # DOCTYPE are refused, their entity declarations could expand to any size or load other files.
+    records = []
+    state = {'row': None, 'field': None, 'text': []}
+
+    def start(tag, attrs):
+        if tag == 'record':
+            state['row'] = {}
+        elif tag == 'field' and state['row'] is not None:
+            state['field'] = attrs.get('name')
+            state['text'] = []
+
+    def end(tag):
+        if tag == 'field' and state['row'] is not None:
+            state['row'][state['field']] = ''.join(state['text']).strip()
+            state['field'] = None
+        elif tag == 'record' and state['row'] is not None:
+            records.append(state['row'])
+            state['row'] = None
+
+    def data(text):
+        if state['field'] is not None:
+            state['text'].append(text)
+
+    def refuse(*args):
+        raise ImportFileError("DOCTYPE and entity declarations are not allowed in XML files.")
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    parser.StartDoctypeDeclHandler = refuse
+    parser.EntityDeclHandler = refuse
+    number = 0
+    while True:
+        piece = fileobj.read(step)
+        try:
+            parser.Parse(piece, not piece)
+        except expat.ExpatError as e:
+            raise ImportFileError("Invalid XML file: %s" % e)
+        for row in records:
+            number += 1
+            yield number, row
+        del records[:]
+        if not piece:
+            break
+
+
+IMPORT_READERS = {
+    'csv': csv_rows,
+    'xml': xml_rows,
+}
+
+
+def b64decode_file(data, fileobj, step=4 * 65536):
+    # Decode the base64 'data' into 'fileobj' piece by piece. Whitespace (line breaks) is dropped from each piece
+    # rather than from a full copy of the data; the characters beyond the last complete quantum are carried over.
+    rest = ''
+    for i in range(0, len(data), step):
+        piece = rest + ''.join(data[i:i + step].split())
+        end = len(piece) - len(piece) % 4
+        fileobj.write(base64.b64decode(piece[:end]))
+        rest = piece[end:]
+    if rest:
+        fileobj.write(base64.b64decode(rest))
+
+
+class ImportLookups(object):
+    # The IMPORT_LOOKUPS maps of a company, loaded on first use.
+
+    def __init__(self, cr, company_id):
+        self.cr = cr
+        self.company_id = company_id
+        self.maps = {}
+
+    def map(self, kind):
+        if kind not in self.maps:
+            query, company_dependent = IMPORT_LOOKUPS[kind]
+            self.cr.execute(query, company_dependent and {'company_id': self.company_id} or None)
+            result = self.maps[kind] = {}
+            for row in self.cr.fetchall():
+                result.setdefault(len(row) > 2 and row[:-1] or row[0], row[-1])
+        return self.maps[kind]
+
+    def get(self, kind, key, label):
+        # Id of the record 'key' (False for an empty key), ImportRowError if there is none.
+        if not key:
+            return False
+        if kind in ('country', 'state'):
+            key = isinstance(key, tuple) and (key[0], key[1].upper()) or key.upper()
+        record_id = self.map(kind).get(key)
+        if record_id is None:
+            raise ImportRowError("Unknown %s '%s'" % (label, isinstance(key, tuple) and key[-1] or key))
+        return record_id
+
+    def get_many(self, kind, value, label):
+        return [self.get(kind, key.strip(), label) for key in value.split(',') if key.strip()]
+
+
+def import_bool(value, column):
+    value = (value or '').lower()
+    if value in ('', '0', 'false', 'no', 'n'):
+        return False
+    if value in ('1', 'true', 'yes', 'y', 'x'):
+        return True
+    raise ImportRowError("Invalid boolean '%s' in %s" % (value, column))
+
+
+def import_date(value, column):
+    if not value:
+        return False
+    try:
+        datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        raise ImportRowError("Invalid date '%s' in %s, expected YYYY-MM-DD" % (value, column))
+    return value
+
+
+def import_required(row, column):
+    if not row.get(column):
+        raise ImportRowError("Missing %s" % column)
+    return row[column]
+
+
+class WizardAccountFiscalAllocationImport(orm.TransientModel):
+    _name = 'wizard.account.fiscal.allocation.import'
+    _description = 'Import Fiscal Attributes, Allocations and Rules'
+    _columns = {
+        'company_id': fields.many2one('res.company', 'Company', required=True),
+        'model': fields.selection(IMPORT_MODELS, 'Records', required=True),
+        'file_format': fields.selection([('csv', 'CSV'), ('xml', 'XML')], 'Format', required=True),
+        # Required by the view only: it is emptied once imported, not to keep the file in the database.
+        'data': fields.binary('File'),
+        'chunk_size': fields.integer('Chunk Size', required=True, help="Number of rows inserted together."),
+        'result': fields.text('Result', readonly=True),
+    }
+    _defaults = {
+        'company_id': lambda self, cr, uid, c:
+        self.pool.get('res.users').browse(cr, uid, [uid], c)[0].company_id.id,
+        'model': 'account.fiscal.allocation.rule',
+        'file_format': 'csv',
+        'chunk_size': 1000,
+    }
+
+    # ##### Row conversion: create() values of a row, ImportRowError if the row is invalid
+
+    def _import_attribute_vals(self, cr, uid, row, lookups, company_id, context=None):
+        return {
+            'name': import_required(row, 'name'),
+            'description': row.get('description') or False,
+            'note': row.get('note') or False,
+            'attribute_use_id': lookups.get('attribute_use', row.get('attribute_use'), 'attribute use'),
+            'fiscal_domain_id': lookups.get('fiscal_domain', row.get('fiscal_domain'), 'fiscal domain'),
+            'company_id': company_id,
+        }
+
+    def _import_allocation_vals(self, cr, uid, row, lookups, company_id, context=None):
+        return {
+            'name': import_required(row, 'name'),
+            'description': row.get('description') or False,
+            'note': row.get('note') or False,
+            'fiscal_domain_id': lookups.get('fiscal_domain', import_required(row, 'fiscal_domain'), 'fiscal domain'),
+            'sale_tax_ids': [(6, 0, lookups.get_many('tax', row.get('sale_taxes', ''), 'tax'))],
+            'purchase_tax_ids': [(6, 0, lookups.get_many('tax', row.get('purchase_taxes', ''), 'tax'))],
+            'company_id': company_id,
+        }
+
+    def _import_rule_vals(self, cr, uid, row, lookups, company_id, context=None):
+        vals = {
+            'name': import_required(row, 'name'),
+            'description': row.get('description') or False,
+            'fiscal_domain_id': lookups.get('fiscal_domain', import_required(row, 'fiscal_domain'), 'fiscal domain'),
+            'vat_rule': row.get('vat_rule') or 'both',
+            'date_start': import_date(row.get('date_start'), 'date_start'),
+            'date_end': import_date(row.get('date_end'), 'date_end'),
+            'fiscal_attribute_id': [(6, 0, lookups.get_many('attribute', row.get('fiscal_attributes', ''),
+                                                            'fiscal attribute'))],
+            'fiscal_allocation_id': [(6, 0, lookups.get_many('allocation', row.get('fiscal_allocations', ''),
+                                                             'fiscal allocation'))],
+            'account_invoice_id': lookups.get('account', row.get('account_invoice'), 'account'),
+            'account_purchase_id': lookups.get('account', row.get('account_purchase'), 'account'),
+            'company_id': company_id,
+        }
+        if vals['vat_rule'] not in ('with', 'both', 'without'):
+            raise ImportRowError("Invalid vat_rule '%s'" % vals['vat_rule'])
+        try:
+            vals['sequence'] = int(row.get('sequence') or 10)
+        except ValueError:
+            raise ImportRowError("Invalid sequence '%s'" % row['sequence'])
+        for use in RULE_USE_FLAGS:
+            vals[use] = import_bool(row.get(use), use)
+        for country_column, state_column in IMPORT_GEO_COLUMNS:
+            country_id = vals[country_column] = lookups.get('country', row.get(country_column), 'country')
+            if row.get(state_column) and not country_id:
+                raise ImportRowError("%s requires %s" % (state_column, country_column))
+            vals[state_column] = lookups.get('state', row.get(state_column) and (country_id, row[state_column]),
+                                             'state')
+        return vals
+
+    # ##### Import
+
+    # model: (row conversion method, lookup of the names already used, when names must be unique)
+    _import_models = {
+        'account.fiscal.attribute': ('_import_attribute_vals', 'attribute'),
+        'account.fiscal.allocation': ('_import_allocation_vals', 'allocation'),
+        'account.fiscal.allocation.rule': ('_import_rule_vals', None),
+    }
+
+    def _import_insert(self, cr, uid, model, chunk, rejected, context=None):
+        # Insert the chunk of (row number, vals), in a savepoint. Should the database or the constraints of the model
+        # refuse the chunk, its rows are inserted one by one to reject only the faulty ones. Return the number of
+        # inserted rows.
+        obj = self.pool.get(model)
+        cr.execute("SAVEPOINT fiscal_allocation_import")
+        try:
+            obj._create_batch(cr, uid, [vals for number, vals in chunk], context=context)
+            cr.execute("RELEASE SAVEPOINT fiscal_allocation_import")
+            return len(chunk)
+        except psycopg2.Error:
+            cr.execute("ROLLBACK TO SAVEPOINT fiscal_allocation_import")
+            reason = "Refused by the database"
+        except orm.except_orm as e:
+            cr.execute("ROLLBACK TO SAVEPOINT fiscal_allocation_import")
+            reason = e.value
+        if len(chunk) == 1:
+            number, vals = chunk[0]
+            _logger.info("Fiscal allocation import: row %s of %s refused", number, model, exc_info=True)
+            rejected.append((number, reason))
+            return 0
+        return sum(self._import_insert(cr, uid, model, [entry], rejected, context=context) for entry in chunk)
+
+    def import_file(self, cr, uid, fileobj, model, file_format, company_id, chunk_size=1000, context=None):
+        # Import the rows of 'fileobj' as records of 'model' for the company. Memory use only depends on the chunk
+        # size and the lookup maps, not on the size of the file.
+        # Return {'imported': count, 'rejected': [(row number, reason)] (the first IMPORT_REPORT_LIMIT),
+        # 'rejected_count': count}.
+        user = self.pool.get('res.users').browse(cr, uid, uid, context=context)
+        if company_id not in [company.id for company in user.company_ids]:
+            raise orm.except_orm('Error', "You are not allowed to import records for this company.")
+        method, unique = self._import_models[model]
+        lookups = ImportLookups(cr, company_id)
+        result = {'imported': 0, 'rejected': [], 'rejected_count': 0}
+        rejected = []
+        chunk = []
+        # Unique names of the rows of the chunk: they join the names already used once inserted.
+        chunk_names = set()
+
+        def reject(number, reason):
+            result['rejected_count'] += 1
+            if len(result['rejected']) < IMPORT_REPORT_LIMIT:
+                result['rejected'].append((number, reason))
+
+        def flush():
+            result['imported'] += self._import_insert(cr, uid, model, chunk, rejected, context=context)
+            refused = set(number for number, reason in rejected)
+            for number, reason in rejected:
+                reject(number, reason)
+            if unique:
+                names = lookups.map(unique)
+                for number, vals in chunk:
+                    if number not in refused:
+                        names[vals['name']] = None
+            del chunk[:]
+            del rejected[:]
+            chunk_names.clear()
+
+        try:
+            for number, row in IMPORT_READERS[file_format](fileobj):
+                try:
+                    if isinstance(row, ImportRowError):
+                        raise row
+                    vals = getattr(self, method)(cr, uid, row, lookups, company_id, context=context)
+                    if unique:
+                        if vals['name'] in lookups.map(unique) or vals['name'] in chunk_names:
+                            raise ImportRowError("'%s' already exists" % vals['name'])
+                        chunk_names.add(vals['name'])
+                except ImportRowError as e:
+                    reject(number, e.args[0])
+                    continue
+                chunk.append((number, vals))
+                if len(chunk) >= chunk_size:
+                    flush()
+        except ImportFileError as e:
+            raise orm.except_orm('Error', e.args[0])
+        if chunk:
+            flush()
+        return result
+
+    def action_import(self, cr, uid, ids, context=None):
+        wizard = self.read(cr, uid, ids[0], ['company_id', 'model', 'file_format', 'chunk_size'], context=context,
+                           load='_classic_write')
+        # Decode the upload piecewise into a temporary file the rows are streamed from.
+        with tempfile.TemporaryFile() as fileobj:
+            b64decode_file(self.read(cr, uid, ids[0], ['data'], context=context)['data'] or '', fileobj)
+            fileobj.seek(0)
+            result = self.import_file(cr, uid, fileobj, wizard['model'], wizard['file_format'], wizard['company_id'],
+                                      chunk_size=max(wizard['chunk_size'], 1), context=context)
+
+        lines = ["%s rows imported, %s rejected." % (result['imported'], result['rejected_count'])]
+        lines += ["Row %s: %s" % rejected for rejected in result['rejected']]
+        if result['rejected_count'] > len(result['rejected']):
+            lines.append("...")
+        self.write(cr, uid, ids, {'result': '\n'.join(lines), 'data': False}, context=context)
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': ids[0],
+            'view_type': 'form',
+            'view_mode': 'form',
+            'target': 'new',
+            'context': context,
+        }
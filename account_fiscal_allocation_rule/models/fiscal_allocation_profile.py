@@ -0,0 +1,123 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Opt-in instrumentation of the fiscal mapping entry points. Enabled from the server configuration file:
+#
+#   fiscal_allocation_profile = True        record per-call timings, query counts and cache hits/misses
+#   fiscal_allocation_profile_log = True    also log every record as a structured (JSON) line
+#   fiscal_allocation_profile_size = 10000  size of the ring buffer of records (per worker)
+#
+# Records are read back with account.fiscal.allocation.rule get_fiscal_allocation_profile().
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from functools import wraps
+from openerp.tools import config
+
+_logger = logging.getLogger(__name__)
+
+PROFILE_MODEL = 'account.fiscal.allocation.rule'
+
+# Keyword arguments of the profiled methods worth keeping to find slow partners and products.
+PROFILE_KWARGS = ('company_id', 'partner_id', 'partner_invoice_id', 'partner_shipping_id', 'product_id')
+
+
+def _config_flag(key):
+    return str(config.get(key, False)).lower() in ('1', 'true', 'yes')
+
+
+class FiscalAllocationProfile(object):
+    # Ring buffer of call records and cache counters of one worker.
+
+    def __init__(self):
+        self.enabled = _config_flag('fiscal_allocation_profile')
+        self.log = _config_flag('fiscal_allocation_profile_log')
+        self.records = deque(maxlen=int(config.get('fiscal_allocation_profile_size', 10000)))
+        self.caches = {}
+        self.local = threading.local()
+
+    def reset(self):
+        self.records.clear()
+        self.caches.clear()
+
+    def count(self, cache, hit):
+        # Cache lookup counter: {cache: [hits, misses]}
+        if self.enabled:
+            counter = self.caches.setdefault(cache, [0, 0])
+            counter[0 if hit else 1] += 1
+
+    def record(self, record):
+        self.records.append(record)
+        if self.log:
+            _logger.info("fiscal_allocation_profile %s", json.dumps(record, sort_keys=True))
+
+    def stats(self, limit=None):
+        records = list(self.records)
+        if limit:
+            records = records[-limit:]
+        caches = {}
+        for cache, (hits, misses) in self.caches.items():
+            caches[cache] = {
+                'hits': hits,
+                'misses': misses,
+                'ratio': hits + misses and float(hits) / (hits + misses) or None,
+            }
+        return {'enabled': self.enabled, 'records': records, 'caches': caches}
+
+
+def profiled(method):
+    # Decorator for methods (self, cr, uid, ...) of the fiscal mapping: when profiling is enabled, record duration,
+    # number of queries issued on the cursor, call depth, result size and the interesting keyword arguments.
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, cr, uid, *args, **kwargs):
+        profile = self.pool.get(PROFILE_MODEL)._profile
+        if not profile.enabled:
+            return method(self, cr, uid, *args, **kwargs)
+
+        depth = getattr(profile.local, 'depth', 0)
+        profile.local.depth = depth + 1
+        queries = cr.sql_log_count
+        start = time.time()
+        try:
+            result = method(self, cr, uid, *args, **kwargs)
+        finally:
+            profile.local.depth = depth
+        record = {
+            'model': self._name,
+            'method': name,
+            'depth': depth,
+            'timestamp': start,
+            'duration_ms': 1000.0 * (time.time() - start),
+            'queries': cr.sql_log_count - queries,
+        }
+        for key in PROFILE_KWARGS:
+            if kwargs.get(key):
+                record[key] = kwargs[key]
+        if isinstance(result, (list, tuple)):
+            record['result_count'] = len(result)
+        profile.record(record)
+        return result
+
+    return wrapper
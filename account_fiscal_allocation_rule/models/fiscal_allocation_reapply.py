@@ -0,0 +1,258 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import logging
+import threading
+from collections import deque
+from openerp import pooler
+from openerp.osv import fields, orm
+
+_logger = logging.getLogger(__name__)
+
+# Draft documents the Fiscal Allocation Rules can be re-applied to:
+# model: (wizard flag, draft states, method processing a chunk of document ids)
+REAPPLY_DOCUMENTS = {
+    'account.invoice': ('apply_invoice', ('draft',), '_reapply_invoices'),
+    'sale.order': ('apply_sale', ('draft', 'sent'), '_reapply_sale_orders'),
+    'purchase.order': ('apply_purchase', ('draft', 'sent'), '_reapply_purchase_orders'),
+}
+
+
+class ReapplyProgress(object):
+    # Progress of a re-application shared by the workers.
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def update(self, count, failed=False):
+        with self.lock:
+            if failed:
+                self.failed += count
+            else:
+                self.done += count
+            _logger.info("Fiscal allocation re-application: %s/%s documents processed (%s failed)",
+                         self.done + self.failed, self.total, self.failed)
+
+
+class WizardAccountFiscalAllocationReapply(orm.TransientModel):
+    _name = 'wizard.account.fiscal.allocation.reapply'
+    _description = 'Re-apply Fiscal Allocation Rules to draft documents'
+    _columns = {
+        'company_id': fields.many2one('res.company', 'Company', required=True),
+        'date_from': fields.date('From Date', help="Only documents dated from this date on."),
+        'apply_invoice': fields.boolean('Draft Invoices'),
+        'apply_sale': fields.boolean('Draft Sale Orders'),
+        'apply_purchase': fields.boolean('Draft Purchase Orders'),
+        'chunk_size': fields.integer('Chunk Size', required=True,
+                                     help="Number of documents recomputed and written together."),
+        'workers': fields.integer('Workers', required=True,
+                                  help="Number of workers, each with its own cursor, committing chunk by chunk. "
+                                       "With a single worker, everything runs in the current transaction."),
+        'result': fields.text('Result', readonly=True),
+    }
+    _defaults = {
+        'company_id': lambda self, cr, uid, c:
+        self.pool.get('res.users').browse(cr, uid, [uid], c)[0].company_id.id,
+        'apply_invoice': True,
+        'apply_sale': True,
+        'apply_purchase': True,
+        'chunk_size': 200,
+        'workers': 1,
+    }
+
+    # ##### Document selection
+
+    def _reapply_select(self, cr, uid, wizard, context=None):
+        # Return [(model, document ids)] of the draft documents to recompute.
+        result = []
+        for model, (flag, states, method) in sorted(REAPPLY_DOCUMENTS.items()):
+            obj = self.pool.get(model)
+            if not wizard[flag] or obj is None:
+                continue
+            domain = [('state', 'in', list(states)), ('company_id', '=', wizard.company_id.id)]
+            if wizard.date_from:
+                domain.append((model == 'account.invoice' and 'date_invoice' or 'date_order', '>=', wizard.date_from))
+            ids = obj.search(cr, uid, domain, context=context)
+            if ids:
+                result.append((model, ids))
+        return result
+
+    # ##### Recomputation of a chunk
+
+    def _reapply_base_taxes(self, cr, uid, product, company_id, fiscal_position, direction, context=None):
+        # Default taxes of the product, as the core product onchanges compute them.
+        return self.pool.get('account.fiscal.allocation.rule')._product_default_taxes(
+            cr, uid, product, company_id, fiscal_position, direction, context=context)
+
+    def _reapply_lines(self, cr, uid, line_model, tax_field, entries, context=None):
+        # 'entries' are (line_id, current tax ids, base tax ids, fiscal_allocation_map_batch line) tuples. All
+        # lines are mapped in one batch, then written grouped by resulting tax set, skipping unchanged lines.
+        # Return the ids of the written lines.
+        results = self.pool.get('account.fiscal.allocation.rule').fiscal_allocation_map_batch(
+            cr, uid, [entry[3] for entry in entries], context=context)
+        groups = {}
+        for (line_id, current, base, line), mapped in zip(entries, results):
+            taxes = tuple(sorted(set(base) | set(mapped['invoice_line_tax_id'])))
+            if taxes != tuple(sorted(current)):
+                groups.setdefault(taxes, []).append(line_id)
+
+        written = []
+        for taxes, line_ids in groups.items():
+            self.pool.get(line_model).write(cr, uid, line_ids, {tax_field: [(6, 0, list(taxes))]}, context=context)
+            written += line_ids
+        return written
+
+    def _reapply_invoices(self, cr, uid, ids, context=None):
+        obj_invoice = self.pool.get('account.invoice')
+        obj_line = self.pool.get('account.invoice.line')
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+
+        invoices = obj_invoice.browse(cr, uid, ids, context=context)
+        line_invoice = {}
+        entries = []
+        headers = []
+        base_taxes = {}
+        for invoice in invoices:
+            partner_id = invoice.partner_id.id
+            company_id = invoice.company_id.id
+            direction = invoice.type in ('out_invoice', 'out_refund') and 'sale' or 'purchase'
+            headers.append((partner_id, partner_id, False, company_id, False, invoice.date_invoice,
+                            'use_invoice', invoice.type))
+            for line in invoice.invoice_line:
+                if not line.product_id:
+                    continue
+                key = (line.product_id.id, company_id, invoice.fiscal_position.id, direction)
+                if key not in base_taxes:
+                    base_taxes[key] = self._reapply_base_taxes(
+                        cr, uid, line.product_id, company_id, invoice.fiscal_position, direction, context=context)
+                line_invoice[line.id] = invoice.id
+                entries.append((
+                    line.id, [t.id for t in line.invoice_line_tax_id], base_taxes[key],
+                    (partner_id, partner_id, False, company_id, line.product_id.id, invoice.date_invoice,
+                     'use_invoice', invoice.type)))
+
+        written = self._reapply_lines(cr, uid, 'account.invoice.line', 'invoice_line_tax_id', entries,
+                                      context=context)
+
+        # Account replacement takes place at the invoice level (see account.invoice onchange_partner_id).
+        accounts = {}
+        for invoice, mapped in zip(invoices, obj_rule.fiscal_allocation_map_batch(cr, uid, headers, context=context)):
+            if mapped['account_id'] and mapped['account_id'] != invoice.account_id.id:
+                accounts.setdefault(mapped['account_id'], []).append(invoice.id)
+        for account_id, invoice_ids in accounts.items():
+            obj_invoice.write(cr, uid, invoice_ids, {'account_id': account_id}, context=context)
+
+        changed = set(line_invoice[line_id] for line_id in written)
+        if changed:
+            obj_invoice.button_reset_taxes(cr, uid, list(changed), context=context)
+        return len(written)
+
+    def _reapply_orders(self, cr, uid, ids, model, line_model, tax_field, use, context=None):
+        entries = []
+        base_taxes = {}
+        direction = use == 'use_purchase' and 'purchase' or 'sale'
+        inv_type = direction == 'sale' and 'out_invoice' or 'in_invoice'
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+        for order in self.pool.get(model).browse(cr, uid, ids, context=context):
+            partner_id, partner_invoice_id, partner_shipping_id = obj_rule._order_mapping_partners(
+                cr, uid, order, use, context=context)
+            company_id = order.company_id.id
+            for line in order.order_line:
+                if not line.product_id:
+                    continue
+                key = (line.product_id.id, company_id, order.fiscal_position.id)
+                if key not in base_taxes:
+                    base_taxes[key] = self._reapply_base_taxes(
+                        cr, uid, line.product_id, company_id, order.fiscal_position, direction, context=context)
+                entries.append((
+                    line.id, [t.id for t in line[tax_field]], base_taxes[key],
+                    (partner_id, partner_invoice_id, partner_shipping_id, company_id, line.product_id.id,
+                     order.date_order, use, inv_type)))
+        return len(self._reapply_lines(cr, uid, line_model, tax_field, entries, context=context))
+
+    def _reapply_sale_orders(self, cr, uid, ids, context=None):
+        return self._reapply_orders(cr, uid, ids, 'sale.order', 'sale.order.line', 'tax_id', 'use_sale',
+                                    context=context)
+
+    def _reapply_purchase_orders(self, cr, uid, ids, context=None):
+        return self._reapply_orders(cr, uid, ids, 'purchase.order', 'purchase.order.line', 'taxes_id',
+                                    'use_purchase', context=context)
+
+    # ##### Execution
+
+    def _reapply_worker(self, dbname, uid, jobs, progress, context=None):
+        # Each worker has its own cursor and commits chunk by chunk; a failing chunk is rolled back and reported
+        # without stopping the others.
+        cr = pooler.get_db(dbname).cursor()
+        try:
+            while True:
+                try:
+                    method, ids = jobs.popleft()
+                except IndexError:
+                    break
+                try:
+                    getattr(self, method)(cr, uid, ids, context=context)
+                    cr.commit()
+                    progress.update(len(ids))
+                except Exception:
+                    cr.rollback()
+                    _logger.exception("Fiscal allocation re-application failed on %s %s", method, ids)
+                    progress.update(len(ids), failed=True)
+        finally:
+            cr.close()
+
+    def action_reapply(self, cr, uid, ids, context=None):
+        wizard = self.browse(cr, uid, ids[0], context=context)
+        chunk_size = max(wizard.chunk_size, 1)
+
+        jobs = deque()
+        for model, doc_ids in self._reapply_select(cr, uid, wizard, context=context):
+            method = REAPPLY_DOCUMENTS[model][2]
+            for i in range(0, len(doc_ids), chunk_size):
+                jobs.append((method, doc_ids[i:i + chunk_size]))
+        progress = ReapplyProgress(sum(len(job[1]) for job in jobs))
+
+        if wizard.workers <= 1:
+            for method, doc_ids in jobs:
+                getattr(self, method)(cr, uid, doc_ids, context=context)
+                progress.update(len(doc_ids))
+        else:
+            workers = [threading.Thread(target=self._reapply_worker, args=(cr.dbname, uid, jobs, progress, context))
+                       for i in range(min(wizard.workers, len(jobs)))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        self.write(cr, uid, ids, {
+            'result': "%s documents processed, %s failed." % (progress.done, progress.failed),
+        }, context=context)
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': ids[0],
+            'view_type': 'form',
+            'view_mode': 'form',
+            'target': 'new',
+            'context': context,
+        }
@@ -26,15 +26,49 @@
 #
 ###############################################################################
 
+import logging
+import mmap
+import os
+import struct
 import time
+from openerp import SUPERUSER_ID
 from openerp.osv import fields, orm
+from openerp.tools import config
+from openerp.tools.lru import LRU
 from itertools import chain
+from .fiscal_allocation_batch import batch_insert
+from .fiscal_allocation_generation import CACHE_BUILD_CONTEXT, CacheGenerations
+from .fiscal_allocation_profile import FiscalAllocationProfile, profiled
+from .fiscal_allocation_rule_flat import FLAT_CREATE, FLAT_INSERT, FLAT_TABLE, flat_match_query
+from .fiscal_allocation_rule_index import RULE_GEO_FIELDS, RULE_INDEX_FIELDS, FiscalAllocationRuleIndex
+from .fiscal_allocation_snapshot import dump_rule_snapshot, load_rule_snapshot, load_rule_snapshot_header
+
+_logger = logging.getLogger(__name__)
 
 ATTR_USE_DOM_COMPANY = 'company'
 ATTR_USE_DOM_PINVOICE = 'partner_invoice'
 ATTR_USE_DOM_PSHIPPER = 'partner_shipper'
 ATTR_USE_DOM_PRODUCT = 'product'
 
+# Destination criteria (to_<geo>_country / to_<geo>_state) of the addresses passed as 'addrs' to _map_criteria.
+ATTR_USE_DOM_GEO = {
+    ATTR_USE_DOM_PINVOICE: 'invoice',
+    ATTR_USE_DOM_PSHIPPER: 'shipping',
+}
+
+# Cache generations shared by the workers through the database, see _cache_signal / _cache_check. Scopes are
+# 'rules' (all companies), 'rules,<company_id>', 'taxes' (tax sets of the allocations) and 'attributes'.
+CACHE_GENERATION_TABLE = 'account_fiscal_allocation_rule_generation'
+CACHE_GENERATION_SEQUENCE = 'account_fiscal_allocation_rule_generation_seq'
+CACHE_SCOPE_RULES = 'rules'
+CACHE_SCOPE_TAXES = 'taxes'
+CACHE_SCOPE_ATTRIBUTES = 'attributes'
+
+# Invoice type assumed for tax direction when the caller does not pass one (eg. sale and purchase orders).
+USE_INV_TYPE = {
+    'use_purchase': 'in_invoice',
+}
+
 ACC_FISC_ALLOC_RULE_COLS_TMPL = {
 
     # Note: This are template style fields.
@@ -58,23 +92,26 @@ ACC_FISC_ALLOC_RULE_COLS_TMPL = {
     'from_state': fields.many2one(
         'res.country.state', 'State From',
         domain="[('country_id','=',from_country)]"),
-    'to_%s_country': fields.many2one(
-        'res.country', 'Invoice Country') % ATTR_USE_DOM_PINVOICE,
-    'to_&s_state': fields.many2one(
+    'to_invoice_country': fields.many2one(
+        'res.country', 'Invoice Country'),
+    'to_invoice_state': fields.many2one(
         'res.country.state', 'Invoice State',
-        domain="[('country_id','=',to_invoice_country)]") % ATTR_USE_DOM_PINVOICE,
-    'to_&s_country': fields.many2one(
-        'res.country', 'Destination Country') % ATTR_USE_DOM_PSHIPPER,
-    'to_%s_state': fields.many2one(
+        domain="[('country_id','=',to_invoice_country)]"),
+    'to_shipping_country': fields.many2one(
+        'res.country', 'Destination Country'),
+    'to_shipping_state': fields.many2one(
         'res.country.state', 'Destination State',
-        domain="[('country_id','=',to_shipping_country)]") % ATTR_USE_DOM_PSHIPPER,
+        domain="[('country_id','=',to_shipping_country)]"),
     # These are the Fiscal Attributes which are checked at runtime on the invoice-line level. As a many2many you can
     # select a custom number out of the Fiscal Attributes Table. Typicaly you might want to constrain the choice to
     # an above set Fiscal Domain (optional). Typically when parametrizing you might filter by Attribute Use (eg.
     # 'partner' or 'product' cases for convenience. (planned partner specific roles: 'seller' 'invoiced partner'
     # 'shipped partner'
     'fiscal_attribute_id': fields.many2many(
-        'account.fiscal.attribute', 'Fiscal Attributes',
+        'account.fiscal.attribute',
+        'account_fiscal_allocation_rule_attribute_rel',
+        'rule_id', 'attribute_id',
+        'Fiscal Attributes',
         # TODO this probably might result in problems as templates do not have field company_id
         domain="[('company_id','=',company_id),('fiscal_domain_id','=',fiscal_domain_id)]"),
     'use_sale': fields.boolean('Use in sales order'),
@@ -108,8 +145,8 @@ ACC_FISC_ALLOC_RULE_COLS_TMPL = {
         'Fiscal Allocation Sets',
         # TODO this probably might result in problems as templates do not have field company_id
         domain="[('company_id','=',company_id),('fiscal_domain_id','=',fiscal_domain_id)]", select=True),
-    'account_invoice_id': fields.many2ome('account.account', 'Account Replacement on Sales'),
-    'account_purchase_id': fields.many2ome('account.account', 'Account Replacement on Purchases')
+    'account_invoice_id': fields.many2one('account.account', 'Account Replacement on Sales'),
+    'account_purchase_id': fields.many2one('account.account', 'Account Replacement on Purchases')
 }
 
 ACC_FISC_ALLOC_RULE_DEFS_TMPL = {
@@ -134,27 +171,267 @@ class AccountFiscalAllocationRule(orm.Model):
             'res.company')._company_default_get(cr, uid, 'account.fiscal.allocation.rule', context=c),
     }
 
-    _columns = dict(chain(ACC_FISC_ALLOC_RULE_COLS_TMPL.items(), nontmpl_update_cols.items))
-    _defaults = dict(chain(ACC_FISC_ALLOC_RULE_DEFS_TMPL.items(), nontmpl_update_defs.items))
+    _columns = dict(chain(ACC_FISC_ALLOC_RULE_COLS_TMPL.items(), nontmpl_update_cols.items()))
+    _defaults = dict(chain(ACC_FISC_ALLOC_RULE_DEFS_TMPL.items(), nontmpl_update_defs.items()))
+
+    def __init__(self, pool, cr):
+        super(AccountFiscalAllocationRule, self).__init__(pool, cr)
+        # Compiled rules per company: {company_id: FiscalAllocationRuleIndex}. Loaded on first use, dropped by
+        # _rule_index_invalidate whenever rules, allocations or attributes are created, written or unlinked.
+        self._rule_index = {}
+        # Fiscal Attributes resolved through the company dependent 'property_fiscal_attribute' of partners and
+        # products: {(model, res_id, company_id): (attribute_id, ...)}. See _collect_attributes.
+        self._attribute_cache = LRU(8192)
+        # Rule set generations, part of the keys of the result cache: bumped per company by _rule_index_invalidate,
+        # and for all companies at once by _rule_generation_bump without company_ids.
+        self._rule_generation = {}
+        self._rule_generation_all = 0
+        # Allocated taxes and account replacement per normalized criteria:
+        # {(company_id, generations, inv_type, signature): {'invoice_line_tax_id', 'account_id'}}
+        # See _map_criteria_result.
+        self._result_cache = LRU(16384)
+        self._result_cache_stats = {'hits': 0, 'misses': 0}
+        # Opt-in instrumentation of the fiscal mapping, see fiscal_allocation_profile.
+        self._profile = FiscalAllocationProfile()
+        # Match in SQL on the flattened rule table instead of the compiled rule index, see fiscal_allocation_rule_flat.
+        self._flat_backend = config.get('fiscal_allocation_backend') == 'sql'
+        # Shared cache generations last seen by this worker, see fiscal_allocation_generation. The first use of the
+        # caches loads them.
+        self._cache_generations = CacheGenerations(CACHE_GENERATION_TABLE, CACHE_GENERATION_SEQUENCE)
+
+    def init(self, cr):
+        cr.execute("SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'r'", (FLAT_TABLE,))
+        if not cr.fetchone():
+            cr.execute(FLAT_CREATE)
+        self._flat_refresh(cr, SUPERUSER_ID)
+        cr.execute("SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'r'", (CACHE_GENERATION_TABLE,))
+        if not cr.fetchone():
+            cr.execute("CREATE TABLE " + CACHE_GENERATION_TABLE + " ("
+                       "scope varchar PRIMARY KEY, generation integer NOT NULL)")
+        cr.execute("SELECT 1 FROM pg_class WHERE relname = %s AND relkind = 'S'", (CACHE_GENERATION_SEQUENCE,))
+        if not cr.fetchone():
+            # Start above the generations counted by the former increments.
+            cr.execute("SELECT COALESCE(max(generation), 0) + 1 FROM " + CACHE_GENERATION_TABLE)
+            cr.execute("CREATE SEQUENCE " + CACHE_GENERATION_SEQUENCE + " START %s" % cr.fetchone()[0])
+
+    # ##### Cross-worker cache invalidation
+
+    # Every worker holds its own compiled rules, attribute, tax and result caches. Changes bump the generation of
+    # their scope in the database, in the transaction of the change, and flag the registry caches as cleared: at the
+    # end of the request, the registry signaling makes every other worker call clear_caches() on all models. The
+    # next use of the caches in those workers reads the generations (one query) and drops what changed only. The
+    # worker making the change reads them on every use as long as the cursor of the change exists, and once more
+    # afterwards: caches built from a transaction which then rolls back (or from before a concurrent commit) are
+    # dropped as well.
+
+    def _cache_signal(self, cr, uid, scopes, context=None):
+        self._cache_generations.signal(cr, scopes)
+        self.pool._any_cache_cleared = True
+
+    def _cache_check(self, cr, uid, context=None):
+        for scope in self._cache_generations.check(cr):
+            if scope == CACHE_SCOPE_RULES:
+                self._rule_index_drop(cr, uid, context=context)
+            elif scope.startswith(CACHE_SCOPE_RULES + ','):
+                self._rule_index_drop(cr, uid, [int(scope.split(',')[1])], context=context)
+            elif scope == CACHE_SCOPE_TAXES:
+                self.pool.get('account.fiscal.allocation')._tax_cache_drop(cr, uid, context=context)
+            elif scope == CACHE_SCOPE_ATTRIBUTES:
+                self._attribute_cache.clear()
+
+    def clear_caches(self):
+        # Called by the registry when another worker signaled a change.
+        self._cache_generations.pending = True
+        return super(AccountFiscalAllocationRule, self).clear_caches()
+
+    # ##### Compiled rule index
+
+    def _rule_index_read(self, cr, company_id):
+        # The active rules of the company as the rule index and the snapshots need them, see CACHE_BUILD_CONTEXT.
+        ctx = dict(CACHE_BUILD_CONTEXT)
+        rule_ids = self.search(cr, SUPERUSER_ID, [('company_id', '=', company_id)], context=ctx)
+        return self.read(cr, SUPERUSER_ID, rule_ids, RULE_INDEX_FIELDS, context=ctx, load='_classic_write')
+
+    def _rule_index_build(self, cr, uid, company_id, context=None):
+        return FiscalAllocationRuleIndex(company_id, self._rule_index_read(cr, company_id))
 
-    def _map_domain(self, cr, uid, partner, addrs, company, product=None,
-                    context=None, **kwargs):
+    def _rule_index_get(self, cr, uid, company_id, context=None):
+        # Built as superuser, so the access right of the caller is checked here, cache hit or not.
+        self.check_access_rights(cr, uid, 'read')
+        self._cache_check(cr, uid, context=context)
+        index = self._rule_index.get(company_id)
+        self._profile.count('rule_index', index is not None)
+        if index is None:
+            index = self._rule_index[company_id] = self._rule_index_build(cr, uid, company_id, context=context)
+        return index
+
+    def _rule_index_invalidate(self, cr, uid, company_ids=None, context=None):
+        # Without company_ids, the compiled rules of all companies are dropped, in all workers.
+        self._rule_index_drop(cr, uid, company_ids, context=context)
+        if company_ids is None:
+            self._cache_signal(cr, uid, [CACHE_SCOPE_RULES], context=context)
+        else:
+            self._cache_signal(cr, uid, ['%s,%s' % (CACHE_SCOPE_RULES, c) for c in company_ids], context=context)
+
+    def _rule_index_drop(self, cr, uid, company_ids=None, context=None):
+        # Local part of _rule_index_invalidate. The allocations of the rules may have changed too, the memoized
+        # tax unions (keyed on rule ids) go along.
+        self._rule_generation_bump(cr, uid, company_ids, context=context)
+        self.pool.get('account.fiscal.allocation')._tax_cache_drop(cr, uid, [], context=context)
+        if company_ids is None:
+            self._rule_index.clear()
+            return
+        for company_id in company_ids:
+            self._rule_index.pop(company_id, None)
+
+    def _rule_generation_bump(self, cr, uid, company_ids=None, context=None):
+        # Results cached before are never served again (see _map_criteria_result). Without company_ids, for all
+        # companies.
+        if company_ids is None:
+            self._rule_generation_all += 1
+            return
+        for company_id in company_ids:
+            self._rule_generation[company_id] = self._rule_generation.get(company_id, 0) + 1
+
+    # ##### Fiscal Attribute cache
+
+    def _collect_attributes(self, cr, uid, model, res_id, company_id, context=None):
+        # Fiscal Attribute ids of a partner or product template for the given company. Resolving the property means
+        # reading ir.property, so it is done once and then served from the cache until the property or one of the
+        # attributes changes. The same partner as invoice and shipping address shares one entry.
+        self._cache_check(cr, uid, context=context)
+        key = (model, res_id, company_id)
+        if key in self._attribute_cache:
+            self._profile.count('attributes', True)
+            return self._attribute_cache[key]
+        self._profile.count('attributes', False)
+        ctx = dict(CACHE_BUILD_CONTEXT, force_company=company_id)
+        record = self.pool.get(model).browse(cr, SUPERUSER_ID, res_id, context=ctx)
+        attribute_ids = tuple(sorted(a.id for a in record.property_fiscal_attribute))
+        self._attribute_cache[key] = attribute_ids
+        return attribute_ids
+
+    def _attribute_cache_invalidate(self, cr, uid, model=None, res_ids=None, context=None):
+        # Without model, the whole cache is dropped. Without res_ids, all the records of model are. The other
+        # workers drop their whole cache.
+        self._cache_signal(cr, uid, [CACHE_SCOPE_ATTRIBUTES], context=context)
+        if model is None:
+            self._attribute_cache.clear()
+            return
+        for key in self._attribute_cache.keys():
+            if key[0] == model and (res_ids is None or key[1] in res_ids):
+                del self._attribute_cache[key]
+
+    # ##### Flattened rule table
+
+    def _flat_refresh(self, cr, uid, ids=None, context=None):
+        # Rebuild the rows of the flattened rule table of the rules 'ids' (of all rules if None).
+        if ids is None:
+            cr.execute("DELETE FROM " + FLAT_TABLE)
+            cr.execute(FLAT_INSERT)
+            return
+        ids = list(ids)
+        if ids:
+            cr.execute("DELETE FROM " + FLAT_TABLE + " WHERE rule_id IN %s", (tuple(ids),))
+            cr.execute(FLAT_INSERT + " AND r.id IN %s", (tuple(ids),))
+
+    def _flat_rule_ids(self, cr, uid, allocation_ids=None, attribute_ids=None, tax_ids=None, context=None):
+        # Ids of the rules whose flattened rows depend on the given allocations, attributes or taxes. To be called
+        # before unlinking them: the relation rows disappear with them.
+        rule_ids = set()
+        if allocation_ids:
+            cr.execute("SELECT rule_id FROM account_fiscal_allocation_rel WHERE allocation_id IN %s",
+                       (tuple(allocation_ids),))
+            rule_ids.update(r[0] for r in cr.fetchall())
+        if attribute_ids:
+            cr.execute("SELECT rule_id FROM account_fiscal_allocation_rule_attribute_rel WHERE attribute_id IN %s",
+                       (tuple(attribute_ids),))
+            rule_ids.update(r[0] for r in cr.fetchall())
+        if tax_ids:
+            cr.execute("SELECT DISTINCT rule_id FROM " + FLAT_TABLE + " WHERE tax_id IN %s", (tuple(tax_ids),))
+            rule_ids.update(r[0] for r in cr.fetchall())
+            # Reactivated taxes have no rows yet.
+            cr.execute("SELECT rel.rule_id FROM account_fiscal_allocation_rel rel "
+                       "WHERE rel.allocation_id IN (SELECT fiscal_allocation_id FROM fiscal_allocation_sale_tax_rel "
+                       "WHERE tax_id IN %s UNION SELECT fiscal_allocation_id FROM fiscal_allocation_purchase_tax_rel "
+                       "WHERE tax_id IN %s)", (tuple(tax_ids), tuple(tax_ids)))
+            rule_ids.update(r[0] for r in cr.fetchall())
+        return rule_ids
+
+    def _rule_allocation_ids(self, cr, uid, ids, context=None):
+        # Ids of the (active) Fiscal Allocations linked to the given rules.
+        allocation_ids = set()
+        for rule in self.read(cr, uid, list(ids), ['fiscal_allocation_id'], context=context):
+            allocation_ids.update(rule['fiscal_allocation_id'])
+        return allocation_ids
+
+    def _rule_company_ids(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        company_ids = set()
+        for rule in self.read(cr, uid, ids, ['company_id'], context=context, load='_classic_write'):
+            company_ids.add(rule['company_id'])
+        return company_ids
+
+    def create(self, cr, uid, vals, context=None):
+        rule_id = super(AccountFiscalAllocationRule, self).create(cr, uid, vals, context=context)
+        self._flat_refresh(cr, uid, [rule_id], context=context)
+        self._rule_index_invalidate(cr, uid, self._rule_company_ids(cr, uid, rule_id, context=context),
+                                    context=context)
+        return rule_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        # Rules may move between companies: invalidate both, the former and the new one.
+        company_ids = self._rule_company_ids(cr, uid, ids, context=context)
+        if vals.get('company_id'):
+            company_ids.add(vals['company_id'])
+        result = super(AccountFiscalAllocationRule, self).write(cr, uid, ids, vals, context=context)
+        self._flat_refresh(cr, uid, isinstance(ids, (int, long)) and [ids] or ids, context=context)
+        self._rule_index_invalidate(cr, uid, company_ids, context=context)
+        return result
+
+    def unlink(self, cr, uid, ids, context=None):
+        company_ids = self._rule_company_ids(cr, uid, ids, context=context)
+        result = super(AccountFiscalAllocationRule, self).unlink(cr, uid, ids, context=context)
+        self._rule_index_invalidate(cr, uid, company_ids, context=context)
+        return result
+
+    def _create_batch(self, cr, uid, vals_list, context=None):
+        # Mass creation of rules (chart templates, imports): multi-row INSERTs, see fiscal_allocation_batch, then a
+        # single refresh of the flattened rows and cache invalidation instead of one per rule.
+        ids = batch_insert(self, cr, uid, vals_list, context=context)
+        if ids:
+            self._flat_refresh(cr, uid, ids, context=context)
+            self._rule_index_invalidate(cr, uid, self._rule_company_ids(cr, uid, ids, context=context),
+                                        context=context)
+        return ids
+
+    # ##### Rule matching
+
+    @profiled
+    def _map_criteria(self, cr, uid, partner, addrs, company, product=None,
+                      context=None, **kwargs):
         if context is None:
             context = {}
 
-        from_country = company.partner_id.country_id.id
-        from_state = company.partner_id.state_id.id
+        criteria = {
+            'company_id': company.id,
+            'use': context.get('use_domain', ('use_sale', '=', True))[0],
+            'date': context.get('date') or time.strftime('%Y-%m-%d'),
+            'vat': bool(partner.vat),
+            'from_country': company.partner_id.country_id.id or False,
+            'from_state': company.partner_id.state_id.id or False,
+        }
 
         # ##### Get all Fiscal Attributes from recieved arguments
 
         # Collects all Fiscal Attributes to construct a concurrent match-againt-list.
         # LOGIC: If the Fiscal Attribute of a Fiscal Rule are an entire subset of this list, the rule will match.
-        attributes_all = []
-        # Return list of the company Fiscal Attributes
-        attributes_all += company.partner_id.property_fiscal_attribute.search(
-            cr, uid, ('name','=', ATTR_USE_DOM_COMPANY), context=None
-        )
-        # Return list of the product Fiscal Attributes
+        attributes_all = set()
+        # Collect the company Fiscal Attributes
+        attributes_all.update(self._collect_attributes(
+            cr, uid, 'res.partner', company.partner_id.id, company.id, context=context))
+        # Collect the product Fiscal Attributes
         # Search domain in product is optional unless the proudct would be coded to receive more AttributUse Domains.
         # It is assured at the view level, that we don't have a rule that want's to alter an account, but has product
         # attributes defined. (This rule would fail, as product is only passed form account.invoice.line,
@@ -162,77 +439,81 @@ class AccountFiscalAllocationRule(orm.Model):
         # Account alteration however takes place at the account.invoice level. We still want to write all rules into
         # a single table. That's why the disctinction has to be made in a "soft" manner at the view lavel)
         if product:
-            attributes_all += product.property_fiscal_attribute.search(
-                cr, uid, ('name','=', ATTR_USE_DOM_PRODUCT), context=None
-        )
-        # Collect all attributes of the corresponding invoice & shipper partners resepectively.
-        for attr_dom_use, address in addrs.items():
-            attributes_all += address.fiscal_attribute_id.search(
-                cr, uid, ('name','=', attr_dom_use), context=None
-            )
-
-        # ##### Finished / "Get all Fiscal Attributes from recieved arguments
+            attributes_all.update(self._collect_attributes(
+                cr, uid, 'product.template', product.product_tmpl_id.id, company.id, context=context))
 
-        document_date = context.get('date', time.strftime('%Y-%m-%d'))
-        use_domain = context.get('use_domain', ('use_sale', '=', True))
-
-        domain = ['&', ('company_id', '=', company.id), use_domain,
-                  '|', ('from_country', '=', from_country),
-                  ('from_country', '=', False),
-                  '|', ('from_state', '=', from_state),
-                  ('from_state', '=', False),
-                  '|', ('date_start', '=', False),
-                  ('date_start', '<=', document_date),
-                  '|', ('date_end', '=', False),
-                  ('date_end', '>=', document_date),
-                  # TODO fiscal_attribute_id (as a many2many) must be somehow flattened out/iterated:
-                  '|', ('fiscal_attribute_id', '=', False),
-                  ('fiscal_attribute_id', 'in', attribute_all),
-                  ]
-        if partner.vat:
-            domain += [('vat_rule', 'in', ['with', 'both'])]
-        else:
-            domain += ['|', ('vat_rule', 'in', ['both', 'without']),
-                       ('vat_rule', '=', False)]
+        # Collect all attributes and the destination of the corresponding invoice & shipper partners resepectively.
+        for attr_dom_use, geo in ATTR_USE_DOM_GEO.items():
+            address = addrs.get(attr_dom_use)
+            if address:
+                attributes_all.update(self._collect_attributes(
+                    cr, uid, 'res.partner', address.id, company.id, context=context))
+            criteria['to_%s_country' % geo] = address and address.country_id.id or False
+            criteria['to_%s_state' % geo] = address and address.state_id.id or False
 
-        for attr_dom_use, address in addrs.items():
-            key_country = 'to_%s_country' % attr_dom_use
-            key_state = 'to_%s_state' % attr_dom_use
+        criteria['attributes'] = frozenset(attributes_all)
 
-            to_country = address.country_id.id or False
-            to_state = address.state_id.id or False
-
-
-            domain += ['|', (key_country, '=', to_country),
-                       (key_country, '=', False)]
+        # ##### Finished / "Get all Fiscal Attributes from recieved arguments
 
-            domain += ['|', (key_state, '=', to_state),
-                       (key_state, '=', False)]
+        return criteria
 
-        return domain
+    @profiled
+    def _match_compiled_rules(self, cr, uid, criteria, context=None):
+        # Return the compiled (see fiscal_allocation_rule_index) matching Fiscal Allocation Rules, ordered by sequence.
+        index = self._rule_index_get(cr, uid, criteria['company_id'], context=context)
+        return index.match(criteria)
 
+    @profiled
     def apply_fiscal_mapping(self, cr, uid, result, **kwargs):
-        taxes = result['value']['invoice_line_tax_id']
-        result['value'].update(self.fiscal_allocation_map(cr, uid, taxes, **kwargs))
+        value = result.setdefault('value', {})
+        kwargs.setdefault('taxes', value.get('invoice_line_tax_id') or [])
+        value.update(self.fiscal_allocation_map(cr, uid, **kwargs))
         return result
 
+    @profiled
     def fiscal_allocation_map(self, cr, uid, partner_id=None,
                               partner_invoice_id=None, partner_shipping_id=None,
                               company_id=None, product_id=None, account_id=None, context=None, **kwargs):
 
-        # TODO Maybe some update instead, to preserve product default taxes
-        result = {'invoice_line_tax_id': False, 'account_id': False}
+        # Only the keys which are actually mapped are returned, in order to preserve the values of the caller.
+        result = {}
         if not partner_id or not company_id:
             return result
+        if context is None:
+            context = {}
+
+        criteria = self._map_line_criteria(
+            cr, uid, partner_id, partner_invoice_id, partner_shipping_id, company_id, product_id, context=context,
+            **kwargs)
+        inv_type = kwargs.get('inv_type') or USE_INV_TYPE.get(criteria['use'], 'out_invoice')
+        # Allocated taxes and account replacement of all matching Fiscal Allocation Rules.
+        mapped = self._map_criteria_result(cr, uid, criteria, inv_type, context=context)
+        # Return an updated output dictionary with taxes stored in invoice_line_tax_id.
+        # See 'product_id_change' method in 'account.inovice.line' model in 'accont_invoice.py' of core account addon.
+        # CASE: Called from the Invoice Line ('account.invoice.line')
+        if product_id:
+            # Existing taxes are preserved, allocated taxes are added.
+            if mapped['invoice_line_tax_id']:
+                result['invoice_line_tax_id'] = list(set(kwargs.get('taxes') or []) |
+                                                     set(mapped['invoice_line_tax_id']))
+        # CASE: Called from the Invoice itself ('account.invoice')
+        elif account_id:
+            if mapped['account_id']:
+                result['account_id'] = mapped['account_id']
 
-        # ##### Construct dictionary objects to be passed to the _map_domain method
+        return result
+
+    def _map_line_criteria(self, cr, uid, partner_id, partner_invoice_id, partner_shipping_id, company_id,
+                           product_id, context=None, **kwargs):
+
+        # ##### Construct dictionary objects to be passed to the _map_criteria method
 
         obj_partner = self.pool.get("res.partner")
         obj_company = self.pool.get("res.company")
         obj_product = self.pool.get("product.product")
         partner = obj_partner.browse(cr, uid, partner_id, context=context)
         company = obj_company.browse(cr, uid, company_id, context=context)
-        product = obj_product.browse(cr, uid, product_id, context=context)
+        product = product_id and obj_product.browse(cr, uid, product_id, context=context)
 
         addrs = {}
         addrs[ATTR_USE_DOM_PINVOICE] = partner_invoice_id and obj_partner.browse(
@@ -240,62 +521,414 @@ class AccountFiscalAllocationRule(orm.Model):
         addrs[ATTR_USE_DOM_PSHIPPER] = partner_shipping_id and obj_partner.browse(
                 cr, uid, partner_shipping_id, context=context)
 
-        # ##### Finished / Construct dictionary objects to be passed to the _map_domain method
+        # ##### Finished / Construct dictionary objects to be passed to the _map_criteria method
 
-        # Construct a domain attribute within the _map_domain method
-        domain = self._map_domain(cr, uid, partner, addrs, company, product, context, **kwargs)
+        return self._map_criteria(cr, uid, partner, addrs, company, product, context, **kwargs)
 
-        frule_obj = self.pool.get('account.fiscal.allocation.rule')
-        # Return a list with ids of all matching Fiscal Allocation Rules
-        frule_ids = self.search(cr, uid, domain, context=context)
-        # Return a dictionary containing all applicable Fiscall Allocation Rule
-        frules = frule_ids and frule_obj.browse(cr, uid, frule_ids, context=context) or False
-        # Pass applicable Fiscal Allocation Rules to the Fiscal Allocation mapa_tax method.
-        # Return an updated output dictionary with taxes stored in invoice_line_tax_id.
-        # See 'product_id_change' method in 'account.inovice.line' model in 'accont_invoice.py' of core account addon.
-        # TODO restrict search according to case for better performance, if possible.
-        # CASE: Called from the Invoice Line ('account.invoice.line')
-        if product_id:
-            falloc_obj =  self.pool.get('account.fiscal.allocation')
-            # This .update() is kind of a double floor, as existing taxes are also preserved in the map_tax method.
-            updated_taxes = frules and t['invoice_line_tax_id'].update(
-                falloc_obj.map_tax(cr, uid, frules, taxes, inv_type, context)
-                # TODO as date is probably not passed in context, load invoice date into the present context
-            ) or False
-            return updated_taxes
-        # CASE: Called from the Invoice itself ('account.invoice')
-        if account_id:
-            updated_account = frules and t['account_id'] = self._map_account(
-                cr, uid, frules, account_id, inv_type, context
-                # TODO as date is probably not passed in context, load invoice date into the present context
-            ) or False
-            return updated_account
+    def fiscal_allocation_explain(self, cr, uid, partner_id=None,
+                                  partner_invoice_id=None, partner_shipping_id=None,
+                                  company_id=None, product_id=None, context=None, **kwargs):
+        # Explain mode of fiscal_allocation_map, for the same arguments: trace which rules survive each criterion
+        # (company, use flag, from / to invoice / to shipping geography, dates, VAT rule, attributes), how many are
+        # eliminated by each and the time spent per stage.
+        # Return {'criteria': {...}, 'stages': [{'stage', 'before', 'after', 'eliminated', 'rule_ids', 'duration_ms'}],
+        #         'rule_ids': [matching rule ids, as fiscal_allocation_map applies them]}
+        if not partner_id or not company_id:
+            return {'criteria': {}, 'stages': [], 'rule_ids': []}
+        if context is None:
+            context = {}
 
-        return False
+        criteria = self._map_line_criteria(
+            cr, uid, partner_id, partner_invoice_id, partner_shipping_id, company_id, product_id, context=context,
+            **kwargs)
+        start = time.time()
+        index = self._rule_index_get(cr, uid, company_id, context=context)
+        # Rules of the other companies are never looked at: the company stage is the choice of the index.
+        before = self.search_count(cr, uid, [], context=context)
+        stages = [{
+            'stage': 'company',
+            'before': before,
+            'after': len(index),
+            'eliminated': before - len(index),
+            'rule_ids': sorted(index.rules, key=lambda i: (index.rules[i].sequence, i)),
+            'duration_ms': 1000.0 * (time.time() - start),
+        }]
+        stages += index.explain(criteria)
 
+        return {
+            'criteria': dict(criteria, attributes=sorted(criteria['attributes'])),
+            'stages': stages,
+            'rule_ids': [rule.id for rule in index.match(criteria)],
+        }
 
-    def _map_account(self, cr, uid, frules, account_id, inv_type, context=None):
+    @profiled
+    def fiscal_allocation_map_batch(self, cr, uid, lines, inv_type=None, context=None):
+        # Batch counterpart of fiscal_allocation_map for whole documents (invoice validation, EDI imports, ...).
+        # 'lines' is a list of (partner_id, partner_invoice_id, partner_shipping_id, company_id, product_id, date, use)
+        # tuples, where 'use' is a use flag ('use_sale', 'use_invoice', ...) or False for the context 'use_domain'.
+        # An optional 8th element overrides inv_type for that line.
+        # Return one {'invoice_line_tax_id': [tax ids], 'account_id': account id or False} per line, in the order of
+        # 'lines'. Only the allocated taxes are returned, the caller merges them with the taxes of the line. Lines
+        # without product get no taxes, as in fiscal_allocation_map: only their account replacement applies.
+        if context is None:
+            context = {}
+
+        obj_partner = self.pool.get("res.partner")
+        obj_company = self.pool.get("res.company")
+        obj_product = self.pool.get("product.product")
 
-        # Some ugly hack to get the corresponding rule with the highest sequence number only.
-        # TODO rise alert if sequence number is ambigous. -> adapt rules sequence numbers manually.
-        f_valid_sales_id = frules.search(
-            cr, uid, ('account_invoice_id', '!=', None) , offset=0, limit=1, order=sequence, context=context)
-        f_valid_purchase_id = frules.search(
-            cr, uid, ('account_purchase_id', '!=', None) , offset=0, limit=1, order=sequence, context=context)
-        # Get it as a dict, in order to access the account fields.
-        f_valid_sales  = frules.browse(cr, uid, f_valid_sales_id, context=context)
-        f_valid_purchase  = frules.browse(cr, uid, f_valid_purchase_id, context=context)
+        # Browse every record of the batch at once, so they share a single prefetching cache.
+        partner_ids, company_ids, product_ids = set(), set(), set()
+        for line in lines:
+            partner_ids.update(line[0:3])
+            company_ids.add(line[3])
+            product_ids.add(line[4])
+        partners = dict((p.id, p) for p in obj_partner.browse(
+            cr, uid, [i for i in partner_ids if i], context=context))
+        companies = dict((c.id, c) for c in obj_company.browse(
+            cr, uid, [i for i in company_ids if i], context=context))
+        products = dict((p.id, p) for p in obj_product.browse(
+            cr, uid, [i for i in product_ids if i], context=context))
 
-        # CASE: Outgoing Invoice or a refund of such.
-        if inv_type in ('out_invoice','out_refund'):
-            account_id = f_valid_sales_id and f_valid_sales.account_invoice_id or False
+        # Criteria of each distinct document context, without product attributes.
+        contexts = {}
+        product_attributes = {}
+        # Result of each distinct (document context, product attributes, invoice type).
+        mapped = {}
+        results = []
+        for line in lines:
+            partner_id, partner_invoice_id, partner_shipping_id, company_id, product_id, date, use = line[:7]
+            if not partner_id or not company_id:
+                results.append({'invoice_line_tax_id': [], 'account_id': False})
+                continue
+
+            # Documents dated within the same validity segment of the rules of the company match the same rules,
+            # so the date only counts through its segment.
+            date = date or context.get('date') or time.strftime('%Y-%m-%d')
+            segment = self._rule_index_get(cr, uid, company_id, context=context).date_segment(date)
+            context_key = (partner_id, partner_invoice_id, partner_shipping_id, company_id, segment, use)
+            criteria = contexts.get(context_key)
+            if criteria is None:
+                ctx = dict(context, date=date)
+                if use:
+                    ctx['use_domain'] = (use, '=', True)
+                addrs = {
+                    ATTR_USE_DOM_PINVOICE: partners.get(partner_invoice_id, False),
+                    ATTR_USE_DOM_PSHIPPER: partners.get(partner_shipping_id, False),
+                }
+                criteria = contexts[context_key] = self._map_criteria(
+                    cr, uid, partners[partner_id], addrs, companies[company_id], None, context=ctx)
+
+            attributes = product_attributes.get((product_id, company_id))
+            if attributes is None:
+                product = products.get(product_id)
+                attributes = product_attributes[(product_id, company_id)] = frozenset(
+                    product and self._collect_attributes(
+                        cr, uid, 'product.template', product.product_tmpl_id.id, company_id, context=context) or [])
+
+            line_inv_type = len(line) > 7 and line[7] or inv_type or USE_INV_TYPE.get(criteria['use'], 'out_invoice')
+            key = (context_key, attributes, line_inv_type)
+            if key not in mapped:
+                mapped[key] = self._map_criteria_result(
+                    cr, uid, dict(criteria, attributes=criteria['attributes'] | attributes), line_inv_type,
+                    context=context)
+            results.append({
+                'invoice_line_tax_id': product_id and list(mapped[key]['invoice_line_tax_id']) or [],
+                'account_id': mapped[key]['account_id'],
+            })
+
+        return results
+
+    def _product_default_taxes(self, cr, uid, product, company_id, fiscal_position, direction, context=None):
+        # Default taxes of the product ('sale' or 'purchase' direction) in the company, through the (core) fiscal
+        # position, as the product onchanges of the documents compute them before the allocated taxes are added.
+        taxes = direction == 'sale' and product.taxes_id or product.supplier_taxes_id
+        taxes = [t for t in taxes if t.company_id.id == company_id]
+        if fiscal_position:
+            return self.pool.get('account.fiscal.position').map_tax(cr, uid, fiscal_position, taxes)
+        return [t.id for t in taxes]
+
+    def _order_mapping_partners(self, cr, uid, order, use, context=None):
+        # (partner, invoice partner, shipping partner) ids of the (browsed) sale or purchase order, as its onchanges
+        # pass them to the mapping: purchase orders have no invoice address, and ship to their destination address.
+        if use == 'use_purchase':
+            return order.partner_id.id, order.partner_id.id, order.dest_address_id.id or False
+        return order.partner_id.id, order.partner_invoice_id.id, order.partner_shipping_id.id
+
+    def fiscal_allocation_line_updates(self, cr, uid, order_lines, tax_field, partner_id, partner_invoice_id,
+                                       partner_shipping_id, company_id, use, fiscal_position=None, context=None):
+        # Re-map the taxes of the (browsed) lines of a sale or purchase order for new header values, in one
+        # fiscal_allocation_map_batch call: lines of the same product attributes share one rule resolution.
+        # 'fiscal_position' is the new fiscal position id of the header (False when cleared), None when unchanged.
+        # Only the lines whose taxes are still those of the saved header are re-mapped, user edited taxes are kept.
+        # Return (1, id, {tax_field: [(6, 0, tax ids)]}) for the lines whose taxes change only. To be applied when the
+        # order is saved (see write of sale.order and purchase.order), not returned by the header onchanges: the 7.0
+        # client takes an one2many onchange value as the whole content of the field, dropping the unsaved lines.
+        if context is None:
+            context = {}
+        inv_type = USE_INV_TYPE.get(use, 'out_invoice')
+        direction = inv_type == 'out_invoice' and 'sale' or 'purchase'
+        if fiscal_position:
+            fiscal_position = self.pool.get('account.fiscal.position').browse(
+                cr, uid, fiscal_position, context=context)
+        entries = []
+        base_taxes = {}
+        for line in order_lines:
+            if not line.product_id or not partner_id or not company_id:
+                entries.append((line, None, None, None, None))
+                continue
+            order = line.order_id
+            old_company_id = order.company_id.id or company_id
+            new_position = fiscal_position is None and order.fiscal_position or fiscal_position
+            bases = []
+            for position, base_company_id in ((order.fiscal_position, old_company_id), (new_position, company_id)):
+                key = (line.product_id.id, position and position.id, base_company_id)
+                if key not in base_taxes:
+                    base_taxes[key] = self._product_default_taxes(
+                        cr, uid, line.product_id, base_company_id, position, direction, context=context)
+                bases.append(base_taxes[key])
+            # The mapping of the saved header, which produced the current taxes of the untouched lines.
+            old_line = self._order_mapping_partners(cr, uid, order, use, context=context) + (
+                old_company_id, line.product_id.id, order.date_order, use, inv_type)
+            new_line = (
+                partner_id, partner_invoice_id, partner_shipping_id, company_id, line.product_id.id,
+                context.get('date') or order.date_order, use, inv_type)
+            entries.append((line, bases[0], bases[1], old_line, new_line))
+
+        batch = []
+        for entry in entries:
+            if entry[3]:
+                batch += [entry[3], entry[4]]
+        results = iter(self.fiscal_allocation_map_batch(cr, uid, batch, context=context))
+        commands = []
+        for line, old_base, new_base, old_line, new_line in entries:
+            if old_line is None:
+                continue
+            old_taxes = sorted(set(old_base) | set(next(results)['invoice_line_tax_id']))
+            taxes = sorted(set(new_base) | set(next(results)['invoice_line_tax_id']))
+            current = sorted(t.id for t in line[tax_field])
+            if current == old_taxes and taxes != current:
+                commands.append((1, line.id, {tax_field: [(6, 0, taxes)]}))
+        return commands
+
+    def _map_criteria_signature(self, cr, uid, criteria, context=None):
+        if self._flat_backend:
+            return (criteria['use'], tuple(criteria[field] for field in RULE_GEO_FIELDS), criteria['date'],
+                    bool(criteria['vat']), criteria['attributes'])
+        return self._rule_index_get(cr, uid, criteria['company_id'], context=context).signature(criteria)
+
+    def _map_criteria_result(self, cr, uid, criteria, inv_type, context=None):
+        # Allocated taxes and replacement account of the rules matching 'criteria', served from the result cache.
+        # Lines of different partners and products mostly share the same normalized criteria, and so the result.
+        self._cache_check(cr, uid, context=context)
+        company_id = criteria['company_id']
+        key = (company_id, self._rule_generation_all, self._rule_generation.get(company_id, 0), inv_type,
+               self._map_criteria_signature(cr, uid, criteria, context=context))
+        hit = key in self._result_cache
+        self._profile.count('result', hit)
+        if hit:
+            self._result_cache_stats['hits'] += 1
+            result = self._result_cache[key]
+        else:
+            self._result_cache_stats['misses'] += 1
+            result = self._result_cache[key] = self._map_criteria_result_uncached(
+                cr, uid, criteria, inv_type, context=context)
+        return {'invoice_line_tax_id': list(result['invoice_line_tax_id']), 'account_id': result['account_id']}
+
+    def _map_criteria_result_uncached(self, cr, uid, criteria, inv_type, context=None):
+        if self._flat_backend:
+            return self._flat_map_result(cr, uid, criteria, inv_type, context=context)
+        result = {'invoice_line_tax_id': [], 'account_id': False}
+        frules = self._match_compiled_rules(cr, uid, criteria, context=context)
+        if not frules:
+            return result
+        falloc_obj = self.pool.get('account.fiscal.allocation')
+        result['invoice_line_tax_id'] = falloc_obj.map_tax(cr, uid, frules, [], inv_type, context=context)
+        result['account_id'] = self._map_account(cr, uid, frules, False, inv_type, context=context)
+        return result
+
+    @profiled
+    def _flat_map_result(self, cr, uid, criteria, inv_type, context=None):
+        # SQL counterpart of _map_criteria_result: taxes and account replacement in a single query on the flattened
+        # rule table. Rows come ordered by sequence and rule id, so the first account found wins like in
+        # FiscalAllocationRuleIndex.select_account.
+        if inv_type in ('out_invoice', 'out_refund'):
+            direction, account_col = 'sale', 3
+        elif inv_type in ('in_invoice', 'in_refund'):
+            direction, account_col = 'purchase', 4
+        else:
+            direction, account_col = None, None
+
+        query, params = flat_match_query(criteria, direction)
+        cr.execute(query, params)
+        taxes = set()
+        account_id = False
+        for row in cr.fetchall():
+            if row[2]:
+                taxes.add(row[2])
+            if account_col and not account_id and row[account_col]:
+                account_id = row[account_col]
+        return {'invoice_line_tax_id': list(taxes), 'account_id': account_id}
+
+    @profiled
+    def _map_account(self, cr, uid, frules, account_id, inv_type, context=None):
+        # 'frules' are the compiled matching rules, ordered by sequence. The first rule which has an account
+        # replacement for the direction of the invoice wins; the compiled rules carry sequence and accounts, so no
+        # additional query is needed.
 
+        # CASE: Outgoing Invoice or a refund of such.
+        if inv_type in ('out_invoice', 'out_refund'):
+            field = 'account_invoice_id'
         # CASE: Incoming Invoice or a refund of such.
-        if inv_type in ('in_invoice', 'in_refund'):
-            account_id = f_valid_purchase_id and f_valid_purchase.account_purchase_id or False
+        elif inv_type in ('in_invoice', 'in_refund'):
+            field = 'account_purchase_id'
+        else:
+            return account_id
 
+        if not frules:
+            return False
+        index = self._rule_index_get(cr, uid, frules[0].company_id, context=context)
+        account_id, ambiguity = index.select_account(frules, field)
+        if ambiguity and ambiguity['count'] == 1:
+            _logger.warning(
+                "Ambiguous account replacement (%s) on sequence %s between rules %s of company %s, "
+                "rule %s wins. Adapt the sequences of these rules.",
+                field, ambiguity['sequence'], ambiguity['rule_ids'], index.company_id, ambiguity['rule_ids'][0])
         return account_id
 
+    def get_account_ambiguities(self, cr, uid, company_id=None, context=None):
+        # Diagnostic: account replacements that were resolved between matched rules sharing the same sequence but
+        # pointing to different accounts, since the compiled rules of the company (of all loaded companies if
+        # company_id is not given) were loaded.
+        # Return a list of {'company_id', 'field', 'sequence', 'rule_ids', 'account_ids', 'count'}.
+        if company_id:
+            indexes = [self._rule_index_get(cr, uid, company_id, context=context)]
+        else:
+            indexes = list(self._rule_index.values())
+        result = []
+        for index in indexes:
+            for ambiguity in index.account_ambiguities.values():
+                result.append(dict(ambiguity, company_id=index.company_id))
+        return result
+
+    # ##### Rule set snapshots
+
+    # Workers load the compiled rules from the snapshots of the directory of the server option
+    #
+    #   fiscal_allocation_snapshot_dir = /path/to/snapshots
+    #
+    # at startup instead of reading them on the first orders, provided the snapshot is current: same database and
+    # same generations of the cache scopes as when it was exported. See fiscal_allocation_snapshot.
+
+    def _snapshot_scopes(self, company_id):
+        return (CACHE_SCOPE_RULES, '%s,%s' % (CACHE_SCOPE_RULES, company_id), CACHE_SCOPE_TAXES)
+
+    def _snapshot_path(self, cr, directory, company_id):
+        return os.path.join(directory, '%s.%s.fars' % (cr.dbname, company_id))
+
+    def _export_rule_snapshot(self, cr, uid, company_ids=None, context=None):
+        # Write the snapshot of the rules of the companies (of all companies having rules if None) and of the taxes
+        # of their Fiscal Allocations into fiscal_allocation_snapshot_dir. Return the paths of the files written.
+        # Private on purpose: only server-side code (deploy scripts, scheduled actions) writes snapshots.
+        directory = config.get('fiscal_allocation_snapshot_dir')
+        if not directory:
+            raise ValueError("No snapshot directory, set fiscal_allocation_snapshot_dir")
+        if company_ids is None:
+            cr.execute("SELECT DISTINCT company_id FROM account_fiscal_allocation_rule WHERE active")
+            company_ids = [row[0] for row in cr.fetchall()]
+        database_uuid = self.pool.get('ir.config_parameter').get_param(cr, SUPERUSER_ID, 'database.uuid')
+        cr.execute("SELECT scope, generation FROM " + CACHE_GENERATION_TABLE)
+        generations = dict(cr.fetchall())
+        obj_fa = self.pool.get('account.fiscal.allocation')
+
+        paths = []
+        for company_id in company_ids:
+            rules = self._rule_index_read(cr, company_id)
+            allocation_ids = list(set(a for rule in rules for a in rule['fiscal_allocation_id']))
+            tax_sets = dict((allocation['id'], (allocation['sale_tax_ids'], allocation['purchase_tax_ids']))
+                            for allocation in obj_fa.read(cr, SUPERUSER_ID, allocation_ids,
+                                                          ['sale_tax_ids', 'purchase_tax_ids'],
+                                                          context=dict(CACHE_BUILD_CONTEXT)))
+            path = self._snapshot_path(cr, directory, company_id)
+            with open(path + '.tmp', 'wb') as fileobj:
+                dump_rule_snapshot(fileobj, company_id, database_uuid,
+                                   [generations.get(scope, 0) for scope in self._snapshot_scopes(company_id)],
+                                   rules, tax_sets)
+            os.rename(path + '.tmp', path)
+            paths.append(path)
+        return paths
+
+    def _snapshot_load(self, cr, uid, path, database_uuid, context=None):
+        # Install the compiled rules and tax sets of the snapshot 'path' if it is current. Return its company.
+        with open(path, 'rb') as fileobj:
+            buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                header = load_rule_snapshot_header(buf)
+                company_id = header['company_id']
+                current = tuple(self._cache_generations.generations.get(scope, 0)
+                                for scope in self._snapshot_scopes(company_id))
+                if header['database_uuid'] != database_uuid or tuple(header['generations']) != current:
+                    return None
+                header, rules, tax_sets = load_rule_snapshot(buf)
+            finally:
+                buf.close()
+        self._rule_index[company_id] = FiscalAllocationRuleIndex(company_id, rules)
+        obj_fa = self.pool.get('account.fiscal.allocation')
+        for allocation_id, (sale_tax_ids, purchase_tax_ids) in tax_sets.items():
+            if allocation_id not in obj_fa._tax_sets:
+                obj_fa._tax_sets[allocation_id] = {
+                    'sale': obj_fa._tax_ordinals.encode(sale_tax_ids),
+                    'purchase': obj_fa._tax_ordinals.encode(purchase_tax_ids),
+                }
+        return company_id
+
+    def _register_hook(self, cr):
+        super(AccountFiscalAllocationRule, self)._register_hook(cr)
+        directory = config.get('fiscal_allocation_snapshot_dir')
+        if not directory or not os.path.isdir(directory):
+            return
+        # Take the current generations first: the snapshots are compared with them, and the first use of the
+        # caches must not drop what was just loaded.
+        self._cache_check(cr, SUPERUSER_ID)
+        database_uuid = self.pool.get('ir.config_parameter').get_param(cr, SUPERUSER_ID, 'database.uuid')
+        prefix = cr.dbname + '.'
+        for name in sorted(os.listdir(directory)):
+            if not (name.startswith(prefix) and name.endswith('.fars')):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                company_id = self._snapshot_load(cr, SUPERUSER_ID, path, database_uuid)
+            except (EnvironmentError, ValueError, struct.error):
+                _logger.warning("Rule snapshot %s could not be loaded", path, exc_info=True)
+                continue
+            if company_id is None:
+                _logger.info("Rule snapshot %s is outdated, the rules will be read from the database", path)
+            else:
+                _logger.info("Rule snapshot %s loaded", path)
+
+    # ##### Instrumentation
+
+    def get_result_cache_stats(self, cr, uid, context=None):
+        # Hits and misses of the result cache of this worker since it started.
+        hits, misses = self._result_cache_stats['hits'], self._result_cache_stats['misses']
+        return {
+            'hits': hits,
+            'misses': misses,
+            'ratio': hits + misses and float(hits) / (hits + misses) or None,
+            'size': len(self._result_cache),
+        }
+
+    def get_fiscal_allocation_profile(self, cr, uid, limit=None, context=None):
+        # Records of the profiled calls of this worker (the last 'limit' ones), and hit ratios of its caches:
+        # {'enabled': bool, 'records': [{'model', 'method', 'depth', 'timestamp', 'duration_ms', 'queries', ...}],
+        #  'caches': {cache: {'hits', 'misses', 'ratio'}}}
+        # Records with depth 0 are the entry points, nested calls (depth > 0) are accounted in their duration too.
+        return self._profile.stats(limit)
+
+    def reset_fiscal_allocation_profile(self, cr, uid, context=None):
+        self._profile.reset()
+        return True
+
 # ---------------------------
 # Templates & Wizards Section
 # ---------------------------
@@ -303,7 +936,24 @@ class AccountFiscalAllocationRule(orm.Model):
 
 class AccountFiscalAllocationRuleTemplate(orm.Model):
     _name = "account.fiscal.allocation.rule.template"
-    _columns = ACC_FISC_ALLOC_RULE_COLS_TMPL
+
+    # The relation tables of the rules have their foreign key on the rule table: templates need their own.
+    tmpl_update_cols = {
+        'fiscal_attribute_id': fields.many2many(
+            'account.fiscal.attribute',
+            'account_fiscal_allocation_rule_template_attribute_rel',
+            'template_id', 'attribute_id',
+            'Fiscal Attributes',
+            domain="[('fiscal_domain_id','=',fiscal_domain_id)]"),
+        'fiscal_allocation_id': fields.many2many(
+            'account.fiscal.allocation',
+            'account_fiscal_allocation_rule_template_allocation_rel',
+            'template_id', 'allocation_id',
+            'Fiscal Allocation Sets',
+            domain="[('fiscal_domain_id','=',fiscal_domain_id)]"),
+    }
+
+    _columns = dict(chain(ACC_FISC_ALLOC_RULE_COLS_TMPL.items(), tmpl_update_cols.items()))
     _defaults = ACC_FISC_ALLOC_RULE_DEFS_TMPL
 
 
@@ -312,36 +962,42 @@ class WizardAccountFiscalAllocationRule(orm.TransientModel):
     _columns = {
         'company_id': fields.many2one('res.company', 'Company', required=True),
     }
-    defaults = {
+    _defaults = {
         'company_id': lambda self, cr, uid, c:
         self.pool.get('res.users').browse(cr, uid, [uid], c)[0].company_id.id,
     }
 
-    def _template_vals(self, cr, uid, template, company_id,
-                       fiscal_allocation_ids, context=None):
-        return {'name': template.name,
-                'description': template.description,
-                'from_country': template.from_country.id,
-                'from_state': template.from_state.id,
-                'to_invoice_country': template.to_invoice_country.id,
-                'to_invoice_state': template.to_invoice_state.id,
-                'to_shipping_country': template.to_shipping_country.id,
-                'to_shipping_state': template.to_shipping_state.id,
-                'company_id': company_id,
-                'fiscal_allocation_id': fiscal_allocation_ids and fiscal_allocation_ids[0],
-                # Add further template attributes here
-                'from_fiscal_attribute_id': template.from_fiscal_attribute_id.id,
-                'to_fiscal_attribute_id': template.to_fiscal_attribute_id.id,
-                'product_fiscal_attribute_id': template.product_fiscal_attribute_id.id,
-                'use_sale': template.use_sale,
-                'use_invoice': template.use_invoice,
-                'use_purchase': template.use_purchase,
-                'use_picking': template.use_picking,
-                'date_start': template.date_start,
-                'date_end': template.date_end,
-                'sequence': template.sequence,
-                'vat_rule': template.vat_rule,
-                }
+    def _template_vals(self, cr, uid, template, company_id, allocation_map, attribute_map, context=None):
+        # 'template' is a rule template as read() returns it (load='_classic_write'). 'allocation_map' and
+        # 'attribute_map' translate the Fiscal Allocations and Fiscal Attributes of the templates into those of the
+        # company of the same name. Return None when one of them has no counterpart in the company.
+        allocation_ids = [allocation_map.get(a) for a in template['fiscal_allocation_id']]
+        attribute_ids = [attribute_map.get(a) for a in template['fiscal_attribute_id']]
+        if None in allocation_ids or None in attribute_ids:
+            return None
+        # Account replacements belong to the company of the template, they are not copied.
+        vals = dict((field, template[field]) for field in ACC_FISC_ALLOC_RULE_COLS_TMPL if field not in (
+            'fiscal_allocation_id', 'fiscal_attribute_id', 'account_invoice_id', 'account_purchase_id'))
+        vals.update({
+            'company_id': company_id,
+            'fiscal_allocation_id': [(6, 0, allocation_ids)],
+            'fiscal_attribute_id': [(6, 0, attribute_ids)],
+        })
+        return vals
+
+    def _company_name_map(self, cr, uid, model, ids, company_id, context=None):
+        # {id: id of the record of the same name of the company} for the records 'ids' of 'model'. One read of the
+        # names and one search/read of the records of the company, whatever the number of templates.
+        obj = self.pool.get(model)
+        company_ids = obj.search(cr, uid, [('company_id', '=', company_id)], order='id', context=context)
+        by_name = {}
+        for record in obj.read(cr, uid, company_ids, ['name'], context=context):
+            by_name.setdefault(record['name'], record['id'])
+        result = {}
+        for record in obj.read(cr, uid, list(ids), ['name'], context=context):
+            if record['name'] in by_name:
+                result[record['id']] = by_name[record['name']]
+        return result
 
     def action_create(self, cr, uid, ids, context=None):
 
@@ -349,30 +1005,28 @@ class WizardAccountFiscalAllocationRule(orm.TransientModel):
 
         obj_far = self.pool.get('account.fiscal.allocation.rule')
         obj_far_temp = self.pool.get('account.fiscal.allocation.rule.template')
-        obj_fa = self.pool.get('account.fiscal.allocation')
 
         company_id = obj_wizard.company_id.id
 
         far_ids = obj_far_temp.search(cr, uid, [], context=context)
+        templates = obj_far_temp.read(cr, uid, far_ids, ACC_FISC_ALLOC_RULE_COLS_TMPL.keys(), context=context,
+                                      load='_classic_write')
 
-        # TODO fix me doesn't work multi template that have empty fiscal
-        # position maybe we should link the rule with the account template
-        for far_template in obj_far_temp.browse(
-                cr, uid, far_ids, context=context):
-            fa_ids = False
-            if far_template.fiscal_allocation_id:
-
-                fa_ids = obj_fa.search(
-                    cr, uid,
-                    [('name', '=', far_template.fiscal_allocation_id.name)],
-                    context=context)
-
-                if not fa_ids:
-                    continue
+        allocation_map = self._company_name_map(
+            cr, uid, 'account.fiscal.allocation',
+            set(a for template in templates for a in template['fiscal_allocation_id']), company_id, context=context)
+        attribute_map = self._company_name_map(
+            cr, uid, 'account.fiscal.attribute',
+            set(a for template in templates for a in template['fiscal_attribute_id']), company_id, context=context)
 
-            vals = self._template_vals(
-                cr, uid, far_template, company_id, fa_ids, context=context)
-            obj_far.create(
-                cr, uid, vals, context=context)
+        vals_list = []
+        for template in templates:
+            vals = self._template_vals(cr, uid, template, company_id, allocation_map, attribute_map, context=context)
+            if vals is None:
+                _logger.info("Rule template %s (%s) skipped: its Fiscal Allocations or Fiscal Attributes do not "
+                             "exist in company %s.", template['id'], template['name'], company_id)
+                continue
+            vals_list.append(vals)
+        obj_far._create_batch(cr, uid, vals_list, context=context)
 
         return {}
@@ -0,0 +1,126 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Flattened, denormalized copy of the Fiscal Allocation Rules for SQL-side matching: one row per (rule, allocation,
+# direction, tax) of the active rules, allocations and taxes, carrying all the criteria of the rule. Every rule also
+# has one row with allocation_id, direction and tax_id NULL, which carries its account replacements. Only the active
+# Fiscal Attributes of a rule are kept in attribute_ids, as in the compiled rule index.
+# The table is maintained by the write hooks of the rules, allocations, attributes and taxes (see _flat_refresh of
+# account.fiscal.allocation.rule) and used instead of the compiled rule index when the server configuration has
+#
+#   fiscal_allocation_backend = sql
+#
+# Requires PostgreSQL 9.2 (daterange).
+
+from .fiscal_allocation_rule_index import RULE_GEO_FIELDS, RULE_USE_FLAGS
+
+FLAT_TABLE = 'account_fiscal_allocation_rule_flat'
+
+FLAT_CREATE = """
+CREATE TABLE %(table)s (
+    rule_id integer NOT NULL REFERENCES account_fiscal_allocation_rule (id) ON DELETE CASCADE,
+    company_id integer NOT NULL,
+    sequence integer,
+    use_sale boolean,
+    use_invoice boolean,
+    use_purchase boolean,
+    use_picking boolean,
+    from_country integer,
+    from_state integer,
+    to_invoice_country integer,
+    to_invoice_state integer,
+    to_shipping_country integer,
+    to_shipping_state integer,
+    vat_rule varchar,
+    validity daterange NOT NULL,
+    attribute_ids integer[] NOT NULL,
+    account_invoice_id integer,
+    account_purchase_id integer,
+    allocation_id integer,
+    direction varchar,
+    tax_id integer
+);
+CREATE INDEX %(table)s_rule_id_index ON %(table)s (rule_id);
+CREATE INDEX %(table)s_company_direction_index ON %(table)s (company_id, direction);
+CREATE INDEX %(table)s_validity_index ON %(table)s USING gist (validity);
+CREATE INDEX %(table)s_attribute_ids_index ON %(table)s USING gin (attribute_ids);
+""" % {'table': FLAT_TABLE}
+
+# Rows of the active rules matching the WHERE clause appended to it (on the rule table 'r').
+FLAT_INSERT = """
+INSERT INTO %(table)s (
+    rule_id, company_id, sequence, %(uses)s, %(geo)s, vat_rule, validity, attribute_ids,
+    account_invoice_id, account_purchase_id, allocation_id, direction, tax_id)
+SELECT r.id, r.company_id, r.sequence, %(r_uses)s, %(r_geo)s, r.vat_rule,
+       CASE WHEN r.date_start > r.date_end THEN 'empty'::daterange
+            ELSE daterange(r.date_start, r.date_end, '[]') END,
+       COALESCE((SELECT array_agg(rel.attribute_id ORDER BY rel.attribute_id)
+                 FROM account_fiscal_allocation_rule_attribute_rel rel
+                 JOIN account_fiscal_attribute fa ON fa.id = rel.attribute_id AND fa.active
+                 WHERE rel.rule_id = r.id), '{}'),
+       r.account_invoice_id, r.account_purchase_id, t.allocation_id, t.direction, t.tax_id
+FROM account_fiscal_allocation_rule r
+JOIN (
+    SELECT id AS rule_id, NULL::integer AS allocation_id, NULL::varchar AS direction, NULL::integer AS tax_id
+    FROM account_fiscal_allocation_rule
+    UNION ALL
+    SELECT rel.rule_id, a.id, x.direction, x.tax_id
+    FROM account_fiscal_allocation_rel rel
+    JOIN account_fiscal_allocation a ON a.id = rel.allocation_id AND a.active
+    JOIN (SELECT fiscal_allocation_id, tax_id, 'sale' AS direction FROM fiscal_allocation_sale_tax_rel
+          UNION ALL
+          SELECT fiscal_allocation_id, tax_id, 'purchase' AS direction FROM fiscal_allocation_purchase_tax_rel
+          ) x ON x.fiscal_allocation_id = a.id
+    JOIN account_tax tax ON tax.id = x.tax_id AND tax.active
+) t ON t.rule_id = r.id
+WHERE r.active
+""" % {
+    'table': FLAT_TABLE,
+    'uses': ', '.join(RULE_USE_FLAGS),
+    'geo': ', '.join(RULE_GEO_FIELDS),
+    'r_uses': ', '.join('r.%s' % f for f in RULE_USE_FLAGS),
+    'r_geo': ', '.join('r.%s' % f for f in RULE_GEO_FIELDS),
+}
+
+
+def flat_match_query(criteria, direction):
+    # Return (query, params) selecting (rule_id, sequence, tax_id, account_invoice_id, account_purchase_id) of the
+    # rows matching 'criteria' (see account.fiscal.allocation.rule _map_criteria) for the tax 'direction'. The
+    # SQL twin of FiscalAllocationRuleIndex.match.
+    if criteria['use'] not in RULE_USE_FLAGS:
+        raise ValueError("Unknown use flag %r" % (criteria['use'],))
+    where = [
+        "company_id = %s",
+        "%s" % criteria['use'],
+        "(direction = %s OR direction IS NULL)",
+        "validity @> %s::date",
+        "attribute_ids <@ %s::integer[]",
+    ]
+    params = [criteria['company_id'], direction, criteria['date'], sorted(criteria['attributes'])]
+    if criteria['vat']:
+        where.append("vat_rule IN ('with', 'both')")
+    else:
+        where.append("vat_rule IS DISTINCT FROM 'with'")
+    for field in RULE_GEO_FIELDS:
+        where.append("(%s IS NULL OR %s = %%s)" % (field, field))
+        params.append(criteria[field] or None)
+    query = "SELECT rule_id, sequence, tax_id, account_invoice_id, account_purchase_id FROM %s WHERE %s " \
+            "ORDER BY sequence, rule_id" % (FLAT_TABLE, ' AND '.join(where))
+    return query, params
@@ -0,0 +1,308 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Compiled, in-memory representation of the Fiscal Allocation Rules of one company.
+# The index is plain python (no ORM access) on purpose: it is built once from a single read() of the rules and then
+# answers "which rules match this document line" with dictionary lookups, instead of a domain search per call.
+# PostgreSQL cannot index the "(field = x OR field IS NULL)" pairs of the domain well, the geographic routing of the
+# index resolves them in constant time instead.
+
+import time
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+DATE_FORMAT = '%Y-%m-%d'
+
+RULE_USE_FLAGS = ('use_sale', 'use_invoice', 'use_purchase', 'use_picking')
+
+RULE_GEO_FIELDS = (
+    'from_country', 'from_state',
+    'to_invoice_country', 'to_invoice_state',
+    'to_shipping_country', 'to_shipping_state',
+)
+
+# Fields read from account.fiscal.allocation.rule to compile the index.
+RULE_INDEX_FIELDS = list(RULE_USE_FLAGS) + list(RULE_GEO_FIELDS) + [
+    'company_id', 'date_start', 'date_end', 'vat_rule', 'sequence',
+    'fiscal_attribute_id', 'fiscal_allocation_id',
+    'account_invoice_id', 'account_purchase_id',
+]
+
+
+class CompiledRule(object):
+    """Immutable snapshot of a Fiscal Allocation Rule, holding only what matching needs."""
+
+    __slots__ = ('id', 'company_id', 'sequence') + RULE_USE_FLAGS + RULE_GEO_FIELDS + (
+        'date_start', 'date_end', 'date_bit', 'vat_rule', 'attribute_mask', 'fiscal_allocation_ids',
+        'account_invoice_id', 'account_purchase_id')
+
+    def __init__(self, values, attribute_mask, date_bit):
+        # 'values' is a rule as read() returns it (load='_classic_write'), with RULE_INDEX_FIELDS.
+        setattr_ = object.__setattr__
+        for field in ('id', 'company_id', 'sequence', 'date_start', 'date_end', 'vat_rule',
+                      'account_invoice_id', 'account_purchase_id') + RULE_USE_FLAGS + RULE_GEO_FIELDS:
+            setattr_(self, field, values[field])
+        setattr_(self, 'fiscal_allocation_ids', tuple(values['fiscal_allocation_id']))
+        setattr_(self, 'attribute_mask', attribute_mask)
+        setattr_(self, 'date_bit', date_bit)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledRule is immutable")
+
+    def __repr__(self):
+        return '<CompiledRule %s>' % self.id
+
+
+def rule_match_geo(rule, criteria):
+    for field in RULE_GEO_FIELDS:
+        value = getattr(rule, field)
+        if value and value != criteria[field]:
+            return False
+    return True
+
+
+def rule_match(rule, criteria, attribute_mask, date_mask):
+    # Whether the compiled rule matches the criteria of account.fiscal.allocation.rule._map_criteria. Company, use
+    # flag and geography (rule_match_geo) are not checked here, they are resolved by the route the rule is found in.
+    # 'attribute_mask' is the bitmask of the collected Fiscal Attributes, see FiscalAllocationRuleIndex.attribute_mask,
+    # 'date_mask' the bitmask of the dated rules valid on the document date, see FiscalAllocationRuleIndex.date_mask.
+    if rule.date_bit and not rule.date_bit & date_mask:
+        return False
+
+    if criteria['vat']:
+        if rule.vat_rule not in ('with', 'both'):
+            return False
+    elif rule.vat_rule == 'with':
+        return False
+
+    # The Fiscal Attributes of the rule must be a subset of the collected ones (a rule without attributes always is).
+    if rule.attribute_mask & ~attribute_mask:
+        return False
+
+    return True
+
+
+class FiscalAllocationRuleIndex(object):
+    """Fiscal Allocation Rules of one company, routed by use flag and geography (origin and destinations)."""
+
+    def __init__(self, company_id, rules):
+        # 'rules' are the rules of the company as read() returns them, see CompiledRule.
+        self.company_id = company_id
+        # {rule_id: CompiledRule}
+        self.rules = {}
+        # Dense bit position of every Fiscal Attribute used by a rule: {attribute_id: 1 << n}. Each rule carries the
+        # bitmask of its attributes, so that the subset test is a single integer operation.
+        self.attribute_bits = {}
+        # Geographic routing, per use flag. 'geo_buckets' holds the rules by their exact RULE_GEO_FIELDS key,
+        # False standing for "any". 'geo_values' are the values used by at least one rule, per field. 'routes' maps
+        # a normalized document key (values no rule uses replaced by False) to the rules of all the buckets that
+        # match it, wildcards included, ordered by sequence.
+        self.geo_buckets = dict((use, {}) for use in RULE_USE_FLAGS)
+        self.geo_values = dict((use, [set() for field in RULE_GEO_FIELDS]) for use in RULE_USE_FLAGS)
+        self.routes = dict((use, {}) for use in RULE_USE_FLAGS)
+        # Validity intervals of the rules having date_start and/or date_end. 'date_boundaries' are the sorted dates
+        # on which the set of valid rules changes, 'date_segments[i]' is the bitmask (over 'date_bit' of the dated
+        # rules) of the rules valid from date_boundaries[i - 1] included to date_boundaries[i] excluded.
+        self.date_boundaries = []
+        self.date_segments = [0]
+        # Account replacements resolved between rules of equal sequence, see select_account.
+        # {(field, (rule_id, ...)): {'field', 'sequence', 'rule_ids', 'account_ids', 'count'}}
+        self.account_ambiguities = {}
+
+        date_bits = self._build_date_segments(rules)
+        for values in sorted(rules, key=lambda r: (r['sequence'], r['id'])):
+            attribute_mask = 0
+            for attribute_id in values['fiscal_attribute_id']:
+                attribute_mask |= self.attribute_bits.setdefault(attribute_id, 1 << len(self.attribute_bits))
+            rule = self.rules[values['id']] = CompiledRule(values, attribute_mask, date_bits.get(values['id'], 0))
+            key = tuple(values[field] for field in RULE_GEO_FIELDS)
+            for use in RULE_USE_FLAGS:
+                if values[use]:
+                    self.geo_buckets[use].setdefault(key, []).append(rule)
+                    for geo_values, value in zip(self.geo_values[use], key):
+                        if value:
+                            geo_values.add(value)
+
+    def _build_date_segments(self, rules):
+        # Sweep the validity intervals once: a rule enters on its date_start and leaves the day after its date_end.
+        # A rule whose date_start is after its date_end is valid on no date: its bit is in no segment.
+        # Return the date bit of the dated rules: {rule_id: bit}
+        enter, leave = {}, {}
+        date_bits = {}
+        dated = [r for r in rules if r['date_start'] or r['date_end']]
+        open_mask = 0
+        for n, rule in enumerate(sorted(dated, key=lambda r: r['id'])):
+            date_bits[rule['id']] = bit = 1 << n
+            if rule['date_start'] and rule['date_end'] and rule['date_start'] > rule['date_end']:
+                continue
+            if rule['date_start']:
+                enter[rule['date_start']] = enter.get(rule['date_start'], 0) | bit
+            else:
+                open_mask |= bit
+            if rule['date_end']:
+                day_after = (datetime.strptime(rule['date_end'], DATE_FORMAT) + timedelta(days=1)).strftime(DATE_FORMAT)
+                leave[day_after] = leave.get(day_after, 0) | bit
+
+        self.date_boundaries = sorted(set(enter) | set(leave))
+        self.date_segments = [open_mask]
+        for boundary in self.date_boundaries:
+            open_mask = (open_mask | enter.get(boundary, 0)) & ~leave.get(boundary, 0)
+            self.date_segments.append(open_mask)
+        return date_bits
+
+    def date_segment(self, document_date):
+        # Number of the validity segment of document_date: documents of the same segment match the same rules as far
+        # as dates are concerned.
+        return bisect_right(self.date_boundaries, document_date)
+
+    def date_mask(self, document_date):
+        return self.date_segments[self.date_segment(document_date)]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def geo_key(self, use, key):
+        # Replace the RULE_GEO_FIELDS values of 'key' no rule of 'use' refers to by False: they match the same rules.
+        return tuple(value if value in values else False for values, value in zip(self.geo_values[use], key))
+
+    def route(self, use, key):
+        # Candidate rules (ordered by sequence) for the RULE_GEO_FIELDS values 'key' of a document. All wildcard
+        # fallbacks of a key are resolved once, on its first lookup, then the route is a single dictionary hit.
+        # Routes are not expanded eagerly for every key: each wildcard rule would be copied into all of them.
+        key = self.geo_key(use, key)
+        routes = self.routes[use]
+        candidates = routes.get(key)
+        if candidates is None:
+            buckets = self.geo_buckets[use]
+            positions = [i for i, value in enumerate(key) if value]
+            candidates = []
+            for n in range(1 << len(positions)):
+                pattern = list(key)
+                for bit, position in enumerate(positions):
+                    if n & (1 << bit):
+                        pattern[position] = False
+                candidates.extend(buckets.get(tuple(pattern), ()))
+            candidates.sort(key=lambda r: (r.sequence, r.id))
+            routes[key] = candidates
+        return candidates
+
+    def candidates(self, criteria):
+        return self.route(criteria['use'], tuple(criteria[field] for field in RULE_GEO_FIELDS))
+
+    def attribute_mask(self, attribute_ids):
+        # Attributes not used by any rule of the company cannot make a difference and are left out.
+        mask = 0
+        for attribute_id in attribute_ids:
+            mask |= self.attribute_bits.get(attribute_id, 0)
+        return mask
+
+    def signature(self, criteria):
+        # Normalized form of 'criteria': criteria of equal signature match the same rules. Geography, date and
+        # attributes only count as far as the rules of the company tell them apart.
+        use = criteria['use']
+        return (
+            use,
+            self.geo_key(use, tuple(criteria[field] for field in RULE_GEO_FIELDS)),
+            self.date_segment(criteria['date']),
+            bool(criteria['vat']),
+            self.attribute_mask(criteria['attributes']),
+        )
+
+    def match(self, criteria):
+        # Return the matching rules ordered like the model (_order = 'sequence').
+        attribute_mask = self.attribute_mask(criteria['attributes'])
+        date_mask = self.date_mask(criteria['date'])
+        # Routes are ordered by sequence already, and so is the result.
+        return [rule for rule in self.candidates(criteria)
+                if rule_match(rule, criteria, attribute_mask, date_mask)]
+
+    def explain(self, criteria):
+        # Trace of the evaluation of 'criteria': the rules of the company are filtered criterion by criterion,
+        # without the routing, in the order below. Return one {'stage', 'before', 'after', 'eliminated',
+        # 'rule_ids' (survivors, ordered by sequence), 'duration_ms'} per stage. The survivors of the last stage are
+        # the rules match() returns.
+        use = criteria['use']
+        attribute_mask = self.attribute_mask(criteria['attributes'])
+        date_mask = self.date_mask(criteria['date'])
+        vat_rules = criteria['vat'] and ('with', 'both') or ('both', 'without', False, None)
+
+        def match_geo(fields):
+            return lambda r: all(not getattr(r, f) or getattr(r, f) == criteria[f] for f in fields)
+
+        stages = (
+            ('use', lambda r: getattr(r, use)),
+            ('from', match_geo(RULE_GEO_FIELDS[0:2])),
+            ('to_invoice', match_geo(RULE_GEO_FIELDS[2:4])),
+            ('to_shipping', match_geo(RULE_GEO_FIELDS[4:6])),
+            ('date', lambda r: not r.date_bit or r.date_bit & date_mask),
+            ('vat', lambda r: r.vat_rule in vat_rules),
+            ('attributes', lambda r: not r.attribute_mask & ~attribute_mask),
+        )
+        rules = sorted(self.rules.values(), key=lambda r: (r.sequence, r.id))
+        trace = []
+        for stage, predicate in stages:
+            start = time.time()
+            survivors = [rule for rule in rules if predicate(rule)]
+            trace.append({
+                'stage': stage,
+                'before': len(rules),
+                'after': len(survivors),
+                'eliminated': len(rules) - len(survivors),
+                'rule_ids': [rule.id for rule in survivors],
+                'duration_ms': 1000.0 * (time.time() - start),
+            })
+            rules = survivors
+        return trace
+
+    def select_account(self, rules, field):
+        # Pick the account replacement ('account_invoice_id' or 'account_purchase_id') of the matched rules, which
+        # are ordered by sequence, in one pass: the first rule having one wins. Other rules of the same sequence
+        # with a different account make the choice ambiguous; the tie is resolved on the rule id and recorded.
+        # Return (account_id or False, ambiguity record or None).
+        winner = None
+        tied = []
+        for rule in rules:
+            account_id = getattr(rule, field)
+            if not account_id:
+                continue
+            if winner is None:
+                winner = rule
+                winner_account_id = account_id
+                tied = [rule]
+            elif rule.sequence != winner.sequence:
+                break
+            elif account_id != winner_account_id:
+                tied.append(rule)
+
+        if winner is None:
+            return False, None
+        if len(tied) == 1:
+            return winner_account_id, None
+
+        rule_ids = tuple(r.id for r in tied)
+        ambiguity = self.account_ambiguities.setdefault((field, rule_ids), {
+            'field': field,
+            'sequence': winner.sequence,
+            'rule_ids': rule_ids,
+            'account_ids': tuple(getattr(r, field) for r in tied),
+            'count': 0,
+        })
+        ambiguity['count'] += 1
+        return winner_account_id, ambiguity
@@ -92,7 +92,7 @@ class AccountInvoice (orm.Model):
         if not partner_id or not company_id:
             return result
 
-        return self.pool.get._fiscal_allocation_map(
+        return self._fiscal_allocation_map(
             cr, uid,
             result,
             partner_id=partner_id,
@@ -101,6 +101,25 @@ class AccountInvoice (orm.Model):
             inv_type=inv_type
         )
 
+    def fiscal_allocation_map_lines(self, cr, uid, ids, context=None):
+        # Map the lines of whole invoices in a single fiscal_allocation_map_batch call, instead of replaying
+        # product_id_change line by line (invoice validation, EDI and other import paths).
+        # Return {invoice_line_id: {'invoice_line_tax_id': [allocated tax ids], 'account_id': account id or False}},
+        # without taxes for the lines without product, as product_id_change.
+        line_ids = []
+        lines = []
+        for invoice in self.browse(cr, uid, ids, context=context):
+            partner_id = invoice.partner_id.id
+            for line in invoice.invoice_line:
+                line_ids.append(line.id)
+                lines.append((
+                    partner_id, partner_id, False, invoice.company_id.id, line.product_id.id,
+                    invoice.date_invoice, 'use_invoice', invoice.type))
+
+        results = self.pool.get('account.fiscal.allocation.rule').fiscal_allocation_map_batch(
+            cr, uid, lines, context=context)
+        return dict(zip(line_ids, results))
+
     # def onchange_company_id(self, cr, uid, ids, company_id, partner_id, c_type,
     #                         invoice_line, currency_id, context=None):
     #     result = super(AccountInvoice, self).onchange_company_id(
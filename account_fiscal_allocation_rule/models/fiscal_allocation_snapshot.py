@@ -0,0 +1,193 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Versioned binary snapshot of the rule set of a company, for workers to skip reading and resolving the rules from
+# the ORM at startup. Plain python (no ORM access): account.fiscal.allocation.rule exports and loads it, see
+# _export_rule_snapshot and _register_hook.
+#
+# Layout, little-endian, every section a packed array of int32 so that the file can be memory-mapped:
+#
+#   header       SNAPSHOT_HEADER: magic, version, company, database uuid, generations of the cache scopes 'rules',
+#                'rules,<company_id>' and 'taxes' when exported, then the length of each section
+#   rules        SNAPSHOT_RULE_LAYOUT per rule: criteria, dates (proleptic ordinals, 0 for none), vat rule,
+#                accounts, and offset/count of its attributes and allocations in the two next sections
+#   attributes   Fiscal Attribute ids of the rules
+#   allocations  Fiscal Allocation ids of the rules
+#   tax sets     allocation id, offset/count of its sale taxes, offset/count of its purchase taxes
+#   taxes        tax ids of the tax sets
+
+import struct
+import sys
+from array import array
+from datetime import date, datetime
+from .fiscal_allocation_rule_index import DATE_FORMAT, RULE_GEO_FIELDS, RULE_USE_FLAGS
+
+SNAPSHOT_MAGIC = b'FARS'
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_HEADER = struct.Struct('<4sHxxi36sqqqIIIII4x')
+
+SNAPSHOT_VAT_RULES = (False, 'with', 'both', 'without')
+
+SNAPSHOT_RULE_LAYOUT = ('id', 'sequence', 'uses') + RULE_GEO_FIELDS + (
+    'date_start', 'date_end', 'vat_rule', 'account_invoice_id', 'account_purchase_id',
+    'attribute_offset', 'attribute_count', 'allocation_offset', 'allocation_count')
+
+SNAPSHOT_TAX_SET_WIDTH = 5
+
+
+def _int32_array(values):
+    result = array('i', values)
+    if result.itemsize != 4:
+        raise ValueError("array('i') is not 32 bits wide on this platform")
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result
+
+
+def _int32_bytes(values):
+    result = _int32_array(values)
+    if hasattr(result, 'tobytes'):
+        return result.tobytes()
+    return result.tostring()
+
+
+def _int32_load(buf, offset, count):
+    result = array('i')
+    data = buf[offset:offset + 4 * count]
+    if len(data) != 4 * count:
+        raise ValueError("Truncated rule snapshot")
+    if hasattr(result, 'frombytes'):
+        result.frombytes(data)
+    else:
+        result.fromstring(data)
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result
+
+
+def _date_ordinal(value):
+    return value and datetime.strptime(value, DATE_FORMAT).toordinal() or 0
+
+
+def _ordinal_date(value):
+    return value and date.fromordinal(value).strftime(DATE_FORMAT) or False
+
+
+def dump_rule_snapshot(fileobj, company_id, database_uuid, generations, rules, tax_sets):
+    # 'rules' are the rules of the company as read() returns them for the rule index (see RULE_INDEX_FIELDS),
+    # 'tax_sets' the taxes of their Fiscal Allocations: {allocation_id: (sale tax ids, purchase tax ids)},
+    # 'generations' the generations of the cache scopes ('rules', 'rules,<company_id>', 'taxes').
+    records, attribute_ids, allocation_ids = [], [], []
+    for rule in rules:
+        uses = 0
+        for bit, use in enumerate(RULE_USE_FLAGS):
+            if rule[use]:
+                uses |= 1 << bit
+        records.extend([rule['id'], rule['sequence'] or 0, uses])
+        records.extend(rule[field] or 0 for field in RULE_GEO_FIELDS)
+        records.extend([
+            _date_ordinal(rule['date_start']), _date_ordinal(rule['date_end']),
+            SNAPSHOT_VAT_RULES.index(rule['vat_rule'] or False),
+            rule['account_invoice_id'] or 0, rule['account_purchase_id'] or 0,
+            len(attribute_ids), len(rule['fiscal_attribute_id']),
+            len(allocation_ids), len(rule['fiscal_allocation_id']),
+        ])
+        attribute_ids.extend(rule['fiscal_attribute_id'])
+        allocation_ids.extend(rule['fiscal_allocation_id'])
+
+    sets, tax_ids = [], []
+    for allocation_id, (sale_tax_ids, purchase_tax_ids) in sorted(tax_sets.items()):
+        sets.extend([allocation_id, len(tax_ids), len(sale_tax_ids), len(tax_ids) + len(sale_tax_ids),
+                     len(purchase_tax_ids)])
+        tax_ids.extend(sale_tax_ids)
+        tax_ids.extend(purchase_tax_ids)
+
+    fileobj.write(SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, company_id, (database_uuid or '').encode('ascii'),
+        generations[0], generations[1], generations[2],
+        len(rules), len(attribute_ids), len(allocation_ids), len(tax_sets), len(tax_ids)))
+    for section in (records, attribute_ids, allocation_ids, sets, tax_ids):
+        fileobj.write(_int32_bytes(section))
+
+
+def load_rule_snapshot_header(buf):
+    # Return {'company_id', 'database_uuid', 'generations'} of the snapshot in 'buf' (bytes or mmap), ValueError
+    # if it is not a rule snapshot of this version.
+    if len(buf) < SNAPSHOT_HEADER.size:
+        raise ValueError("Truncated rule snapshot")
+    header = SNAPSHOT_HEADER.unpack(buf[:SNAPSHOT_HEADER.size])
+    if header[0] != SNAPSHOT_MAGIC or header[1] != SNAPSHOT_VERSION:
+        raise ValueError("Not a rule snapshot of version %s" % SNAPSHOT_VERSION)
+    return {
+        'company_id': header[2],
+        'database_uuid': header[3].rstrip(b'\0').decode('ascii'),
+        'generations': header[4:7],
+        'counts': header[7:12],
+    }
+
+
+def load_rule_snapshot(buf):
+    # Return (header, rules, tax_sets) of the snapshot in 'buf', rules and tax sets as dump_rule_snapshot takes
+    # them.
+    header = load_rule_snapshot_header(buf)
+    rule_count, attribute_count, allocation_count, set_count, tax_count = header['counts']
+    width = len(SNAPSHOT_RULE_LAYOUT)
+    offset = SNAPSHOT_HEADER.size
+    records = _int32_load(buf, offset, rule_count * width)
+    offset += 4 * len(records)
+    attribute_ids = _int32_load(buf, offset, attribute_count)
+    offset += 4 * attribute_count
+    allocation_ids = _int32_load(buf, offset, allocation_count)
+    offset += 4 * allocation_count
+    sets = _int32_load(buf, offset, set_count * SNAPSHOT_TAX_SET_WIDTH)
+    offset += 4 * len(sets)
+    tax_ids = _int32_load(buf, offset, tax_count)
+
+    geo_start = SNAPSHOT_RULE_LAYOUT.index(RULE_GEO_FIELDS[0])
+    geo_end = geo_start + len(RULE_GEO_FIELDS)
+    rules = []
+    for i in range(0, len(records), width):
+        record = records[i:i + width]
+        rule = dict(zip(RULE_GEO_FIELDS, [value or False for value in record[geo_start:geo_end]]))
+        (date_start, date_end, vat_rule, account_invoice_id, account_purchase_id,
+         attribute_offset, attribute_len, allocation_offset, allocation_len) = record[geo_end:]
+        for bit, use in enumerate(RULE_USE_FLAGS):
+            rule[use] = bool(record[2] & 1 << bit)
+        rule.update({
+            'id': record[0],
+            'company_id': header['company_id'],
+            'sequence': record[1],
+            'date_start': _ordinal_date(date_start),
+            'date_end': _ordinal_date(date_end),
+            'vat_rule': SNAPSHOT_VAT_RULES[vat_rule],
+            'account_invoice_id': account_invoice_id or False,
+            'account_purchase_id': account_purchase_id or False,
+            'fiscal_attribute_id': list(attribute_ids[attribute_offset:attribute_offset + attribute_len]),
+            'fiscal_allocation_id': list(allocation_ids[allocation_offset:allocation_offset + allocation_len]),
+        })
+        rules.append(rule)
+
+    tax_sets = {}
+    for i in range(0, len(sets), SNAPSHOT_TAX_SET_WIDTH):
+        allocation_id, sale_offset, sale_len, purchase_offset, purchase_len = sets[i:i + SNAPSHOT_TAX_SET_WIDTH]
+        tax_sets[allocation_id] = (list(tax_ids[sale_offset:sale_offset + sale_len]),
+                                   list(tax_ids[purchase_offset:purchase_offset + purchase_len]))
+    return header, rules, tax_sets
@@ -0,0 +1,119 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+from openerp.osv import orm
+from .fiscal_allocation_batch import batch_insert
+
+
+class AccountFiscalAttribute(orm.Model):
+    _inherit = 'account.fiscal.attribute'
+
+    # Fiscal Attributes are compiled into the rule index of account.fiscal.allocation.rule, keep it current.
+    def create(self, cr, uid, vals, context=None):
+        res_id = super(AccountFiscalAttribute, self).create(cr, uid, vals, context=context)
+        self.pool.get('account.fiscal.allocation.rule')._rule_index_invalidate(cr, uid, context=context)
+        return res_id
+
+    def _create_batch(self, cr, uid, vals_list, context=None):
+        # Mass creation of attributes (imports), see fiscal_allocation_batch.
+        ids = batch_insert(self, cr, uid, vals_list, context=context)
+        if ids:
+            self.pool.get('account.fiscal.allocation.rule')._rule_index_invalidate(cr, uid, context=context)
+        return ids
+
+    # Writing 'active' or unlinking also changes what the partner and product properties resolve to.
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        res = super(AccountFiscalAttribute, self).write(cr, uid, ids, vals, context=context)
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+        # (De)activated attributes change the attribute ids of the flattened rows.
+        obj_rule._flat_refresh(cr, uid, obj_rule._flat_rule_ids(cr, uid, attribute_ids=ids, context=context),
+                               context=context)
+        obj_rule._rule_index_invalidate(cr, uid, context=context)
+        obj_rule._attribute_cache_invalidate(cr, uid, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        obj_rule = self.pool.get('account.fiscal.allocation.rule')
+        rule_ids = obj_rule._flat_rule_ids(cr, uid, attribute_ids=ids, context=context)
+        res = super(AccountFiscalAttribute, self).unlink(cr, uid, ids, context=context)
+        obj_rule._flat_refresh(cr, uid, rule_ids, context=context)
+        obj_rule._rule_index_invalidate(cr, uid, context=context)
+        obj_rule._attribute_cache_invalidate(cr, uid, context=context)
+        return res
+
+
+class PartnerFiscalAttribute(orm.Model):
+    _inherit = 'res.partner'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(PartnerFiscalAttribute, self).write(cr, uid, ids, vals, context=context)
+        if 'property_fiscal_attribute' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self.pool.get('account.fiscal.allocation.rule')._attribute_cache_invalidate(
+                cr, uid, 'res.partner', ids, context=context)
+        return res
+
+
+class ProductFiscalAttribute(orm.Model):
+    _inherit = 'product.template'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(ProductFiscalAttribute, self).write(cr, uid, ids, vals, context=context)
+        if 'property_fiscal_attribute' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self.pool.get('account.fiscal.allocation.rule')._attribute_cache_invalidate(
+                cr, uid, 'product.template', ids, context=context)
+        return res
+
+
+class IrPropertyFiscalAttribute(orm.Model):
+    _inherit = 'ir.property'
+
+    # Company wide defaults of 'property_fiscal_attribute' apply to any partner or product without an own value.
+    def _invalidate_fiscal_attribute(self, cr, uid, names, context=None):
+        if 'property_fiscal_attribute' in names:
+            self.pool.get('account.fiscal.allocation.rule')._attribute_cache_invalidate(cr, uid, context=context)
+
+    def create(self, cr, uid, vals, context=None):
+        res_id = super(IrPropertyFiscalAttribute, self).create(cr, uid, vals, context=context)
+        self._invalidate_fiscal_attribute(cr, uid, [vals.get('name')], context=context)
+        return res_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        names = [p.name for p in self.browse(cr, uid, ids, context=context)]
+        res = super(IrPropertyFiscalAttribute, self).write(cr, uid, ids, vals, context=context)
+        self._invalidate_fiscal_attribute(cr, uid, names + [vals.get('name')], context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        names = [p.name for p in self.browse(cr, uid, ids, context=context)]
+        res = super(IrPropertyFiscalAttribute, self).unlink(cr, uid, ids, context=context)
+        self._invalidate_fiscal_attribute(cr, uid, names, context=context)
+        return res
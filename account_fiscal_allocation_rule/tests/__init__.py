@@ -0,0 +1,39 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+from . import test_cache_generation
+from . import test_import_readers
+from . import test_map_batch
+from . import test_order_line_updates
+from . import test_rule_index
+from . import test_rule_snapshot
+from . import test_tax_bitset
+from . import test_tax_union
+
+checks = [
+    test_cache_generation,
+    test_import_readers,
+    test_map_batch,
+    test_order_line_updates,
+    test_rule_index,
+    test_rule_snapshot,
+    test_tax_bitset,
+    test_tax_union,
+]
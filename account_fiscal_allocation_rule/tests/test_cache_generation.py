@@ -0,0 +1,128 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of the cross-worker cache generations (plain python, the generation table simulated).
+
+import gc
+import unittest2
+
+from ..models.fiscal_allocation_generation import CacheGenerations
+
+
+class FakeDatabase(object):
+
+    def __init__(self):
+        self.committed = {}
+        self.sequence = 0
+
+
+class FakeCursor(object):
+    # The queries of CacheGenerations on a transactional copy of the generation table.
+
+    def __init__(self, database):
+        self.database = database
+        self.rows = dict(database.committed)
+        self.written = set()
+        self.result = []
+        self.rowcount = 0
+
+    def nextval(self):
+        self.database.sequence += 1
+        return self.database.sequence
+
+    def execute(self, query, params=None):
+        if query.startswith('UPDATE'):
+            scope = params[1]
+            self.rowcount = int(scope in self.rows)
+            if self.rowcount:
+                self.rows[scope] = self.nextval()
+                self.written.add(scope)
+        elif query.startswith('INSERT'):
+            self.rows[params[0]] = self.nextval()
+            self.written.add(params[0])
+        elif query.startswith('SELECT'):
+            self.result = list(self.rows.items())
+
+    def fetchall(self):
+        return self.result
+
+    def commit(self):
+        self.database.committed.update((scope, self.rows[scope]) for scope in self.written)
+        self.rollback()
+
+    def rollback(self):
+        self.rows = dict(self.database.committed)
+        self.written = set()
+
+
+class TestCacheGenerations(unittest2.TestCase):
+
+    def setUp(self):
+        self.database = FakeDatabase()
+        cr = FakeCursor(self.database)
+        CacheGenerations('generation', 'generation_seq').signal(cr, ['rules'])
+        cr.commit()
+        self.generations = CacheGenerations('generation', 'generation_seq')
+        self.assertEqual(self.generations.check(FakeCursor(self.database)), ['rules'])
+
+    def test_unchanged(self):
+        self.assertEqual(self.generations.check(FakeCursor(self.database)), [])
+
+    def test_commit(self):
+        cr = FakeCursor(self.database)
+        self.generations.signal(cr, ['rules', 'taxes'])
+        self.assertEqual(sorted(self.generations.check(cr)), ['rules', 'taxes'])
+        cr.commit()
+        del cr
+        gc.collect()
+        self.assertEqual(self.generations.check(FakeCursor(self.database)), [])
+        self.assertFalse(self.generations.pending)
+
+    def test_rollback(self):
+        # Caches rebuilt from the rolled back transaction are dropped on the next use of the same cursor.
+        cr = FakeCursor(self.database)
+        self.generations.signal(cr, ['rules', 'taxes'])
+        self.assertEqual(sorted(self.generations.check(cr)), ['rules', 'taxes'])
+        cr.rollback()
+        self.assertEqual(sorted(self.generations.check(cr)), ['rules', 'taxes'])
+        self.assertEqual(self.generations.check(cr), [])
+
+    def test_rollback_closed(self):
+        # ... and on the next use of another cursor, once the cursor of the change is gone.
+        cr = FakeCursor(self.database)
+        self.generations.signal(cr, ['rules'])
+        self.assertEqual(self.generations.check(cr), ['rules'])
+        cr.rollback()
+        del cr
+        gc.collect()
+        self.assertEqual(self.generations.check(FakeCursor(self.database)), ['rules'])
+        self.assertFalse(self.generations.pending)
+        self.assertEqual(self.generations.check(FakeCursor(self.database)), [])
+
+    def test_concurrent_commit(self):
+        # A change committed by another worker while this one holds the cursor of its own change.
+        cr = FakeCursor(self.database)
+        self.generations.signal(cr, ['taxes'])
+        self.assertEqual(self.generations.check(cr), ['taxes'])
+        other = FakeCursor(self.database)
+        CacheGenerations('generation', 'generation_seq').signal(other, ['rules'])
+        other.commit()
+        cr.commit()
+        self.assertEqual(self.generations.check(cr), ['rules'])
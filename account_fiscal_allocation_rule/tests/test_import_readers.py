@@ -0,0 +1,153 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of the row readers of the import wizard (plain python, no database).
+
+import base64
+import io
+import unittest2
+
+from openerp.osv import orm
+from ..models.fiscal_allocation_import import ImportFileError, ImportRowError, WizardAccountFiscalAllocationImport, \
+    b64decode_file, csv_rows, xml_rows
+
+
+def read_rows(rows):
+    # The rows, with the rows which cannot be read as their error message.
+    return [(number, isinstance(row, ImportRowError) and row.args[0] or row) for number, row in rows]
+
+
+class TestImportReaders(unittest2.TestCase):
+
+    def test_csv_rows(self):
+        data = u'\ufeffname, sequence,use_sale\nRule \xe9,5,1\n\n,,\n" Rule 2 ",,\n'.encode('utf-8')
+        self.assertEqual(list(csv_rows(io.BytesIO(data))), [
+            (2, {u'name': u'Rule \xe9', u'sequence': u'5', u'use_sale': u'1'}),
+            (5, {u'name': u'Rule 2', u'sequence': u'', u'use_sale': u''}),
+        ])
+
+    def test_csv_rows_header_only(self):
+        self.assertEqual(list(csv_rows(io.BytesIO(b'name,sequence\n'))), [])
+
+    def test_csv_rows_rejected(self):
+        data = b'name,sequence\nRule 1,5,x\nRule \xe9,5\nRule 3\nRule 4,6\n'
+        self.assertEqual(read_rows(csv_rows(io.BytesIO(data))), [
+            (2, '3 columns, the header has 2'),
+            (3, 'Not UTF-8'),
+            (4, '1 columns, the header has 2'),
+            (5, {u'name': u'Rule 4', u'sequence': u'6'}),
+        ])
+        self.assertRaises(ImportFileError, list, csv_rows(io.BytesIO(b'name,s\xe9quence\n')))
+
+    def test_xml_rows(self):
+        data = u'''<?xml version="1.0" encoding="utf-8"?>
+<records>
+    <record><field name="name"> Rule \xe9 </field><field name="sequence">5</field></record>
+    <record><field name="name">Rule 2</field><field name="description"/></record>
+</records>'''.encode('utf-8')
+        self.assertEqual(list(xml_rows(io.BytesIO(data))), [
+            (1, {'name': u'Rule \xe9', 'sequence': '5'}),
+            (2, {'name': 'Rule 2', 'description': ''}),
+        ])
+        # Read piece by piece.
+        self.assertEqual(list(xml_rows(io.BytesIO(data), step=7)), list(xml_rows(io.BytesIO(data))))
+
+    def test_xml_rows_doctype(self):
+        data = b'''<?xml version="1.0"?>
+<!DOCTYPE records [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>
+<records><record><field name="name">&b;</field></record></records>'''
+        self.assertRaises(ImportFileError, list, xml_rows(io.BytesIO(data)))
+        self.assertRaises(ImportFileError, list, xml_rows(io.BytesIO(b'<?xml version="1.0"?><!DOCTYPE records>'
+                                                                         b'<records/>')))
+        self.assertRaises(ImportFileError, list, xml_rows(io.BytesIO(b'<records><record></records>')))
+
+    def test_b64decode_file(self):
+        data = bytes(bytearray(range(256))) * 50
+        encoded = base64.encodestring(data).decode('ascii')
+        for step in (4, 7, 100, 4 * 65536):
+            fileobj = io.BytesIO()
+            b64decode_file(encoded, fileobj, step)
+            self.assertEqual(fileobj.getvalue(), data)
+
+
+class FakeCursor(object):
+    # No existing names.
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return []
+
+
+class FakeUsers(object):
+
+    def browse(self, cr, uid, ids, context=None):
+        company = type('Company', (object,), {'id': 1})
+        return type('User', (object,), {'company_ids': [company]})
+
+
+class FakePool(object):
+
+    def get(self, name):
+        return FakeUsers()
+
+
+class FakeImportWizard(object):
+    # Rows are {'name': name}, the database refuses the row numbers in 'refused'.
+
+    import_file = WizardAccountFiscalAllocationImport.__dict__['import_file']
+    _import_models = {'account.fiscal.attribute': ('_import_vals', 'attribute')}
+
+    def __init__(self, refused):
+        self.pool = FakePool()
+        self.refused = refused
+        self.inserted = []
+
+    def _import_vals(self, cr, uid, row, lookups, company_id, context=None):
+        return {'name': row['name']}
+
+    def _import_insert(self, cr, uid, model, chunk, rejected, context=None):
+        for number, vals in chunk:
+            if number in self.refused:
+                rejected.append((number, 'Refused by the database'))
+            else:
+                self.inserted.append(vals['name'])
+        return len(chunk) - len(rejected)
+
+
+class TestImportFile(unittest2.TestCase):
+
+    def import_file(self, wizard, data, chunk_size=2):
+        return wizard.import_file(FakeCursor(), 1, io.BytesIO(data), 'account.fiscal.attribute', 'csv', 1,
+                                  chunk_size=chunk_size)
+
+    def test_unique_names(self):
+        # A name refused by the database is not used: a later row may take it. Duplicates within a chunk are
+        # rejected.
+        wizard = FakeImportWizard(refused=set([2]))
+        result = self.import_file(wizard, b'name\nA\nB\nB\nA\nC,x\nA\n')
+        self.assertEqual(wizard.inserted, ['B', 'A'])
+        self.assertEqual(result, {'imported': 2, 'rejected_count': 4, 'rejected': [
+            (2, 'Refused by the database'), (4, "'B' already exists"), (6, '2 columns, the header has 1'),
+            (7, "'A' already exists")]})
+
+    def test_invalid_file(self):
+        self.assertRaises(orm.except_orm, self.import_file, FakeImportWizard(set()), b'name,s\xe9quence\nA,1\n')
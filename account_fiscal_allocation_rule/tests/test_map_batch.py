@@ -0,0 +1,109 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of fiscal_allocation_map_batch against fiscal_allocation_map line by line, with browse records and the
+# rule resolution replaced by plain objects.
+
+import unittest2
+
+from ..models.fiscal_allocation_profile import FiscalAllocationProfile
+from ..models.fiscal_allocation_rule import AccountFiscalAllocationRule
+
+
+class Record(object):
+
+    def __init__(self, id, **values):
+        self.id = id
+        self.__dict__.update(values)
+
+
+class FakeModel(object):
+
+    def __init__(self, records):
+        self.records = records
+
+    def browse(self, cr, uid, ids, context=None):
+        if isinstance(ids, list):
+            return [self.records[i] for i in ids]
+        return self.records[ids]
+
+
+class FakeRuleIndex(object):
+
+    def date_segment(self, date):
+        return date[:4]
+
+
+class FakeRuleModel(object):
+    # Attributes: those of the partner and of the product. Allocated taxes: 100 + each attribute, the account
+    # replacement: 500 + the number of attributes.
+
+    fiscal_allocation_map = AccountFiscalAllocationRule.__dict__['fiscal_allocation_map']
+    fiscal_allocation_map_batch = AccountFiscalAllocationRule.__dict__['fiscal_allocation_map_batch']
+    _map_line_criteria = AccountFiscalAllocationRule.__dict__['_map_line_criteria']
+
+    def __init__(self):
+        self._profile = FiscalAllocationProfile()
+        self.models = {
+            'res.partner': FakeModel({1: Record(1, attributes=[1]), 2: Record(2, attributes=[2])}),
+            'res.company': FakeModel({1: Record(1)}),
+            'product.product': FakeModel({7: Record(7, product_tmpl_id=Record(70, attributes=[3]))}),
+        }
+        self.pool = self
+
+    def get(self, name):
+        return self.models.get(name, self)
+
+    def _rule_index_get(self, cr, uid, company_id, context=None):
+        return FakeRuleIndex()
+
+    def _collect_attributes(self, cr, uid, model, res_id, company_id, context=None):
+        return tuple(self.models['product.product'].records[7].product_tmpl_id.attributes)
+
+    def _map_criteria(self, cr, uid, partner, addrs, company, product=None, context=None, **kwargs):
+        attributes = frozenset(partner.attributes) | frozenset(product and product.product_tmpl_id.attributes or [])
+        return {'use': (context or {}).get('use_domain', ('use_invoice',))[0], 'attributes': attributes}
+
+    def _map_criteria_result(self, cr, uid, criteria, inv_type, context=None):
+        return {'invoice_line_tax_id': [100 + a for a in criteria['attributes']],
+                'account_id': 500 + len(criteria['attributes'])}
+
+
+class TestMapBatch(unittest2.TestCase):
+
+    def test_parity(self):
+        model = FakeRuleModel()
+        lines = [
+            (1, 1, False, 1, 7, '2014-05-01', 'use_invoice'),
+            (1, 1, False, 1, False, '2014-05-01', 'use_invoice'),
+            (2, 2, 1, 1, 7, '2015-05-01', 'use_sale'),
+            (2, 2, 1, 1, False, '2015-05-01', 'use_sale'),
+            (False, False, False, 1, 7, '2015-05-01', 'use_sale'),
+        ]
+        batch = model.fiscal_allocation_map_batch(None, 1, lines)
+        self.assertEqual([sorted(result['invoice_line_tax_id']) for result in batch],
+                         [[101, 103], [], [102, 103], [], []])
+        for line, result in zip(lines, batch):
+            partner_id, partner_invoice_id, partner_shipping_id, company_id, product_id, date, use = line
+            single = model.fiscal_allocation_map(
+                None, 1, partner_id=partner_id, partner_invoice_id=partner_invoice_id,
+                partner_shipping_id=partner_shipping_id, company_id=company_id, product_id=product_id, taxes=[],
+                context={'date': date, 'use_domain': (use, '=', True)})
+            self.assertEqual(sorted(single.get('invoice_line_tax_id', [])), sorted(result['invoice_line_tax_id']))
@@ -0,0 +1,95 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of the re-mapping of the order lines on header changes, with browse records and the rule resolution
+# replaced by plain objects.
+
+import unittest2
+
+from ..models.fiscal_allocation_rule import AccountFiscalAllocationRule
+
+
+class Record(object):
+
+    def __init__(self, id, **values):
+        self.id = id
+        self.__dict__.update(values)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __bool__(self):
+        return bool(self.id)
+    __nonzero__ = __bool__
+
+
+NULL = Record(False)
+
+
+class FakeRuleModel(object):
+    # Base taxes: tax 1 without fiscal position. Allocated taxes: 1000 + the id of the shipping partner.
+
+    _order_mapping_partners = AccountFiscalAllocationRule.__dict__['_order_mapping_partners']
+    fiscal_allocation_line_updates = AccountFiscalAllocationRule.__dict__['fiscal_allocation_line_updates']
+
+    def _product_default_taxes(self, cr, uid, product, company_id, fiscal_position, direction, context=None):
+        return [fiscal_position and fiscal_position.id or 1]
+
+    def fiscal_allocation_map_batch(self, cr, uid, lines, context=None):
+        return [{'invoice_line_tax_id': [1000 + (line[2] or 0)], 'account_id': False} for line in lines]
+
+
+class TestOrderLineUpdates(unittest2.TestCase):
+
+    def setUp(self):
+        self.model = FakeRuleModel()
+        self.product = Record(7)
+
+    def make_lines(self, order, tax_field, *taxes):
+        lines = [Record(n + 1, product_id=self.product, order_id=order, **{tax_field: [Record(t) for t in tax_ids]})
+                 for n, tax_ids in enumerate(taxes)]
+        order.order_line = lines
+        return lines
+
+    def test_purchase_dest_address(self):
+        # Mapped with the destination address (2) as shipping partner: line 1 has the mapped taxes, line 2 was
+        # edited by the user.
+        order = Record(1, partner_id=Record(1), dest_address_id=Record(2), company_id=Record(1),
+                       fiscal_position=NULL, date_order='2014-05-01')
+        lines = self.make_lines(order, 'taxes_id', [1, 1002], [1, 5])
+        commands = self.model.fiscal_allocation_line_updates(
+            None, 1, lines, 'taxes_id', 1, 1, 3, 1, 'use_purchase')
+        self.assertEqual(commands, [(1, 1, {'taxes_id': [(6, 0, [1, 1003])]})])
+
+    def test_purchase_without_dest_address(self):
+        order = Record(1, partner_id=Record(1), dest_address_id=NULL, company_id=Record(1),
+                       fiscal_position=NULL, date_order='2014-05-01')
+        lines = self.make_lines(order, 'taxes_id', [1, 1000])
+        commands = self.model.fiscal_allocation_line_updates(
+            None, 1, lines, 'taxes_id', 1, 1, 3, 1, 'use_purchase')
+        self.assertEqual(commands, [(1, 1, {'taxes_id': [(6, 0, [1, 1003])]})])
+
+    def test_sale_shipping_address(self):
+        order = Record(1, partner_id=Record(1), partner_invoice_id=Record(4), partner_shipping_id=Record(5),
+                       company_id=Record(1), fiscal_position=NULL, date_order='2014-05-01')
+        lines = self.make_lines(order, 'tax_id', [1, 1005], [1, 1001])
+        commands = self.model.fiscal_allocation_line_updates(
+            None, 1, lines, 'tax_id', 1, 4, 6, 1, 'use_sale')
+        self.assertEqual(commands, [(1, 1, {'tax_id': [(6, 0, [1, 1006])]})])
@@ -0,0 +1,201 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of the compiled rule index (plain python, no database).
+
+import random
+import unittest2
+
+from ..models.fiscal_allocation_rule_index import RULE_GEO_FIELDS, RULE_USE_FLAGS, FiscalAllocationRuleIndex
+
+
+def make_rule(rule_id, **values):
+    rule = {
+        'id': rule_id, 'company_id': 1, 'sequence': 10, 'date_start': False, 'date_end': False, 'vat_rule': 'both',
+        'fiscal_attribute_id': [], 'fiscal_allocation_id': [], 'account_invoice_id': False,
+        'account_purchase_id': False,
+    }
+    rule.update(dict((use, True) for use in RULE_USE_FLAGS))
+    rule.update(dict((field, False) for field in RULE_GEO_FIELDS))
+    rule.update(values)
+    return rule
+
+
+def make_criteria(date, **values):
+    criteria = {'company_id': 1, 'use': 'use_invoice', 'date': date, 'vat': False, 'attributes': []}
+    criteria.update(dict((field, False) for field in RULE_GEO_FIELDS))
+    criteria.update(values)
+    return criteria
+
+
+def linear_match(rules, criteria):
+    # Reference matcher: every criterion of the domain of _map_criteria checked on every rule, in _order.
+    result = []
+    for rule in sorted(rules, key=lambda r: (r['sequence'], r['id'])):
+        if rule['company_id'] != criteria['company_id'] or not rule[criteria['use']]:
+            continue
+        if any(rule[field] and rule[field] != criteria[field] for field in RULE_GEO_FIELDS):
+            continue
+        if rule['date_start'] and criteria['date'] < rule['date_start']:
+            continue
+        if rule['date_end'] and criteria['date'] > rule['date_end']:
+            continue
+        if rule['vat_rule'] not in (criteria['vat'] and ('with', 'both') or ('both', 'without')):
+            continue
+        if not set(rule['fiscal_attribute_id']) <= set(criteria['attributes']):
+            continue
+        result.append(rule)
+    return result
+
+
+class TestRuleIndexDates(unittest2.TestCase):
+
+    def setUp(self):
+        self.index = FiscalAllocationRuleIndex(1, [
+            make_rule(1),
+            make_rule(2, date_start='2014-01-01', date_end='2014-06-30'),
+            make_rule(3, date_end='2014-03-31'),
+            make_rule(4, date_start='2014-04-01'),
+            make_rule(5, date_start='2014-06-30', date_end='2014-01-01'),
+        ])
+
+    def matching(self, date):
+        return [rule.id for rule in self.index.match(make_criteria(date))]
+
+    def test_boundaries(self):
+        self.assertNotIn(2, self.matching('2013-12-31'))
+        self.assertIn(2, self.matching('2014-01-01'))
+        self.assertIn(2, self.matching('2014-06-30'))
+        self.assertNotIn(2, self.matching('2014-07-01'))
+
+    def test_open_start(self):
+        self.assertIn(3, self.matching('1990-01-01'))
+        self.assertIn(3, self.matching('2014-03-31'))
+        self.assertNotIn(3, self.matching('2014-04-01'))
+
+    def test_open_end(self):
+        self.assertNotIn(4, self.matching('2014-03-31'))
+        self.assertIn(4, self.matching('2014-04-01'))
+        self.assertIn(4, self.matching('2099-12-31'))
+
+    def test_undated(self):
+        for date in ('1990-01-01', '2014-05-15', '2099-12-31'):
+            self.assertIn(1, self.matching(date))
+
+    def test_inverted_range(self):
+        # date_start after date_end: valid on no date, like the domain search and the flattened rule table.
+        for date in ('2013-12-31', '2014-01-01', '2014-03-15', '2014-06-30', '2014-07-01', '2020-01-01'):
+            self.assertNotIn(5, self.matching(date))
+
+    def test_segments(self):
+        # Dates between the same boundaries share a segment, hence a signature.
+        self.assertEqual(self.index.date_segment('2014-01-02'), self.index.date_segment('2014-03-31'))
+        self.assertNotEqual(self.index.date_segment('2014-03-31'), self.index.date_segment('2014-04-01'))
+        self.assertEqual(self.matching('2014-04-01'), [1, 2, 4])
+
+
+class TestRuleIndexMatching(unittest2.TestCase):
+
+    def test_attribute_subset(self):
+        index = FiscalAllocationRuleIndex(1, [
+            make_rule(1),
+            make_rule(2, fiscal_attribute_id=[10]),
+            make_rule(3, fiscal_attribute_id=[10, 11]),
+            make_rule(4, fiscal_attribute_id=[12]),
+        ])
+
+        def matching(attributes):
+            return [rule.id for rule in index.match(make_criteria('2014-05-01', attributes=attributes))]
+
+        self.assertEqual(matching([]), [1])
+        self.assertEqual(matching([10]), [1, 2])
+        self.assertEqual(matching([11]), [1])
+        self.assertEqual(matching([10, 11, 99]), [1, 2, 3])
+        self.assertEqual(matching([12, 10, 11]), [1, 2, 3, 4])
+
+    def test_geo_wildcards(self):
+        index = FiscalAllocationRuleIndex(1, [
+            make_rule(1),
+            make_rule(2, to_invoice_country=1),
+            make_rule(3, to_invoice_country=1, to_invoice_state=11),
+            make_rule(4, from_country=2, to_shipping_country=1),
+            make_rule(5, to_invoice_country=2, use_invoice=False),
+        ])
+
+        def matching(use='use_invoice', **geo):
+            return [rule.id for rule in index.match(make_criteria('2014-05-01', use=use, **geo))]
+
+        self.assertEqual(matching(), [1])
+        self.assertEqual(matching(to_invoice_country=1), [1, 2])
+        self.assertEqual(matching(to_invoice_country=1, to_invoice_state=11), [1, 2, 3])
+        self.assertEqual(matching(to_invoice_country=1, to_invoice_state=12), [1, 2])
+        self.assertEqual(matching(from_country=2, to_shipping_country=1, to_invoice_country=3), [1, 4])
+        self.assertEqual(matching(to_invoice_country=2), [1])
+        self.assertEqual(matching('use_sale', to_invoice_country=2), [1, 5])
+
+    def test_select_account(self):
+        index = FiscalAllocationRuleIndex(1, [
+            make_rule(1, sequence=5),
+            make_rule(2, sequence=10, account_invoice_id=100),
+            make_rule(3, sequence=10, account_invoice_id=101, account_purchase_id=200),
+            make_rule(4, sequence=10, account_invoice_id=100),
+            make_rule(5, sequence=20, account_invoice_id=102, account_purchase_id=201),
+        ])
+        rules = index.match(make_criteria('2014-05-01'))
+        account_id, ambiguity = index.select_account(rules, 'account_invoice_id')
+        self.assertEqual(account_id, 100)
+        self.assertEqual(ambiguity['rule_ids'], (2, 3))
+        self.assertEqual(ambiguity['account_ids'], (100, 101))
+        self.assertEqual(index.select_account(rules, 'account_purchase_id'), (200, None))
+        self.assertEqual(index.select_account(rules[3:], 'account_invoice_id'), (100, None))
+        self.assertEqual(index.select_account(rules[:1], 'account_invoice_id'), (False, None))
+
+    def test_linear_parity(self):
+        # Random rules and documents of the same small value ranges, plus values no rule uses: the index must match
+        # exactly the rules, and pick the accounts, of a linear scan.
+        rng = random.Random(42)
+
+        def pick(values):
+            return rng.choice(values)
+
+        rules = []
+        for rule_id in range(1, 301):
+            values = dict((field, pick([False, False, 1, 2])) for field in RULE_GEO_FIELDS)
+            values.update((use, rng.random() < 0.7) for use in RULE_USE_FLAGS)
+            rules.append(make_rule(
+                rule_id, sequence=pick([5, 10, 10, 20]), vat_rule=pick(['with', 'both', 'without']),
+                date_start=pick([False, False, '2014-01-01', '2014-07-01']),
+                date_end=pick([False, False, '2014-06-30', '2014-12-31']),
+                fiscal_attribute_id=rng.sample([10, 11, 12, 13], pick([0, 0, 1, 2])),
+                account_invoice_id=pick([False, False, False, 100, 101]), **values))
+        index = FiscalAllocationRuleIndex(1, rules)
+
+        for n in range(1000):
+            criteria = make_criteria(
+                pick(['2013-12-31', '2014-01-01', '2014-06-30', '2014-07-01', '2015-01-01']),
+                use=pick(RULE_USE_FLAGS), vat=pick([False, 'CO1']),
+                attributes=rng.sample([10, 11, 12, 13, 99], pick([0, 1, 2, 3])),
+                **dict((field, pick([False, 1, 2, 3])) for field in RULE_GEO_FIELDS))
+            expected = linear_match(rules, criteria)
+            matched = index.match(criteria)
+            self.assertEqual([rule.id for rule in matched], [rule['id'] for rule in expected])
+            accounts = [rule['account_invoice_id'] for rule in expected if rule['account_invoice_id']]
+            self.assertEqual(index.select_account(matched, 'account_invoice_id')[0],
+                             accounts and accounts[0] or False)
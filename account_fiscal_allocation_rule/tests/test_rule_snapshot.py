@@ -0,0 +1,71 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of the binary rule snapshot format (plain python, no database).
+
+import io
+import unittest2
+
+from ..models.fiscal_allocation_snapshot import SNAPSHOT_HEADER, dump_rule_snapshot, load_rule_snapshot, \
+    load_rule_snapshot_header
+from .test_rule_index import make_rule
+
+
+class TestRuleSnapshot(unittest2.TestCase):
+
+    def setUp(self):
+        self.rules = [
+            make_rule(7),
+            make_rule(8, sequence=3, use_sale=False, use_picking=False, from_country=49, to_invoice_state=12,
+                      date_start='2014-01-01', date_end='2014-12-31', vat_rule='with', fiscal_attribute_id=[3, 5],
+                      fiscal_allocation_id=[11], account_invoice_id=101),
+            make_rule(9, vat_rule=False, date_end='2015-06-30', fiscal_allocation_id=[11, 12],
+                      account_purchase_id=202),
+        ]
+        self.tax_sets = {11: ([1, 2], [3]), 12: ([], [4, 5])}
+        fileobj = io.BytesIO()
+        dump_rule_snapshot(fileobj, 1, 'a1b2c3d4-0000-1111-2222-333344445555', (4, 9, 2), self.rules,
+                           self.tax_sets)
+        self.data = fileobj.getvalue()
+
+    def test_round_trip(self):
+        header, rules, tax_sets = load_rule_snapshot(self.data)
+        self.assertEqual(rules, self.rules)
+        self.assertEqual(tax_sets, self.tax_sets)
+        self.assertEqual(header['company_id'], 1)
+
+    def test_header(self):
+        header = load_rule_snapshot_header(self.data)
+        self.assertEqual(header['database_uuid'], 'a1b2c3d4-0000-1111-2222-333344445555')
+        self.assertEqual(tuple(header['generations']), (4, 9, 2))
+        self.assertEqual(tuple(header['counts']), (3, 2, 3, 2, 5))
+
+    def test_empty(self):
+        fileobj = io.BytesIO()
+        dump_rule_snapshot(fileobj, 2, False, (0, 0, 0), [], {})
+        header, rules, tax_sets = load_rule_snapshot(fileobj.getvalue())
+        self.assertEqual((header['company_id'], header['database_uuid'], rules, tax_sets), (2, '', [], {}))
+
+    def test_bad_magic(self):
+        self.assertRaises(ValueError, load_rule_snapshot_header, b'XXXX' + self.data[4:])
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, load_rule_snapshot_header, self.data[:SNAPSHOT_HEADER.size - 1])
+        self.assertRaises(ValueError, load_rule_snapshot, self.data[:-4])
@@ -0,0 +1,69 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of the tax bitsets (plain python, no database).
+
+import threading
+import unittest2
+
+from ..models.fiscal_allocation_bitset import TaxOrdinals
+
+
+class TestTaxOrdinals(unittest2.TestCase):
+
+    def setUp(self):
+        self.ordinals = TaxOrdinals()
+
+    def test_encode(self):
+        self.assertEqual(self.ordinals.encode([]), 0)
+        self.assertEqual(self.ordinals.encode([30, 10]), 0b11)
+        # Known taxes keep their position, new ones get the next ones.
+        self.assertEqual(self.ordinals.encode([10, 20, 10]), 0b110)
+        self.assertEqual(len(self.ordinals), 3)
+
+    def test_union(self):
+        mask = self.ordinals.encode([5, 6]) | self.ordinals.encode([6, 7])
+        self.assertEqual(sorted(self.ordinals.decode(mask)), [5, 6, 7])
+
+    def test_decode_dense(self):
+        tax_ids = list(range(100, 140))
+        self.assertEqual(self.ordinals.decode(self.ordinals.encode(tax_ids)), tax_ids)
+        self.assertEqual(self.ordinals.decode(0), [])
+
+    def test_decode_sparse(self):
+        self.ordinals.encode(range(1, 1001))
+        mask = self.ordinals.encode([1, 500, 1000])
+        self.assertEqual(self.ordinals.decode(mask), [1, 500, 1000])
+
+    def test_concurrent_encode(self):
+        # Taxes met by several threads at once still get one distinct position each.
+        tax_ids = list(range(1, 501))
+        masks = []
+
+        def encode():
+            masks.append(self.ordinals.encode(tax_ids))
+        threads = [threading.Thread(target=encode) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.ordinals), len(tax_ids))
+        self.assertEqual(set(masks), set([(1 << len(tax_ids)) - 1]))
+        self.assertEqual(sorted(self.ordinals.decode(masks[0])), tax_ids)
@@ -0,0 +1,107 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule for Odoo
+#   Copyright (C) 2014-TODAY Odoo-Colombia <https://github.com/odoo-colombia>
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+# Unit tests of the union of the allocated taxes of map_tax, with the ORM replaced by plain objects.
+
+import unittest2
+
+from ..models.fiscal_allocation import AccountFiscalAllocation
+from ..models.fiscal_allocation_bitset import TaxOrdinals
+from ..models.fiscal_allocation_profile import FiscalAllocationProfile
+from ..models.fiscal_allocation_rule_index import CompiledRule
+from .test_rule_index import make_rule
+
+
+class FakeRuleModel(object):
+
+    def __init__(self):
+        self._profile = FiscalAllocationProfile()
+
+    def _cache_check(self, cr, uid, context=None):
+        pass
+
+    def _rule_generation_bump(self, cr, uid, company_ids=None, context=None):
+        pass
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.rule_model = FakeRuleModel()
+
+    def get(self, name):
+        return self.rule_model
+
+
+class FakeAllocationModel(object):
+    # Tax sets of the allocations: {allocation_id: (sale tax ids, purchase tax ids)}. With 'drop_after_encode', all
+    # the tax caches are dropped right after the tax sets are encoded, as another thread of the worker could.
+
+    map_tax = AccountFiscalAllocation.__dict__['map_tax']
+    _tax_cache_drop = AccountFiscalAllocation.__dict__['_tax_cache_drop']
+
+    def __init__(self, allocations):
+        self.pool = FakePool()
+        self.allocations = allocations
+        self.drop_after_encode = False
+        self._tax_sets = {}
+        self._tax_ordinals = TaxOrdinals()
+        self._tax_union_cache = {}
+
+    def read(self, cr, uid, ids, fields, context=None):
+        return [{'id': i, 'sale_tax_ids': self.allocations[i][0], 'purchase_tax_ids': self.allocations[i][1]}
+                for i in ids]
+
+    def _allocation_tax_sets(self, cr, uid, allocation_ids, context=None):
+        result = AccountFiscalAllocation.__dict__['_allocation_tax_sets'](
+            self, cr, uid, allocation_ids, context=context)
+        if self.drop_after_encode:
+            self._tax_cache_drop(cr, uid, context=context)
+        return result
+
+
+def compiled_rule(rule_id, allocation_ids):
+    return CompiledRule(make_rule(rule_id, fiscal_allocation_id=allocation_ids), 0, 1)
+
+
+class TestTaxUnion(unittest2.TestCase):
+
+    def setUp(self):
+        self.model = FakeAllocationModel({1: ([10, 11], [20]), 2: ([11, 12], [21])})
+        self.rules = [compiled_rule(1, [1]), compiled_rule(2, [2])]
+
+    def map_tax(self, rules, inv_type):
+        return sorted(self.model.map_tax(None, 1, rules, [5], inv_type))
+
+    def test_union(self):
+        self.assertEqual(self.map_tax(self.rules, 'out_invoice'), [5, 10, 11, 12])
+        self.assertEqual(self.map_tax(self.rules, 'in_refund'), [5, 20, 21])
+        self.assertEqual(self.map_tax(self.rules[1:], 'out_invoice'), [5, 11, 12])
+        self.assertEqual(self.map_tax(self.rules, 'other'), [5])
+
+    def test_drop_between_encode_and_decode(self):
+        # The masks encoded before a drop decode to their own taxes, also once taxes met after the drop took
+        # their bit positions.
+        self.model.drop_after_encode = True
+        self.assertEqual(self.map_tax(self.rules[:1], 'out_invoice'), [5, 10, 11])
+        self.model.allocations[3] = ([13, 10], [])
+        self.assertEqual(self.map_tax([compiled_rule(3, [3])], 'out_invoice'), [5, 10, 13])
+        self.assertEqual(self.map_tax(self.rules, 'out_invoice'), [5, 10, 11, 12])
+        self.assertEqual(self.map_tax(self.rules, 'in_invoice'), [5, 20, 21])
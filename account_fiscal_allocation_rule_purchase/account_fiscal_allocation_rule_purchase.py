@@ -25,7 +25,40 @@ from openerp.osv import orm
 class PurchaseOrder(orm.Model):
     _inherit = 'purchase.order'
 
+    # Header fields the taxes of the lines are mapped with.
+    _fiscal_allocation_header = ('partner_id', 'dest_address_id', 'company_id')
+
+    def write(self, cr, uid, ids, vals, context=None):
+        # The saved lines are re-mapped for the new header values when the order is saved, rather than by the header
+        # onchanges (see fiscal_allocation_line_updates): one batch for all lines, resolving the rules once per
+        # distinct product attributes. Lines created or edited in the same save keep the taxes of the form.
+        if not set(vals) & set(self._fiscal_allocation_header + ('fiscal_position',)):
+            return super(PurchaseOrder, self).write(cr, uid, ids, vals, context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        ctx = dict(context or {}, use_domain=('use_purchase', '=', True))
+        edited = set(command[1] for command in vals.get('order_line') or [] if command[0] in (1, 2, 3))
+        fa_rule_obj = self.pool.get('account.fiscal.allocation.rule')
+        updates = []
+        for order in self.browse(cr, uid, ids, context=ctx):
+            lines = [line for line in order.order_line if line.id not in edited]
+            if not lines:
+                continue
+            header = dict((name, vals[name] if name in vals else order[name].id)
+                          for name in self._fiscal_allocation_header)
+            updates += fa_rule_obj.fiscal_allocation_line_updates(
+                cr, uid, lines, 'taxes_id', header['partner_id'], header['partner_id'], header['dest_address_id'],
+                header['company_id'], 'use_purchase',
+                fiscal_position=vals['fiscal_position'] if 'fiscal_position' in vals else None, context=ctx)
+
+        result = super(PurchaseOrder, self).write(cr, uid, ids, vals, context=context)
+        obj_line = self.pool.get('purchase.order.line')
+        for command in updates:
+            obj_line.write(cr, uid, [command[1]], command[2], context=context)
+        return result
+
     def _fiscal_allocation_map(self, cr, uid, result, **kwargs):
+        # Header mapping. The lines are re-mapped when the order is saved, see write.
 
         if not kwargs.get('context', False):
             kwargs['context'] = {}
@@ -0,0 +1,49 @@
+# -*- encoding: utf-8 -*-
+###############################################################################
+#
+#   account_fiscal_allocation_rule_sale for OpenERP
+#   Copyright (C) 2009-TODAY Akretion <http://www.akretion.com>
+#     @author Sébastien BEAU <sebastien.beau@akretion.com>
+#     @author Renato Lima <renato.lima@akretion.com>
+#     @author Raphaël Valyi <raphael.valyi@akretion.com>
+#   Copyright 2012 Camptocamp SA
+#     @author: Guewen Baconnier
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+{
+    'name': 'Account Fiscal Allocation Rule Sale',
+    'description': 'Allocates the taxes of the sale order lines with the Fiscal Allocation Rules.',
+    'category': 'Localization/Account Charts',
+    'license': 'AGPL-3',
+    'author': 'David Arnold (El Aleman SAS), '
+              'Hector Ivan Valencia (TIX), '
+              'Juan Pablo Arias (OpenZIX)',
+    'website': '',
+    'version': '0.1',
+    'depends': [
+        'sale',
+        'account_fiscal_allocation_rule',
+    ],
+    'data': [
+        'views/sale_view.xml',
+    ],
+    'demo': [
+    ],
+    'test': [
+    ],
+    'installable': True,
+    'auto_install': False,
+}
@@ -29,16 +29,56 @@ from openerp.osv import orm
 class SaleOrder(orm.Model):
     _inherit = 'sale.order'
 
+    def _fiscal_allocation_company(self, cr, uid, shop_id, context=None):
+        # Company of the shop: a single read, resolved once per onchange and passed on to all the lines.
+        if not shop_id:
+            return False
+        return self.pool.get('sale.shop').read(
+            cr, uid, [shop_id], ['company_id'], context=context, load='_classic_write')[0]['company_id']
+
+    # Header fields the taxes of the lines are mapped with.
+    _fiscal_allocation_header = ('partner_id', 'partner_invoice_id', 'partner_shipping_id', 'shop_id')
+
+    def write(self, cr, uid, ids, vals, context=None):
+        # The saved lines are re-mapped for the new header values when the order is saved, rather than by the header
+        # onchanges (see fiscal_allocation_line_updates). Lines created or edited in the same save keep the taxes
+        # of the form.
+        if not set(vals) & set(self._fiscal_allocation_header + ('fiscal_position',)):
+            return super(SaleOrder, self).write(cr, uid, ids, vals, context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        ctx = dict(context or {}, use_domain=('use_sale', '=', True))
+        edited = set(command[1] for command in vals.get('order_line') or [] if command[0] in (1, 2, 3))
+        fa_rule_obj = self.pool.get('account.fiscal.allocation.rule')
+        updates = []
+        for order in self.browse(cr, uid, ids, context=ctx):
+            lines = [line for line in order.order_line if line.id not in edited]
+            if not lines:
+                continue
+            header = dict((name, vals[name] if name in vals else order[name].id)
+                          for name in self._fiscal_allocation_header)
+            updates += fa_rule_obj.fiscal_allocation_line_updates(
+                cr, uid, lines, 'tax_id', header['partner_id'], header['partner_invoice_id'],
+                header['partner_shipping_id'], self._fiscal_allocation_company(cr, uid, header['shop_id'], context=ctx),
+                'use_sale', fiscal_position=vals['fiscal_position'] if 'fiscal_position' in vals else None,
+                context=ctx)
+
+        result = super(SaleOrder, self).write(cr, uid, ids, vals, context=context)
+        obj_line = self.pool.get('sale.order.line')
+        for command in updates:
+            obj_line.write(cr, uid, [command[1]], command[2], context=context)
+        return result
+
     def _fiscal_allocation_map(self, cr, uid, result, **kwargs):
+        # Header mapping. The lines are re-mapped when the order is saved, see write.
 
         if not kwargs.get('context', False):
             kwargs['context'] = {}
 
         kwargs['context'].update({'use_domain': ('use_sale', '=', True)})
-        obj_shop = self.pool.get('sale.shop').browse(
-            cr, uid, kwargs.get('shop_id'))
-        company_id = obj_shop.company_id.id
-        kwargs.update({'company_id': company_id})
+        if not kwargs.get('company_id'):
+            kwargs['company_id'] = self._fiscal_allocation_company(
+                cr, uid, kwargs.get('shop_id'), context=kwargs['context'])
         fa_rule_obj = self.pool.get('account.fiscal.allocation.rule')
         return fa_rule_obj.apply_fiscal_mapping(cr, uid, result, **kwargs)
 
@@ -102,3 +142,44 @@ class SaleOrder(orm.Model):
             'context': context
         })
         return self._fiscal_allocation_map(cr, uid, result, **kwargs)
+
+
+class SaleOrderLine(orm.Model):
+    _inherit = 'sale.order.line'
+
+    # The order context of the line comes from the parent order: 'partner_invoice_id', 'partner_shipping_id' and
+    # 'company_id', added to the line context by views/sale_view.xml. Without 'company_id', the company of the
+    # 'shop_id' (or core 'shop') is read.
+    def product_id_change(self, cr, uid, ids, pricelist, product, qty=0,
+                          uom=False, qty_uos=0, uos=False, name='', partner_id=False,
+                          lang=False, update_tax=True, date_order=False, packaging=False,
+                          fiscal_position=False, flag=False, context=None):
+        if not context:
+            context = {}
+
+        result = super(SaleOrderLine, self).product_id_change(
+            cr, uid, ids, pricelist, product, qty=qty, uom=uom, qty_uos=qty_uos, uos=uos, name=name,
+            partner_id=partner_id, lang=lang, update_tax=update_tax, date_order=date_order, packaging=packaging,
+            fiscal_position=fiscal_position, flag=flag, context=context)
+
+        if not product or not partner_id or not update_tax:
+            return result
+
+        company_id = context.get('company_id') or self.pool.get('sale.order')._fiscal_allocation_company(
+            cr, uid, context.get('shop_id') or context.get('shop'), context=context)
+        if not company_id:
+            return result
+
+        values = result.setdefault('value', {})
+        ctx = dict(context, use_domain=('use_sale', '=', True))
+        if date_order:
+            ctx['date'] = date_order
+        mapped = self.pool.get('account.fiscal.allocation.rule').fiscal_allocation_map(
+            cr, uid, partner_id=partner_id,
+            partner_invoice_id=context.get('partner_invoice_id') or False,
+            partner_shipping_id=context.get('partner_shipping_id') or False,
+            company_id=company_id, product_id=product, taxes=values.get('tax_id') or [],
+            inv_type='out_invoice', context=ctx)
+        if 'invoice_line_tax_id' in mapped:
+            values['tax_id'] = mapped['invoice_line_tax_id']
+        return result
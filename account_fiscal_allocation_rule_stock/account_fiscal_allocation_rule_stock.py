@@ -52,23 +52,83 @@ class StockPicking(orm.Model):
         if not partner_id or not company_id:
             return result
 
-        partner_invoice_id = self.pool.get('res.partner').address_get(
-            cr, uid, [partner_id], ['invoice'])['invoice']
-        partner_shipping_id = self.pool.get('res.partner').address_get(
-            cr, uid, [partner_id], ['delivery'])['delivery']
+        addresses = self.pool.get('res.partner').address_get(
+            cr, uid, [partner_id], ['invoice', 'delivery'])
 
         kwargs.update({
             'partner_id': partner_id,
-            'partner_invoice_id': partner_invoice_id,
-            'partner_shipping_id': partner_shipping_id,
+            'partner_invoice_id': addresses['invoice'],
+            'partner_shipping_id': addresses['delivery'],
             'company_id': company_id,
             'context': context,
         })
         return self._fiscal_position_map(cr, uid, result, **kwargs)
 
+    def _fiscal_allocation_prepare(self, cr, uid, pickings, inv_type=None, context=None):
+        # Fiscal allocation of all the pickings invoiced together, in one fiscal_allocation_map_batch call: pickings
+        # of the same (company, partner, invoice / delivery address) share one rule resolution, their moves one per
+        # distinct product attributes. The addresses are looked up once per partner, for both types at once.
+        # Return {'accounts': {picking_id: account_id}, 'taxes': {move_id: [tax ids]}}.
+        obj_partner = self.pool.get('res.partner')
+        addresses = {}
+        lines, keys = [], []
+        for picking in pickings:
+            partner = self._get_partner_to_invoice(cr, uid, picking, context=context)
+            partner_id = isinstance(partner, (int, long)) and partner or partner and partner.id
+            if not partner_id:
+                continue
+            if partner_id not in addresses:
+                addresses[partner_id] = obj_partner.address_get(
+                    cr, uid, [partner_id], ['invoice', 'delivery'])
+            header = (partner_id, addresses[partner_id]['invoice'], addresses[partner_id]['delivery'],
+                      picking.company_id.id, False, picking.date and picking.date[:10], 'use_picking',
+                      inv_type or self._get_invoice_type(picking))
+            lines.append(header)
+            keys.append(('accounts', picking.id))
+            for move in picking.move_lines:
+                if move.product_id:
+                    lines.append(header[:4] + (move.product_id.id,) + header[5:])
+                    keys.append(('taxes', move.id))
+
+        result = {'accounts': {}, 'taxes': {}}
+        mapped = self.pool.get('account.fiscal.allocation.rule').fiscal_allocation_map_batch(
+            cr, uid, lines, context=context)
+        for (kind, res_id), values in zip(keys, mapped):
+            if kind == 'accounts':
+                result[kind][res_id] = values['account_id']
+            else:
+                result[kind][res_id] = values['invoice_line_tax_id']
+        return result
+
+    def action_invoice_create(self, cr, uid, ids, journal_id=False,
+                              group=False, type='out_invoice', context=None):
+        context = dict(context or {})
+        pickings = self.browse(cr, uid, ids, context=context)
+        context['fiscal_allocation_picking'] = self._fiscal_allocation_prepare(
+            cr, uid, pickings, type, context=context)
+        return super(StockPicking, self).action_invoice_create(
+            cr, uid, ids, journal_id=journal_id, group=group, type=type, context=context)
+
     def _prepare_invoice(self, cr, uid, picking, partner, inv_type,
                          journal_id, context=None):
         result = super(StockPicking, self)._prepare_invoice(cr, uid, picking,
                                                             partner, inv_type, journal_id, context)
         result['fiscal_position'] = picking.fiscal_position and picking.fiscal_position.id
+        allocation = (context or {}).get('fiscal_allocation_picking')
+        if allocation and allocation['accounts'].get(picking.id):
+            result['account_id'] = allocation['accounts'][picking.id]
+        return result
+
+    def _prepare_invoice_line(self, cr, uid, group, picking, move_line,
+                              invoice_id, invoice_vals, context=None):
+        result = super(StockPicking, self)._prepare_invoice_line(
+            cr, uid, group, picking, move_line, invoice_id, invoice_vals, context=context)
+        allocation = (context or {}).get('fiscal_allocation_picking')
+        taxes = allocation and allocation['taxes'].get(move_line.id)
+        if taxes:
+            tax_ids = set(taxes)
+            for command in result.get('invoice_line_tax_id') or []:
+                if command[0] == 6:
+                    tax_ids.update(command[2])
+            result['invoice_line_tax_id'] = [(6, 0, list(tax_ids))]
         return result